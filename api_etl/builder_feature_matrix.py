@@ -7,7 +7,7 @@ There are two kinds of features:
 Only the first one is used for now.
 """
 
-from os import path, makedirs
+from os import path
 import logging
 
 from datetime import datetime, timedelta
@@ -15,11 +15,14 @@ import numpy as np
 import pandas as pd
 
 from api_etl.utils_misc import (
-    get_paris_local_datetime_now, DateConverter, S3Bucket
+    get_paris_local_datetime_now, S3Bucket, dt_to_service_seconds,
+    special_times_to_seconds, special_datetimes_to_seconds,
+    service_seconds_to_datetimes
 )
-from api_etl.querier_schedule import DBQuerier
+from api_etl.querier_schedule import schedule_querier
 from api_etl.querier_realtime import ResultsSet
-from api_etl.settings import __S3_BUCKETS__, __TRAINING_SET_FOLDER_PATH__, __RAW_DAYS_FOLDER_PATH__, __DATA_PATH__
+from api_etl.utils_training_set import TrainingSetStore, save_raw_day
+from api_etl.settings import __S3_BUCKETS__, __RAW_DAYS_FOLDER_PATH__, __DATA_PATH__
 
 logger = logging.getLogger(__name__)
 pd.options.mode.chained_assignment = None
@@ -59,7 +62,7 @@ class DayMatrixBuilder:
             logger.info("Dataframe provided for day %s" % self.day)
         else:
             logger.info("Requesting data for day %s" % self.day)
-            self.querier = DBQuerier(scheduled_day=self.day)
+            self.querier = schedule_querier(scheduled_day=self.day)
             # Get schedule
             self.stops_results = self.querier.stoptimes(on_day=self.day, level=4)
             self.serialized_stoptimes = ResultsSet(self.stops_results)
@@ -97,8 +100,12 @@ class DayMatrixBuilder:
         - D_business_day: bool
         - D_stop_special_day: scheduled_day str, day in special date (25h)
         - D_total_sequence: int: number of stops scheduled per trip
+        - D_stop_scheduled_seconds: int, seconds since day midnight
         - D_stop_scheduled_datetime: datetime of scheduled stoptime
         - D_trip_passed_scheduled_stop: bool
+        - D_stop_observed_seconds: int, seconds since day midnight
+
+        Times are compared as seconds since the matrix day midnight.
         """
         # Detect if working day
         self._initial_df.loc[:, "D_business_day"] = bool(
@@ -107,55 +114,44 @@ class DayMatrixBuilder:
         # Write stoptime_day
         self._initial_df.loc[:, "D_stop_special_day"] = self.day
 
-        # Scheduled stop datetime
-        self._initial_df.loc[:, "D_stop_scheduled_datetime"] = self._initial_df\
-            .StopTime_departure_time\
-            .apply(lambda x: DateConverter(
-                special_time=x,
-                special_date=self.day,
-                force_regular_date=True
-            ).dt
+        now_seconds = dt_to_service_seconds(
+            self.paris_datetime_now, self.day)
+
+        # Scheduled stop time (forced on regular date: 25:10:00 -> 01:10:00)
+        self._initial_df.loc[:, "D_stop_scheduled_seconds"] = special_times_to_seconds(
+            self._initial_df.StopTime_departure_time
+        ) % 86400
+        self._initial_df.loc[:, "D_stop_scheduled_datetime"] = service_seconds_to_datetimes(
+            self._initial_df.D_stop_scheduled_seconds, self.day
         )
 
         # Has really passed schedule
-        self._initial_df.loc[:, "D_trip_passed_scheduled_stop"] = self._initial_df.D_stop_scheduled_datetime\
-            .apply(lambda x:
-                   (self.paris_datetime_now - x).total_seconds() >= 0
-                   )
-
-        # Observed stop datetime
-        self._initial_df.loc[:, "D_stop_observed_datetime"] = self\
-            ._initial_df[self._initial_df.RealTime_data_freshness.notnull()]\
-            .apply(lambda x: DateConverter(
-                special_time=x.RealTime_expected_passage_time,
-                special_date=x.RealTime_expected_passage_day
-            ).dt,
-            axis=1
+        self._initial_df.loc[:, "D_trip_passed_scheduled_stop"] = \
+            now_seconds >= self._initial_df.D_stop_scheduled_seconds
+
+        # Observed stop time
+        observed = self._initial_df.RealTime_data_freshness.notnull()
+        self._initial_df.loc[:, "D_stop_observed_seconds"] = special_datetimes_to_seconds(
+            special_dates=self._initial_df.RealTime_expected_passage_day,
+            special_times=self._initial_df.RealTime_expected_passage_time,
+            service_date=self.day
+        ).where(observed)
+        self._initial_df.loc[:, "D_stop_observed_datetime"] = service_seconds_to_datetimes(
+            self._initial_df.D_stop_observed_seconds, self.day
         )
 
-        self._initial_df.loc[:, "D_trip_time_to_observed_stop"] = self\
-            ._initial_df[self._initial_df.D_stop_observed_datetime.notnull()]\
-            .D_stop_observed_datetime\
-            .apply(lambda x:
-                   (self.paris_datetime_now - x).total_seconds()
-                   )
+        self._initial_df.loc[:, "D_trip_time_to_observed_stop"] = \
+            now_seconds - self._initial_df.D_stop_observed_seconds
 
-        # Has really passed observed stop
-        self._initial_df.loc[:, "D_trip_passed_observed_stop"] = self\
-            ._initial_df[self._initial_df.D_stop_observed_datetime.notnull()]\
-            .D_trip_time_to_observed_stop\
-            .apply(lambda x: (x >= 0))
+        # Has really passed observed stop (NaN if not observed)
+        self._initial_df.loc[:, "D_trip_passed_observed_stop"] = (
+            self._initial_df.D_trip_time_to_observed_stop >= 0
+        ).where(self._initial_df.D_stop_observed_seconds.notnull())
 
         # Trip delay
-        self._initial_df.loc[:, "D_trip_delay"] = self\
-            ._initial_df[self._initial_df.RealTime_data_freshness.notnull()]\
-            .apply(
-                lambda x:
-                    (x["D_stop_observed_datetime"] -
-                     x["D_stop_scheduled_datetime"])
-            .total_seconds(),
-                axis=1
-        )
+        self._initial_df.loc[:, "D_trip_delay"] = \
+            self._initial_df.D_stop_observed_seconds \
+            - self._initial_df.D_stop_scheduled_seconds
 
         # Trips total number of stops
         trips_total_number_stations = self._initial_df\
@@ -267,8 +263,9 @@ class DirectPredictionMatrix(DayMatrixBuilder):
     # For time debugging:
     _time_debug_cols = [
         "StopTime_departure_time", "RealTime_expected_passage_time",
-        'D_stop_special_day', 'D_stop_scheduled_datetime',
-        'D_trip_passed_scheduled_stop', 'D_stop_observed_datetime',
+        'D_stop_special_day', 'D_stop_scheduled_seconds',
+        'D_stop_scheduled_datetime', 'D_trip_passed_scheduled_stop',
+        'D_stop_observed_seconds', 'D_stop_observed_datetime',
         'D_trip_time_to_observed_stop', 'D_trip_passed_observed_stop',
         'D_trip_delay', 'TS_matrix_datetime',
         'TS_trip_passed_scheduled_stop', 'TS_observed_vs_matrix_datetime',
@@ -333,27 +330,22 @@ class DirectPredictionMatrix(DayMatrixBuilder):
         self.df.loc[:, "TS_matrix_datetime"] = self.state_at_datetime\
             .strftime("%Y%m%d-%H:%M:%S")
 
+        state_seconds = dt_to_service_seconds(self.state_at_datetime, self.day)
+
         # Has passed scheduled stop at state datetime
-        self.df.loc[:, "TS_trip_passed_scheduled_stop"] = self.df\
-            .D_stop_scheduled_datetime\
-            .apply(lambda x:
-                   ((self.state_at_datetime - x).total_seconds() >= 0),
-                   )
+        self.df.loc[:, "TS_trip_passed_scheduled_stop"] = \
+            state_seconds >= self.df.D_stop_scheduled_seconds
 
         # Time between matrix datetime (for which we compute the prediction
         # features matrix), and stop times observed passages (only for observed
         # passages). <0 means passed, >0 means not passed yet at the given time
-        self.df.loc[:, "TS_observed_vs_matrix_datetime"] = self\
-            .df[self.df["D_stop_observed_datetime"].notnull()]\
-            .D_stop_observed_datetime\
-            .apply(lambda x: (self.state_at_datetime - x).total_seconds())
-
-        # Has passed observed stop time at state datetime
-        self.df.loc[:, "TS_trip_passed_observed_stop"] = self\
-            .df[self.df["TS_observed_vs_matrix_datetime"]
-                .notnull()]\
-            .loc[:, "TS_observed_vs_matrix_datetime"]\
-            .apply(lambda x: (x >= 0))
+        self.df.loc[:, "TS_observed_vs_matrix_datetime"] = \
+            state_seconds - self.df.D_stop_observed_seconds
+
+        # Has passed observed stop time at state datetime (NaN if not observed)
+        self.df.loc[:, "TS_trip_passed_observed_stop"] = (
+            self.df.TS_observed_vs_matrix_datetime >= 0
+        ).where(self.df.TS_observed_vs_matrix_datetime.notnull())
 
         # TripState_observed_delay
         self.df.loc[:, "TS_observed_delay"] = self\
@@ -422,18 +414,12 @@ class DirectPredictionMatrix(DayMatrixBuilder):
             .join(last_observed_scheduled_dep_time, on="Trip_trip_id")
 
         # Compute number of seconds between last observed passed trip scheduled
-        # departure time, and departure time of predited station
-        self.df.loc[:, "TS_stations_scheduled_trip_time"] = self.df\
-            .query("TS_last_observed_scheduled_dep_time.notnull()")\
-            .apply(lambda x:
-                   DateConverter(dt=x["D_stop_scheduled_datetime"])
-                   .compute_delay_from(
-                       special_date=self.day,
-                       special_time=x["TS_last_observed_scheduled_dep_time"],
-                       force_regular_date=True
-                   ),
-                   axis=1
-                   )
+        # departure time, and departure time of predited station: both are
+        # times of the same trip, compared as seconds since service day
+        # midnight (not forced on regular date), as in StopTimePredictor
+        self.df.loc[:, "TS_stations_scheduled_trip_time"] = \
+            special_times_to_seconds(self.df.StopTime_departure_time)\
+            - special_times_to_seconds(self.df.TS_last_observed_scheduled_dep_time)
 
     def _line_level(self):
         """ Computes line level information:
@@ -853,6 +839,7 @@ class TrainingSetBuilder:
         self.tempo = tempo
 
         self.bucket_name = __S3_BUCKETS__["training-sets"]
+        self._store = TrainingSetStore(tempo=tempo)
 
         self._bucket_provider = S3Bucket(
             self.bucket_name,
@@ -863,32 +850,17 @@ class TrainingSetBuilder:
         mat = DirectPredictionMatrix(day)
         mat.compute_multiple_times_of_day(min_diff=self.tempo)
 
-        __FULL_TRAINING_SET_FOLDER__ = __TRAINING_SET_FOLDER_PATH__ % self.tempo
-
-        if not path.exists(__RAW_DAYS_FOLDER_PATH__):
-            makedirs(__RAW_DAYS_FOLDER_PATH__)
-
-        if not path.exists(__FULL_TRAINING_SET_FOLDER__):
-            makedirs(__FULL_TRAINING_SET_FOLDER__)
-
-        __RAW_FILE_NAME__ = "%s.pickle" % day
-        __RAW_FILE_PATH__ = path.join(__RAW_DAYS_FOLDER_PATH__, __RAW_FILE_NAME__)
-        __TRAINING_SET_FILE_NAME__ = "%s.pickle" % day
-        __TRAINING_SET_FILE_PATH__ = path.join(__FULL_TRAINING_SET_FOLDER__, __TRAINING_SET_FILE_NAME__)
-
+        # Parquet files: raw day in one file, training set in one file per
+        # line (see utils_training_set)
         logger.info("Saving data in %s." % __RAW_DAYS_FOLDER_PATH__)
-        mat._initial_df.to_pickle(__RAW_FILE_PATH__)
-        mat.result_concat.to_pickle(__TRAINING_SET_FILE_PATH__)
+        __RAW_FILE_PATH__ = save_raw_day(mat._initial_df, day)
+        __TRAINING_SET_FILE_PATHS__ = self._store.save_day(mat.result_concat, day)
 
         if save_s3:
-            self._bucket_provider.send_file(
-                file_local_path=__RAW_FILE_PATH__,
-                file_remote_path=path.relpath(__RAW_FILE_PATH__, __DATA_PATH__)
-            )
-
-            self._bucket_provider.send_file(
-                file_local_path=__TRAINING_SET_FILE_PATH__,
-                file_remote_path=path.relpath(__TRAINING_SET_FILE_PATH__, __DATA_PATH__)
+            # Files sent concurrently (and in parts if big)
+            self._bucket_provider.send_files(
+                [(file_path, path.relpath(file_path, __DATA_PATH__))
+                 for file_path in [__RAW_FILE_PATH__] + __TRAINING_SET_FILE_PATHS__]
             )
 
     def create_training_sets(self, save_s3=True):
@@ -12,12 +12,13 @@ Steps:
 import logging
 import statistics
 from datetime import datetime, timedelta
-from bdateutil import isbday
 
-from api_etl.utils_misc import get_paris_local_datetime_now, DateConverter
+from api_etl.utils_misc import (
+    get_paris_local_datetime_now, special_time_to_seconds
+)
 from api_etl.data_models import Stop
 from api_etl.querier_realtime import StopTimeState, ResultsSet
-from api_etl.querier_schedule import DBQuerier
+from api_etl.querier_schedule import schedule_querier
 from api_etl.feature_vector import StopTimeFeatureVector
 from api_etl.regressor_predict import RegressorPredictor
 
@@ -45,7 +46,7 @@ class StationState:
 
     def __init__(self, stop_id=None, stop=None, scheduled_day=None):
 
-        self._dbq = DBQuerier(scheduled_day=scheduled_day)
+        self._dbq = schedule_querier(scheduled_day=scheduled_day)
 
         # ARGS PARSING
         if stop:
@@ -268,14 +269,9 @@ class StopTimePredictor:
         return stop_sequence, scheduled_departure_time, delay
 
     def _compute_stoptimes_scheduled_diff(self, last_observed_scheduled_departure_time, last_observed_stop_sequence):
-        # could use static method
-        self.time_diff = DateConverter(
-            normal_date=self.StopTimeState._scheduled_day,
-            normal_time=self.StopTime.departure_time) \
-            .compute_delay_from(
-            special_date=self.StopTimeState._scheduled_day,
-            special_time=last_observed_scheduled_departure_time,
-        )
+        # both are scheduled times of the same trip, on the same service day
+        self.time_diff = special_time_to_seconds(self.StopTime.departure_time)\
+            - special_time_to_seconds(last_observed_scheduled_departure_time)
         self.sequence_diff = int(self.StopTime.stop_sequence) - int(last_observed_stop_sequence)
 
     def set_last_observed_information(self, stop_sequence, scheduled_departure_time, delay):
@@ -318,7 +314,8 @@ class StopTimePredictor:
             predicted_station_median_delay=self.predicted_station_stats["median_delay"])
 
     def _set_business_day_feature(self):
-        self.StopTimeFeatureVector.set_features(business_day=isbday(self.scheduled_day))
+        weekday = datetime.strptime(self.scheduled_day, "%Y%m%d").weekday()
+        self.StopTimeFeatureVector.set_features(business_day=weekday < 5)
 
     def is_predictable(self):
         """
@@ -363,7 +360,7 @@ class TripPredictor:
     def __init__(self, trip_id=None, scheduled_day=None):
         # TODO find line from trip_id
 
-        self._dbq = DBQuerier(scheduled_day=scheduled_day)
+        self._dbq = schedule_querier(scheduled_day=scheduled_day)
 
         # ARGS PARSING
         if not trip_id:
@@ -522,8 +519,11 @@ class TripPredictor:
                     )
 
     def _number_of_trips_rolling_at(self):
-        self.trips_rolling_at_time = self \
-            ._dbq.trips(on_day=self.scheduled_day, active_at_time=True, count=True)
+        # Trips rolling on trip's line, as in training sets
+        # (TS_rolling_trips_on_line)
+        self.trips_rolling_at_time = self._dbq.trips(
+            on_day=self.scheduled_day, active_at_time=True,
+            on_route_short_name=self.line, count=True)
         return self.trips_rolling_at_time
 
     def _build_prediction_vectors_for_stoptimes_to_predict(self):
@@ -5,9 +5,14 @@ from pynamodb.models import Model as DyModel
 from pynamodb.attributes import UnicodeAttribute
 
 from sqlalchemy.ext import declarative
-from sqlalchemy import Column, String, ForeignKey, Text, DateTime, ARRAY, Integer, LargeBinary
-
-from api_etl.utils_misc import get_paris_local_datetime_now, DateConverter
+from sqlalchemy import (
+    Column, String, ForeignKey, Text, DateTime, ARRAY, Integer, LargeBinary, Index
+)
+
+from api_etl.utils_misc import (
+    get_paris_local_datetime_now, special_datetime_to_seconds,
+    dt_to_service_seconds
+)
 from api_etl.utils_secrets import get_secret
 from api_etl.settings import __DYNAMO_REALTIME__
 
@@ -62,8 +67,8 @@ class RealTimeDeparture(DyModel):
         dt = self.expected_passage_time
         dd = self.expected_passage_day
 
-        time_past_dep = DateConverter(dt=at_datetime)\
-            .compute_delay_from(special_date=dd, special_time=dt)
+        time_past_dep = dt_to_service_seconds(at_datetime, dd)\
+            - special_datetime_to_seconds(dd, dt)
 
         if seconds:
             # return number of seconds instead of boolean
@@ -112,6 +117,10 @@ class Route(RdbModel):
 
 class Trip(RdbModel):
     __tablename__ = 'trips'
+    __table_args__ = (
+        Index("ix_trips_service_id", "service_id"),
+        Index("ix_trips_route_id", "route_id"),
+    )
 
     trip_id = Column(String(50), primary_key=True)
     route_id = Column(String(50), ForeignKey('routes.route_id'))
@@ -130,6 +139,10 @@ class Trip(RdbModel):
 
 class StopTime(RdbModel):
     __tablename__ = 'stop_times'
+    __table_args__ = (
+        Index("ix_stop_times_stop_departure", "stop_id", "departure_seconds"),
+        Index("ix_stop_times_trip_sequence", "trip_id", "stop_sequence_number"),
+    )
     trip_id = Column(String(50), ForeignKey('trips.trip_id'), primary_key=True)
     stop_id = Column(String(50), ForeignKey('stops.stop_id'), primary_key=True)
 
@@ -140,6 +153,13 @@ class StopTime(RdbModel):
     pickup_type = Column(String(50))
     drop_off_type = Column(String(50))
 
+    # Typed copies of GTFS values, for comparisons and indexes (see
+    # utils_rdb_migration): sequence as integer, times as seconds since
+    # service day midnight.
+    stop_sequence_number = Column(Integer())
+    arrival_seconds = Column(Integer())
+    departure_seconds = Column(Integer())
+
     def __repr__(self):
         return "<StopTime(trip_id='%s', stop_id='%s', stop_sequence='%s')>"\
             % (self.trip_id, self.stop_id, self.stop_sequence)
@@ -176,8 +196,8 @@ class StopTime(RdbModel):
         # either provided, either one saved through previous realtime request
         dd = self._scheduled_day
 
-        time_past_dep = DateConverter(dt=at_datetime)\
-            .compute_delay_from(special_date=dd, special_time=dt)
+        time_past_dep = dt_to_service_seconds(at_datetime, dd)\
+            - special_datetime_to_seconds(dd, dt)
 
         if seconds:
             # return number of seconds instead of boolean
@@ -231,6 +251,9 @@ class Calendar(RdbModel):
 
 class CalendarDate(RdbModel):
     __tablename__ = 'calendar_dates'
+    __table_args__ = (
+        Index("ix_calendar_dates_date", "date"),
+    )
 
     service_id = Column(String(50), primary_key=True)
     date = Column(String(50), primary_key=True)
@@ -247,6 +270,71 @@ class CalendarDate(RdbModel):
         return self.__repr__()
 
 
+class ServiceDay(RdbModel):
+    """
+    Services active on each day, computed from calendars and calendar dates
+    (see utils_calendar.ServiceCalendar).
+    """
+    __tablename__ = 'service_days'
+
+    date = Column(String(50), primary_key=True)
+    service_id = Column(String(50), primary_key=True)
+
+    def __repr__(self):
+        return "<ServiceDay(date='%s', service_id='%s')>"\
+            % (self.date, self.service_id)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class TripExtent(RdbModel):
+    """
+    Extent of each trip, computed from its stop times (see
+    utils_trip_extents.TripExtents): times are seconds since service day
+    midnight.
+    """
+    __tablename__ = 'trip_extents'
+    __table_args__ = (
+        Index("ix_trip_extents_line_departure", "route_short_name", "first_departure"),
+    )
+
+    trip_id = Column(String(50), primary_key=True)
+    route_short_name = Column(String(50))
+    direction_id = Column(String(50))
+    service_id = Column(String(50))
+    first_departure = Column(Integer())
+    last_arrival = Column(Integer())
+    number_of_stops = Column(Integer())
+
+    def __repr__(self):
+        return "<TripExtent(trip_id='%s', first_departure='%s', last_arrival='%s')>"\
+            % (self.trip_id, self.first_departure, self.last_arrival)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class ScheduleVersion(RdbModel):
+    """
+    Loads of schedule tables: a row is added in the transaction replacing
+    them (see utils_rdb_bulk.GtfsBulkLoader), so that readers know when
+    schedule changed.
+    """
+    __tablename__ = 'schedule_versions'
+
+    version = Column(String(50), primary_key=True)
+    loaded_at = Column(DateTime)
+    tables = Column(Text)
+
+    def __repr__(self):
+        return "<ScheduleVersion(version='%s', loaded_at='%s')>"\
+            % (self.version, self.loaded_at)
+
+    def __str__(self):
+        return self.__repr__()
+
+
 class Predictor(RdbModel):
     """
     A predictor consists of a vector scaler, and a regressor.
@@ -7,39 +7,170 @@ Core module using other modules to:
 import logging
 import time
 from datetime import datetime
-import json
+from io import BytesIO
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import asyncio
 
-import xmltodict
+from defusedxml.ElementTree import iterparse
 import pandas as pd
 
 from api_etl.utils_misc import (
-    get_paris_local_datetime_now, DateConverter, StationProvider
+    get_paris_local_datetime_now, parse_api_date, api_date_to_special_datetime,
+    date_parsing_cache_info, StationProvider
 )
 from api_etl.utils_api_client import ApiClient
+from api_etl.utils_dynamo import DynamoBatchWriter, WriteSkipCache
+from api_etl.utils_archive import RealtimeArchive
+from api_etl.utils_polling import (
+    StationSchedule, AdaptivePollingScheduler, PassagePoller,
+    service_day_and_seconds
+)
 from api_etl.data_models import RealTimeDeparture
+from api_etl.settings import (
+    __API_RATE_LIMIT__, __DYNAMO_REALTIME__, __ADAPTIVE_POLLING__,
+    __PASSAGE_POLLING__, __REALTIME_ARCHIVE__
+)
 
 logger = logging.getLogger(__name__)
 pd.options.mode.chained_assignment = None
 
+# Optional fields given by the API for each train
+_OPTIONAL_TRAIN_FIELDS = ("miss", "term", "etat")
+
+
+def parse_api_response(xml_string, station, request_dt):
+    """
+    Streaming parser of transilien's API XML answers: yields, for each train,
+    a dict of strings that can directly be used to build RealTimeDeparture
+    objects.
+
+    Trains are parsed one after the other, and duplicates on
+    (day_train_num, station_id) keys are dropped (first one is kept).
+
+    :param xml_string: XML answer of the API
+    :type xml_string: string/bytes
+
+    :param station: station id that was queried (8 digits)
+    :type station: string/integer
+
+    :param request_dt: datetime of request (Paris time, naive), used to
+    compute data freshness.
+    :type request_dt: datetime
+
+    :rtype: generator of dicts
+    """
+    if isinstance(xml_string, str):
+        xml_string = xml_string.encode("utf-8")
+
+    station_8d = str(station)
+    station_id = station_8d[:-1]
+    request_day = request_dt.strftime('%Y%m%d')
+    request_time = request_dt.strftime('%H:%M:%S')
+
+    seen_keys = set()
+    for _, element in iterparse(BytesIO(xml_string), events=("end",)):
+        if element.tag != "train":
+            continue
+        fields = {child.tag: (child.text or "").strip() for child in element}
+        # Free memory of already parsed trains
+        element.clear()
+
+        api_date = fields["date"]
+        dt = parse_api_date(api_date)
+        expected_passage_day, expected_passage_time = \
+            api_date_to_special_datetime(api_date)
+
+        # Hash key for dynamodb: station (7 digits)
+        # Sort key for dynamodb: day_train_num
+        day_train_num = "%s_%s" % (expected_passage_day, fields["num"])
+        if day_train_num in seen_keys:
+            continue
+        seen_keys.add(day_train_num)
+
+        record = {
+            "date": api_date,
+            "train_num": fields["num"],
+            "expected_passage_day": expected_passage_day,
+            "expected_passage_time": expected_passage_time,
+            "request_day": request_day,
+            "request_time": request_time,
+            "station_8d": station_8d,
+            "station_id": station_id,
+            # Data freshness is time in seconds between request time and
+            # expected_passage_time: lower is better
+            "data_freshness": str(int((dt - request_dt).total_seconds())),
+            "day_train_num": day_train_num,
+        }
+        for field in _OPTIONAL_TRAIN_FIELDS:
+            if fields.get(field):
+                record[field] = fields[field]
+        yield record
+
+
+def parse_station_records(xml_string, station, request_dt):
+    """
+    Same as parse_api_response, but returns a list (can be sent to executors,
+    including process pools).
+    """
+    return list(parse_api_response(xml_string, station, request_dt))
+
 
 class ApiExtractor:
-    """ Made for unique usage
+    """ Made for unique usage.
+
+    An ApiClient can be provided (for instance a persistent one, reused
+    across cycles): otherwise a new one is built for each request. Likewise,
+    a DynamoBatchWriter can be provided, otherwise one is built (and closed)
+    when saving. If a WriteSkipCache is provided, departures that did not
+    change since they were last written are not written again. If a
+    RealtimeArchive is provided, parsed departures are also appended to it
+    (whatever the mode) by batches of "archive_batch_size" departures, as
+    they are parsed: remaining ones are appended by "save_in_archive".
+
+    Two modes are available:
+    - default: responses are parsed after request, and RealTimeDeparture
+    objects are kept in "dynamo_objects" attribute.
+    - streaming: responses are parsed only when saved in Dynamo, one after
+    the other, and released once parsed. Only counters are kept, and
+    optionally a sample of the last "sample_size" parsed departures (for
+    debugging), so that memory does not depend on number of stations.
+
+    Station list is deduplicated: a station given twice is requested once
+    per cycle.
     """
 
-    def __init__(self, stations, max_per_minute=350):
+    def __init__(self, stations, max_per_minute=__API_RATE_LIMIT__["max_per_minute"], client=None,
+                 streaming=False, sample_size=0, writer=None, skip_cache=None, archive=None,
+                 archive_batch_size=__REALTIME_ARCHIVE__["batch_size"]):
 
         assert isinstance(stations, list)
         stations = list(map(str, stations))
         for station in stations:
             assert len(station) == 8
-        self.stations = stations
+        # Stations requested twice would give duplicated departures
+        unique_stations = list(dict.fromkeys(stations))
+        if len(unique_stations) < len(stations):
+            logger.warning("%d duplicated stations are requested once",
+                           len(stations) - len(unique_stations))
+        self.stations = unique_stations
 
         self.max_per_minute = max_per_minute
+        self.client = client
+        self.writer = writer
+        self._owns_writer = False
+        self.skip_cache = skip_cache
+        self.archive = archive
+        self.archive_batch_size = archive_batch_size
+        self._archive_buffer = []
+        self.streaming = streaming
         self.request_paris_time = None
         self.raw_responses = []
-        self.json_objects = []
-        self.dict_objects = []
         self.dynamo_objects = []
+        self.sample = deque(maxlen=sample_size) if sample_size else None
+        self.counters = Counter()
+        # Number of parsed departures per station
+        self.station_departures = Counter()
         self.saved_dynamo = False
         self.saved_mongo = False
 
@@ -47,59 +178,108 @@ class ApiExtractor:
         """
         This function will query transilien's API asking for expected trains
         passages in near future on stations defined as paramater, and parse
-        responses so that it can be saved in databases.
+        responses so that it can be saved in databases (in streaming mode,
+        parsing is made when saving).
 
         Note that stations id required by api are in 8 digits format.
 
         Note also that the maximum queries per minute accepted by the API is
-        350.
+        350: requests are spread by the ApiClient rate limiter according to
+        "max_per_minute" attribute.
 
         This function will save responses in "raw_responses" attribute, each
-        response being a tuple (string response, station).
+        response being a StationResponse object (content, station, status,
+        latency, size, number of attempts).
         """
 
         logger.info("Extraction of %d stations" % len(self.stations))
-        client = ApiClient()
+        client = self.client or ApiClient(max_per_minute=self.max_per_minute)
         self.raw_responses = client.request_stations(self.stations)
 
+        failed = [r.station for r in self.raw_responses if not r.is_ok()]
+        if failed:
+            logger.warning("No valid answer for %d stations: %s",
+                           len(failed), failed)
+        self.counters["requested_stations"] += len(self.raw_responses)
+        self.counters["failed_stations"] += len(failed)
+        self.counters["received_bytes"] += sum(r.size for r in self.raw_responses)
+        self.counters["attempts"] += sum(r.attempts for r in self.raw_responses)
+        logger.info(
+            "Received %d bytes in %d attempts",
+            self.counters["received_bytes"], self.counters["attempts"]
+        )
+
         # Save at what time the request was made (Paris Time)
         self.request_paris_time = get_paris_local_datetime_now()\
             .replace(tzinfo=None)
 
         # Parse responses
-        self._parse_responses()
+        if not self.streaming:
+            self._parse_responses()
 
-    def _parse_responses(self):
+    def _iter_departures(self):
         """
-        This function parses responses located in "raw_responses" attribute,
-        and saves parsed responses in following attributes:
-        - json_objects
-        - dict_objects
-        - dynamo_objects
+        Generator of parsed departures (dicts), response after response.
+
+        A response is parsed entirely before its departures are yielded, so
+        that a station is either fully parsed or skipped. In streaming mode,
+        responses contents are released once parsed.
         """
-        # Empties previous requests
-        self.json_objects = []
-        self.dict_objects = []
-        self.dynamo_objects = []
-        # Parse responses in JSON format
         logger.info("Parsing")
         for response in self.raw_responses:
+            if not response.is_ok():
+                continue
             try:
-                xml_string = response[0]
-                station = response[1]
-                self._parse_response(xml_string, station)
+                records = list(parse_api_response(
+                    response.content, response.station,
+                    request_dt=self.request_paris_time))
             except Exception as e:
                 logger.debug("Cannot parse station %s: %s" %
-                              (response[1], e))
+                             (response.station, e))
+                self.counters["unparsed_stations"] += 1
                 continue
+            finally:
+                if self.streaming:
+                    response.release()
+
+            self.counters["parsed_stations"] += 1
+            self.counters["departures"] += len(records)
+            self.station_departures[response.station] += len(records)
+            self._collect(records)
+            for record in records:
+                yield record
+
+    def _collect(self, records):
+        """
+        Keeps parsed departures of a response in sample (if any), and for
+        archive (if any), to which they are appended once a batch is full.
+        """
+        if self.sample is not None:
+            self.sample.extend(records)
+        if self.archive is not None:
+            self._archive_buffer.extend(records)
+            if len(self._archive_buffer) >= self.archive_batch_size:
+                try:
+                    self.save_in_archive()
+                except Exception as e:
+                    # Archive is secondary: a failure must not stop extraction
+                    logger.error("Cannot archive departures: %s", e)
+
+    def _parse_responses(self):
+        """
+        This function parses responses located in "raw_responses" attribute,
+        and saves parsed responses in "dynamo_objects" attribute.
+        """
+        # Empties previous requests
+        self.dynamo_objects = [
+            RealTimeDeparture(**item) for item in self._iter_departures()
+        ]
 
     def _parse_response(self, xml_string, station, return_df=False):
         """
         This function transforms transilien's API XML answers into a list of
-        objects, in a valid format, and saves it in attributes:
-        \n- json_objects
-        \n- dict_objects
-        \n- dynamo_objects
+        objects, in a valid format, and saves it in "dynamo_objects"
+        attribute.
 
         :param xml_string: XML string you want to transform
         :type xml_string: string
@@ -111,95 +291,254 @@ class ApiExtractor:
         eurs/
         :type station: string/integer
 
+        Parsing is made by parse_api_response streaming parser.
         """
+        records = list(parse_api_response(
+            xml_string, station, request_dt=self.request_paris_time))
+        self._collect(records)
 
-        # Save with Paris timezone (if server is abroad)
-        request_dt = self.request_paris_time
-
-        # Parse XML into a dataframe
-        mydict = xmltodict.parse(xml_string)
-        trains = mydict["passages"]["train"]
-        df_trains = pd.DataFrame(trains)
-
-        # Add custom fields
-        df_trains.loc[:, "date"] = df_trains.date.apply(lambda x: x["#text"])
-        df_trains.loc[:, "dt_conv"] = df_trains["date"]\
-            .apply(lambda x: DateConverter(api_date=x))
-
-        df_trains.loc[:, "expected_passage_day"] = df_trains["dt_conv"]\
-            .apply(lambda x: x.special_date)
-        df_trains.loc[:, "expected_passage_time"] = df_trains["dt_conv"]\
-            .apply(lambda x: x.special_time)
-
-        df_trains.loc[:, "request_day"] = request_dt.strftime('%Y%m%d')
-        df_trains.loc[:, "request_time"] = request_dt.strftime('%H:%M:%S')
-        df_trains.loc[:, "station_8d"] = str(station)
-        df_trains.loc[:, "station_id"] = str(station)[:-1]
-
-        df_trains.rename(columns={'num': 'train_num'}, inplace=True)
-
-        # Data freshness is time in seconds between request time and
-        # expected_passage_time: lower is better
-        df_trains.loc[:, "data_freshness"] = df_trains\
-            .apply(
-                lambda x: int(x["dt_conv"].compute_delay_from(
-                    dt=request_dt
-                )),
-            axis=1
-        )
-        # Delete datetime converter objects
-        del df_trains["dt_conv"]
-
-        # Hash key for dynamodb: formerly: day_station, now, station (7 digits)
-        # Sort key for dynamodb: formerly: train_num, now, day_train_num
-        df_trains.loc[:, "day_train_num"] = df_trains\
-            .apply(
-                lambda x: "%s_%s" % (
-                    x["expected_passage_day"], x["train_num"]),
-                axis=1
-        )
-
-        # Save only strings in databases
-        df_trains = df_trains.applymap(str)
-
-        # Drop possible duplicates on keys:
-        df_trains.drop_duplicates(
-            subset=["day_train_num", "station_id"],
-            inplace=True
+        self.dynamo_objects.extend(
+            RealTimeDeparture(**item) for item in records
         )
 
-        jsons_to_add = json.loads(df_trains.to_json(orient='records'))
-        self.json_objects.extend(jsons_to_add)
-
-        dicts_to_add = df_trains.to_dict(orient='records')
-        self.dict_objects.extend(dicts_to_add)
-
-        dynamo_objects_to_add = [
-            RealTimeDeparture(**item) for item in dicts_to_add
-        ]
-
-        self.dynamo_objects.extend(dynamo_objects_to_add)
-
         if return_df:
-            return df_trains
+            return pd.DataFrame(records)
 
     def save_in_dynamo(self):
         """
         Saves objects in dynamo database.
+
+        In streaming mode, departures flow from responses through parsing into
+        the batch writer, without being stored.
         """
-        logger.info("Upsert of %d objects in dynamo",
-                     len(self.dynamo_objects))
-        with RealTimeDeparture.batch_write() as batch:
-            for obj in self.dynamo_objects:
-                batch.save(obj)
+        if self.streaming:
+            items = (
+                RealTimeDeparture(**item) for item in self._iter_departures()
+            )
+        else:
+            items = self.dynamo_objects
+
+        try:
+            saved = self._save_items(items)
+        finally:
+            self._close_writer()
+        self.saved_dynamo = True
+        logger.info("Upsert of %d objects in dynamo", saved)
         # Previously:
         # dynamo_insert_batches(items_list, table_name = dynamo_real_dep)
 
-def operate_one_cycle(station_filter=False, dynamo_unique=True):
+    def save_in_archive(self):
+        """
+        Appends departures parsed and not archived yet to the realtime
+        archive. They are dropped from buffer even if append fails, so that
+        memory stays bounded.
+        """
+        if self.archive is None:
+            return
+        records, self._archive_buffer = self._archive_buffer, []
+        archived = self.archive.append(records)
+        self.counters["archived"] += archived
+        logger.info("Archived %d departures", archived)
+
+    def _get_writer(self):
+        if self.writer is None:
+            self.writer = DynamoBatchWriter(
+                RealTimeDeparture,
+                write_capacity=__DYNAMO_REALTIME__["provisioned_throughput"]["write"]
+            )
+            self._owns_writer = True
+        return self.writer
+
+    def _close_writer(self):
+        if self._owns_writer:
+            self.writer.close()
+            self.writer = None
+            self._owns_writer = False
+
+    def _save_items(self, items):
+        """
+        Saves RealTimeDeparture objects in dynamo, returns number of items
+        saved.
+        """
+        cache = self.skip_cache
+        if cache is not None:
+            skipped = cache.counters["skipped"]
+            items = cache.filter(items)
+        try:
+            stats = self._get_writer().write(items)
+        except Exception:
+            if cache is not None:
+                cache.rollback()
+            raise
+        if cache is not None:
+            # Failed items are not known individually: all will be written
+            # again next time
+            if stats["failed"]:
+                cache.rollback()
+            else:
+                cache.commit()
+            self.counters["skipped_dynamo"] += cache.counters["skipped"] - skipped
+
+        self.counters["saved_dynamo"] += stats["saved"]
+        for key in ("batches", "retries", "throttled", "failed", "latency"):
+            self.counters["write_%s" % key] += stats[key]
+        return stats["saved"]
+
+    def request_and_save_pipelined(self, parse_workers=2, use_processes=False, write_batch_size=100,
+                                   max_pending_batches=50):
+        """
+        Queries API, parses responses and saves them in dynamo concurrently:
+        - each response is parsed as soon as it is received, in a thread (or
+        process) pool, so that parsing does not block requests.
+        - parsed departures are sent to a writer, which saves them in dynamo
+        (in its own thread) by batches of "write_batch_size" items, while
+        other stations are still being requested and parsed.
+
+        Cycle duration is then close to the slowest of the three steps, instead
+        of their sum. As in streaming mode, only counters (and optional
+        sample) are kept.
+
+        Request time (used for data freshness) is the time at which each
+        response is received.
+
+        If the writer fails, stations not yet requested are cancelled, and
+        its exception is raised.
+
+        :param parse_workers: number of workers parsing responses.
+        :type parse_workers: int
+
+        :param use_processes: parse in processes instead of threads.
+        :type use_processes: boolean
+
+        :param write_batch_size: number of departures per write to dynamo.
+        :type write_batch_size: int
+
+        :param max_pending_batches: maximum number of parsed responses waiting
+        for the writer (bounds memory if dynamo is slower than API).
+        :type max_pending_batches: int
+        """
+        logger.info("Pipelined extraction of %d stations" % len(self.stations))
+        client = self.client or ApiClient(max_per_minute=self.max_per_minute)
+
+        if use_processes:
+            parse_executor = ProcessPoolExecutor(max_workers=parse_workers)
+        else:
+            parse_executor = ThreadPoolExecutor(max_workers=parse_workers)
+        write_executor = ThreadPoolExecutor(max_workers=1)
+
+        async def run():
+            loop = asyncio.get_event_loop()
+            queue = asyncio.Queue(maxsize=max_pending_batches)
+
+            async def on_response(response):
+                if not response.is_ok():
+                    return
+                request_dt = get_paris_local_datetime_now().replace(tzinfo=None)
+                begin = time.monotonic()
+                try:
+                    records = await loop.run_in_executor(
+                        parse_executor, parse_station_records,
+                        response.content, response.station, request_dt)
+                except Exception as e:
+                    logger.debug("Cannot parse station %s: %s" %
+                                 (response.station, e))
+                    self.counters["unparsed_stations"] += 1
+                    return
+                finally:
+                    response.release()
+                self.counters["parse_seconds"] += time.monotonic() - begin
+                self.counters["parsed_stations"] += 1
+                self.counters["departures"] += len(records)
+                self.station_departures[response.station] += len(records)
+                self._collect(records)
+                await send(records)
+
+            def write(records):
+                begin = time.monotonic()
+                self._save_items(RealTimeDeparture(**item) for item in records)
+                self.counters["write_seconds"] += time.monotonic() - begin
+
+            async def writer():
+                pending = []
+                while True:
+                    records = await queue.get()
+                    if records is None:
+                        break
+                    pending.extend(records)
+                    if len(pending) >= write_batch_size:
+                        await loop.run_in_executor(write_executor, write, pending)
+                        pending = []
+                if pending:
+                    await loop.run_in_executor(write_executor, write, pending)
+
+            async def send(records):
+                # Queue is not consumed anymore if writer failed: its
+                # exception is raised instead of waiting forever
+                put = asyncio.ensure_future(queue.put(records))
+                try:
+                    await asyncio.wait(
+                        [put, writer_task], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    if not put.done():
+                        put.cancel()
+                        await asyncio.wait([put])
+                if put.cancelled():
+                    writer_task.result()
+
+            writer_task = asyncio.ensure_future(writer())
+            fetch_task = asyncio.ensure_future(client.fetch_stations(
+                self.stations, on_response=on_response))
+            try:
+                await asyncio.wait(
+                    [fetch_task, writer_task], return_when=asyncio.FIRST_COMPLETED)
+                if writer_task.done():
+                    # Writer only ends before fetch if it failed: stops
+                    # fetching, and raises its exception
+                    fetch_task.cancel()
+                    await asyncio.wait([fetch_task])
+                    writer_task.result()
+                responses = fetch_task.result()
+            finally:
+                # Ends writer once all parsed departures are sent
+                if not writer_task.done():
+                    await send(None)
+                    await writer_task
+            return responses
+
+        begin = time.monotonic()
+        try:
+            self.raw_responses = client.run(run())
+        finally:
+            parse_executor.shutdown(wait=True)
+            write_executor.shutdown(wait=True)
+            self._close_writer()
+        self.counters["cycle_seconds"] += time.monotonic() - begin
+
+        failed = [r.station for r in self.raw_responses if not r.is_ok()]
+        if failed:
+            logger.warning("No valid answer for %d stations: %s",
+                           len(failed), failed)
+        self.counters["requested_stations"] += len(self.raw_responses)
+        self.counters["failed_stations"] += len(failed)
+        self.counters["received_bytes"] += sum(r.size for r in self.raw_responses)
+        self.counters["attempts"] += sum(r.attempts for r in self.raw_responses)
+        self.saved_dynamo = True
+        logger.info(
+            "Upsert of %d objects in dynamo (fetch, parse and write took %.1f "
+            "seconds, of which %.1f parsing and %.1f writing)",
+            self.counters["saved_dynamo"], self.counters["cycle_seconds"],
+            self.counters["parse_seconds"], self.counters["write_seconds"]
+        )
+
+
+def operate_one_cycle(station_filter=False, dynamo_unique=True, max_per_minute=__API_RATE_LIMIT__["max_per_minute"],
+                      client=None, pipelined=True, writer=None, skip_cache=None, scheduler=None,
+                      archive=None):
     """
-    This function performs the extract_save_stations operation in two steps.
-    First half of stations, then second half of stations. This is made so that
-    we do not exceed transilien's api max requests per minute (350/min).
+    This function performs the extract_save_stations operation for all
+    stations at once. Requests are spread by the ApiClient rate limiter so
+    that we do not exceed transilien's api max requests per minute (350/min),
+    while using all of the quota.
 
     :param station_filter: default to False. If no filter, the function will
     take all stations provided by the StationProvider class. If set to list,
@@ -209,38 +548,330 @@ def operate_one_cycle(station_filter=False, dynamo_unique=True):
 
     :param dynamo_unique: save items in dynamo table that save unique passages
     :type dynamo_unique: boolean
+
+    :param max_per_minute: maximum number of requests per minute.
+    :type max_per_minute: int
+
+    :param client: client used to query the api, if None a new one is built.
+    :type client: ApiClient OR None
+
+    :param pipelined: if saving in dynamo, parse and save responses while
+    other stations are still requested.
+    :type pipelined: boolean
+
+    :param writer: writer used to save in dynamo, if None a new one is built.
+    :type writer: DynamoBatchWriter OR None
+
+    :param skip_cache: cache of written departures, used to skip unchanged
+    ones. If None, all departures are written.
+    :type skip_cache: WriteSkipCache OR None
+
+    :param scheduler: if provided, selects which stations are requested in
+    this cycle (station_filter is then ignored).
+    :type scheduler: AdaptivePollingScheduler OR None
+
+    :param archive: if provided, parsed departures are also appended to this
+    local archive.
+    :type archive: RealtimeArchive OR None
     """
-    if not station_filter:
+    if scheduler is not None:
+        station_list = scheduler.select()
+        if not station_list:
+            logger.info("No station to request in this cycle.")
+            return
+    elif not station_filter:
         station_list = StationProvider().get_stations_per_line()
     else:
         station_list = station_filter
 
-    # station_chunks = chunks(station_list, max_per_minute)
-    # split stations in two of same size
-    station_chunks = [station_list[i::2] for i in range(2)]
+    # Cycles are scheduled every two minutes
+    if len(station_list) > 2 * max_per_minute:
+        logger.warning(
+            "%d stations cannot be requested in less than two minutes with "
+            "a quota of %d requests per minute.",
+            len(station_list), max_per_minute
+        )
 
-    for i, station_chunk in enumerate(station_chunks):
-        chunk_begin_time = datetime.now()
+    cycle_begin_time = datetime.now()
 
-        extractor = ApiExtractor(station_chunk)
+    # Parsed departures flow directly to dynamo, without being stored
+    extractor = ApiExtractor(
+        station_list, max_per_minute=max_per_minute, client=client,
+        streaming=dynamo_unique, writer=writer, skip_cache=skip_cache,
+        archive=archive)
+    if dynamo_unique and pipelined:
+        extractor.request_and_save_pipelined()
+    else:
         extractor.request_api_for_stations()
-
         if dynamo_unique:
             extractor.save_in_dynamo()
 
-        time_passed = (datetime.now() - chunk_begin_time).seconds
-        logger.info("Time spent: %d seconds", int(time_passed))
+    if scheduler is not None:
+        scheduler.record(
+            extractor.station_departures,
+            {response.station: response.status for response in extractor.raw_responses}
+        )
 
-        # Max per minute: so have to wait
-        if time_passed > 60:
-            logger.warning(
-                "Chunk time took more than one minute: %d seconds",
-                time_passed
+    if archive is not None:
+        try:
+            extractor.save_in_archive()
+        except Exception as e:
+            # Archive is secondary: a failure must not stop extraction
+            logger.error("Cannot archive departures: %s", e)
+
+    time_passed = (datetime.now() - cycle_begin_time).seconds
+    logger.info("Time spent: %d seconds", int(time_passed))
+    logger.info("Cycle counters: %s", dict(extractor.counters))
+    if extractor.counters["write_batches"]:
+        logger.info(
+            "Dynamo writes: %d requests (mean latency %.3f seconds), %d "
+            "throttled, %d retries, %d items failed",
+            extractor.counters["write_batches"],
+            extractor.counters["write_latency"] / extractor.counters["write_batches"],
+            extractor.counters["write_throttled"],
+            extractor.counters["write_retries"],
+            extractor.counters["write_failed"]
+        )
+    if skip_cache is not None and extractor.counters["departures"]:
+        logger.info(
+            "Skipped %d unchanged departures out of %d (%.1f%%)",
+            extractor.counters["skipped_dynamo"],
+            extractor.counters["departures"],
+            100. * extractor.counters["skipped_dynamo"] / extractor.counters["departures"]
+        )
+    logger.debug("Date parsing caches: %s", date_parsing_cache_info())
+
+    if time_passed > 120:
+        logger.warning(
+            "Cycle took more than two minutes: %d seconds", time_passed
+        )
+
+
+class ExtractionService:
+    """ Long-lived extraction service, made to be kept by a worker process.
+
+    It keeps one persistent ApiClient, so that its event loop, its rate
+    limiter, and its keep-alive connection pool (TCP connections and DNS
+    lookups) are reused across extraction cycles. Its DynamoBatchWriter (and
+    write pacing) is also shared by all cycles, as well as its WriteSkipCache,
+    so that departures are written only when they change.
+
+    If "adaptive" is set (disabled by default), stations are requested
+    according to their scheduled passages (see AdaptivePollingScheduler),
+    with schedule reloaded each service day. This applies when no station
+    filter is given.
+
+    Instead of cycles, the service can also request stations just before
+    their scheduled passages (see run_passage_polling).
+
+    If "archive" is set (disabled by default), parsed departures are also
+    appended to the local RealtimeArchive, whose partitions of a day are
+    compacted once the service day is over, and whose old days are removed.
+    """
+
+    def __init__(self, max_per_minute=__API_RATE_LIMIT__["max_per_minute"],
+                 adaptive=__ADAPTIVE_POLLING__["enabled"], archive=__REALTIME_ARCHIVE__["enabled"],
+                 **client_kwargs):
+        self.max_per_minute = max_per_minute
+        self.adaptive = adaptive
+        self.scheduler = None
+        self.archive = RealtimeArchive() if archive else None
+        self._archive_day = None
+        self.client = ApiClient(
+            max_per_minute=max_per_minute, persistent=True, **client_kwargs)
+        self.writer = DynamoBatchWriter(
+            RealTimeDeparture,
+            write_capacity=__DYNAMO_REALTIME__["provisioned_throughput"]["write"]
+        )
+        self.skip_cache = WriteSkipCache()
+        self.poller = None
+        # Day and time (monotonic) of last failed schedule load of poller
+        self._poller_failure = None
+        self.counters = Counter()
+        self.cycles = 0
+
+    def run_cycle(self, station_filter=False, dynamo_unique=True, pipelined=True):
+        """ Same as operate_one_cycle, with service's persistent client.
+        """
+        self.skip_cache.evict()
+        self._maintain_archive()
+        scheduler = None
+        if self.adaptive and not station_filter:
+            scheduler = self._get_scheduler()
+        operate_one_cycle(
+            station_filter=station_filter,
+            dynamo_unique=dynamo_unique,
+            max_per_minute=self.max_per_minute,
+            client=self.client,
+            pipelined=pipelined,
+            writer=self.writer,
+            skip_cache=self.skip_cache,
+            scheduler=scheduler,
+            archive=self.archive
+        )
+        self.skip_cache.save()
+        self.cycles += 1
+
+    def _maintain_archive(self):
+        """
+        Compacts archive of previous service day once it is over, and removes
+        days older than archive's "keep_days".
+        """
+        if self.archive is None:
+            return
+        day, _ = service_day_and_seconds(get_paris_local_datetime_now())
+        if self._archive_day != day:
+            if self._archive_day is not None:
+                try:
+                    self.archive.compact(self._archive_day)
+                except Exception as e:
+                    logger.error("Cannot compact archive of day %s: %s",
+                                 self._archive_day, e)
+            try:
+                self.archive.prune(day)
+            except Exception as e:
+                logger.error("Cannot remove old days of archive: %s", e)
+        self._archive_day = day
+
+    def _get_scheduler(self):
+        """
+        Returns scheduler, with schedule of current service day. If schedule
+        cannot be loaded, all stations are requested (and loading is tried
+        again at next cycle).
+        """
+        if self.scheduler is None:
+            self.scheduler = AdaptivePollingScheduler(
+                StationProvider().get_stations_per_line(),
+                max_per_minute=self.max_per_minute
             )
+        day, _ = service_day_and_seconds(get_paris_local_datetime_now())
+        schedule = self.scheduler.schedule
+        if schedule is None or schedule.day != day:
+            self.scheduler.set_schedule(self._load_schedule(day))
+        return self.scheduler
+
+    def _load_schedule(self, day):
+        """
+        Returns schedule of given day, None if it cannot be loaded.
+        """
+        try:
+            schedule = StationSchedule.from_db(day)
+        except Exception as e:
+            logger.warning("Cannot load schedule of day %s: %s", day, e)
+            return None
+        if not len(schedule):
+            logger.warning("Empty schedule for day %s.", day)
+            return None
+        return schedule
+
+    def _get_poller(self, day, now_seconds,
+                    retry_seconds=__PASSAGE_POLLING__["schedule_retry_seconds"]):
+        """
+        Returns passage poller of given service day (built when day changes),
+        None if schedule cannot be loaded. After a failed load, loading is
+        tried again after "retry_seconds" only.
+        """
+        if self.poller is None or self.poller.schedule.day != day:
+            if self._poller_failure is not None:
+                failed_day, failed_at = self._poller_failure
+                if failed_day == day and time.monotonic() - failed_at < retry_seconds:
+                    return None
+            schedule = self._load_schedule(day)
+            if schedule is None:
+                self._poller_failure = (day, time.monotonic())
+                return None
+            self._poller_failure = None
+            if self.poller is not None:
+                self._log_polling()
+            self.poller = PassagePoller(
+                schedule, StationProvider().get_stations_per_line())
+            self.poller.start(now_seconds)
+        return self.poller
+
+    def _log_polling(self):
+        logger.info(
+            "Passage polling: %d requests for %d scheduled passages (%.2f "
+            "requests per passage), %d saved departures",
+            self.poller.counters["polls"], self.poller.counters["passages"],
+            self.poller.polls_per_passage(), self.counters["saved_dynamo"]
+        )
+
+    def run_passage_polling(self, duration_seconds=None,
+                            tick_seconds=__PASSAGE_POLLING__["tick_seconds"]):
+        """
+        Extraction mode without fixed cycles: stations are kept in a heap
+        ordered by their next useful poll time (just before their next
+        scheduled passage, see PassagePoller). Every "tick_seconds", due
+        stations are requested as the quota permits, parsed and saved.
+
+        :param duration_seconds: stops after this duration, if None runs
+        until interrupted.
+        :type duration_seconds: int OR None
 
-        if time_passed < 60 and i != 1:
-            # doesn't wait on last cycle (0,1 -> last cycle is 1)
-            time.sleep(60 - time_passed)
+        :param tick_seconds: delay between two looks at the heap.
+        :type tick_seconds: int
+        """
+        max_per_tick = max(1, int(self.max_per_minute * tick_seconds / 60))
+        begin = time.monotonic()
+        ticks = 0
+        while duration_seconds is None or time.monotonic() - begin < duration_seconds:
+            tick_begin = time.monotonic()
+            day, now_seconds = service_day_and_seconds(
+                get_paris_local_datetime_now())
+            poller = self._get_poller(day, now_seconds)
+
+            stations = []
+            if poller is not None:
+                stations = poller.pop_due(now_seconds, max_count=max_per_tick)
+            if stations:
+                extractor = ApiExtractor(
+                    stations, max_per_minute=self.max_per_minute,
+                    client=self.client, streaming=True, writer=self.writer,
+                    skip_cache=self.skip_cache, archive=self.archive)
+                extractor.request_and_save_pipelined()
+                if self.archive is not None:
+                    try:
+                        extractor.save_in_archive()
+                    except Exception as e:
+                        logger.error("Cannot archive departures: %s", e)
+                self.counters.update(extractor.counters)
+
+            ticks += 1
+            # Every 10 minutes
+            if poller is not None and ticks % max(1, int(600 / tick_seconds)) == 0:
+                self._maintain_archive()
+                self.skip_cache.evict()
+                self.skip_cache.save()
+                self._log_polling()
+            time.sleep(max(0, tick_seconds - (time.monotonic() - tick_begin)))
+
+        if self.poller is not None:
+            self._log_polling()
+        self.skip_cache.save()
+
+    def close(self):
+        self.client.close()
+        self.writer.close()
+
+    def __repr__(self):
+        return "<ExtractionService(max_per_minute='%s', cycles='%s')>"\
+            % (self.max_per_minute, self.cycles)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def operate_passage_polling(duration_seconds=None, max_per_minute=__API_RATE_LIMIT__["max_per_minute"]):
+    """
+    Runs passage polling extraction mode (see
+    ExtractionService.run_passage_polling) during "duration_seconds"
+    seconds (until interrupted if None).
+    """
+    service = ExtractionService(max_per_minute=max_per_minute)
+    try:
+        service.run_passage_polling(duration_seconds=duration_seconds)
+    finally:
+        service.close()
 
 
 def operate_multiple_cycles(
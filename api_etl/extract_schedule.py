@@ -12,16 +12,11 @@ import pandas as pd
 
 from api_etl.settings import __GTFS_FOLDER_PATH__, __GTFS_CSV_URL__, __DATA_PATH__
 from api_etl.utils_rdb import RdbProvider
-from api_etl.data_models import (
-    Agency,
-    Route,
-    Trip,
-    StopTime,
-    Stop,
-    Calendar,
-    CalendarDate,
-)
 from api_etl.utils_misc import get_paris_local_datetime_now, S3Bucket
+from api_etl.utils_rdb_migration import (
+    upgrade_schedule_schema, backfill_typed_columns
+)
+from api_etl.utils_rdb_bulk import GTFS_TABLES, GtfsBulkLoader
 from api_etl.settings import __S3_BUCKETS__
 
 logger = logging.getLogger(__name__)
@@ -121,7 +116,8 @@ class ScheduleExtractor:
 
         sb.send_folder(
             folder_local_path=self.gtfs_folder,
-            folder_remote_path=day
+            folder_remote_path=day,
+            sync=True
         )
 
 
@@ -138,39 +134,16 @@ class ScheduleExtractorRDB(ScheduleExtractor):
     def save_in_rdb(self, tables=None):
         assert self.files_present
 
-        to_save = [
-            ("agency.txt", Agency),
-            ("routes.txt", Route),
-            ("trips.txt", Trip),
-            ("stops.txt", Stop),
-            ("stop_times.txt", StopTime),
-            ("calendar.txt", Calendar),
-            ("calendar_dates.txt", CalendarDate)
-        ]
+        to_save = GTFS_TABLES
         if tables:
             assert isinstance(tables, list)
             to_save = [to_save[i] for i in tables]
 
-        for name, model in to_save:
-            df = pd.read_csv(path.join(self.gtfs_folder, name))
-            df = df.applymap(str)
-            dicts = df.to_dict(orient="records")
-            objects = list(map(lambda x: model(**x), dicts))
-            logger.info("Saving %s file in database, containing %s objects." % (
-                name, len(objects)))
-            session = self.rdb_provider.get_session()
-            try:
-                # Try to save bulks (initial load)
-                chunks = [objects[i:i + 100]
-                          for i in range(0, len(objects), 100)]
-                for chunk in chunks:
-                    logger.debug("Bulk of 100 items saved.")
-                    session.bulk_save_objects(chunk)
-                    session.commit()
-            except Exception:
-                # Or save items one after the other
-                session.rollback()
-                for obj in objects:
-                    session.merge(obj)
-                    session.commit()
-            session.close()
+        # Tables of earlier versions get typed columns and indexes
+        upgrade_schedule_schema(self.rdb_provider)
+
+        # Files streamed in staging tables, along with services active per
+        # day and trips extents computed from them, swapped in one transaction
+        GtfsBulkLoader(self.rdb_provider, self.gtfs_folder).load(to_save)
+
+        backfill_typed_columns(self.rdb_provider)
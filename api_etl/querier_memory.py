@@ -0,0 +1,632 @@
+"""
+Module used to query schedule data held in memory: an alternative backend
+for DBQuerier, with the same methods, loaded once per GTFS feed version
+(from GTFS files, or from relational database).
+"""
+
+from os import path, stat
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import manager_of_class
+from sqlalchemy.sql import func
+
+from api_etl.utils_misc import (
+    get_paris_local_datetime_now, special_times_to_seconds,
+    special_time_to_seconds
+)
+from api_etl.data_models import (
+    Agency, Route, Trip, StopTime, Stop, Calendar, ScheduleVersion
+)
+from api_etl.utils_rdb_bulk import GTFS_TABLES, read_gtfs_file
+from api_etl.utils_calendar import ServiceCalendar
+from api_etl.utils_trip_extents import TripExtents, TripIntervalIndex
+from api_etl.utils_rdb_migration import typed_stop_times_values
+from api_etl.settings import __GTFS_FOLDER_PATH__, __SCHEDULE_QUERIER__
+
+logger = logging.getLogger(__name__)
+
+
+# Interval indexes kept per timetable (days and lines)
+_INTERVAL_INDEXES_SIZE = 64
+
+
+def _model_columns(model):
+    return [column.key for column in model.__table__.columns]
+
+
+def _row_type(names):
+    """
+    Rows of several entities (or columns), like sqlalchemy results: they
+    have an "_asdict" method, and attributes named after entities.
+    """
+    return namedtuple("Row", names)
+
+
+class GtfsTimetable:
+    """ GTFS feed held in memory, as arrays indexed for DBQuerier lookups:
+
+    - stop_times are sorted by (trip, stop sequence): stop times of a trip
+    are a contiguous slice (trip offsets).
+    - a permutation sorts them by (stop, departure time): stop times of a
+    stop in a time range are found by binary search.
+    - first departure and last arrival of each trip are precomputed (see
+    TripExtents), with interval indexes per day and line to find trips
+    rolling at a time.
+    - services active per day are precomputed (see ServiceCalendar).
+
+    Values are strings, as in relational database (see
+    ScheduleExtractorRDB.save_in_rdb): query results are the same model
+    instances as those built by sqlalchemy.
+    """
+
+    def __init__(self, tables, version=None):
+        """
+        :param tables: dataframes (of str) per model class name
+        :type tables: dict
+        """
+        self.version = version
+        self.tables = tables
+        self._build_indexes()
+
+    @staticmethod
+    def _normalize(df, model):
+        # Same values as saved in relational database
+        df = df.astype(str)
+        for column in _model_columns(model):
+            if column not in df.columns:
+                df[column] = None
+        return df[_model_columns(model)].reset_index(drop=True)
+
+    @classmethod
+    def from_folder(cls, folder=__GTFS_FOLDER_PATH__):
+        """
+        Loads timetable from GTFS files.
+        """
+        tables = {}
+        for name, model in GTFS_TABLES:
+            df = read_gtfs_file(folder, name)
+            tables[model.__name__] = cls._normalize(df, model)
+        return cls(tables, version=cls.folder_version(folder))
+
+    @classmethod
+    def from_rdb(cls, provider=None):
+        """
+        Loads timetable from relational database.
+        """
+        if provider is None:
+            from api_etl.utils_rdb import rdb_provider as provider
+        # Read before tables: a load in between is seen at next check
+        version = cls.rdb_version(provider)
+        tables = {}
+        engine = provider.get_engine()
+        for _, model in GTFS_TABLES:
+            df = pd.read_sql_table(model.__tablename__, engine)
+            df = df.where(df.notnull(), None)
+            tables[model.__name__] = df.reindex(columns=_model_columns(model))\
+                .reset_index(drop=True)
+        return cls(tables, version=version)
+
+    @staticmethod
+    def folder_version(folder=__GTFS_FOLDER_PATH__):
+        """Version of GTFS files: their sizes and modification times."""
+        version = []
+        for name, _ in GTFS_TABLES:
+            try:
+                file_stat = stat(path.join(folder, name))
+            except OSError:
+                version.append((name, None))
+                continue
+            version.append((name, file_stat.st_size, file_stat.st_mtime))
+        return tuple(version)
+
+    @staticmethod
+    def rdb_version(provider=None):
+        """
+        Version of schedule in database: last version recorded by GTFS loads
+        (see ScheduleVersion). For databases loaded by earlier versions,
+        dates range of calendars.
+        """
+        if provider is None:
+            from api_etl.utils_rdb import rdb_provider as provider
+        session = provider.get_session()
+        try:
+            if inspect(provider.get_engine()).has_table(ScheduleVersion.__tablename__):
+                latest = session.query(ScheduleVersion.version)\
+                    .order_by(ScheduleVersion.loaded_at.desc()).first()
+                if latest is not None:
+                    return latest.version
+            return tuple(session.query(
+                func.min(Calendar.start_date), func.max(Calendar.end_date)).one())
+        finally:
+            session.close()
+
+    def _build_indexes(self):
+        agencies = self.tables["Agency"]
+        routes = self.tables["Route"]
+        trips = self.tables["Trip"]
+        stops = self.tables["Stop"]
+        calendars = self.tables["Calendar"]
+        calendar_dates = self.tables["CalendarDate"]
+
+        self._agency_index = {a: i for i, a in enumerate(agencies.agency_id)}
+        self._route_index = {r: i for i, r in enumerate(routes.route_id)}
+        self._trip_index = {t: i for i, t in enumerate(trips.trip_id)}
+        self._stop_index = {s: i for i, s in enumerate(stops.stop_id)}
+        self._service_index = {s: i for i, s in enumerate(calendars.service_id)}
+
+        # Routes
+        self.route_agency = np.array(
+            [self._agency_index.get(a, -1) for a in routes.agency_id], dtype=np.int32)
+        self.route_short_name = routes.route_short_name.values
+
+        # Trips
+        self.trip_route = np.array(
+            [self._route_index.get(r, -1) for r in trips.route_id], dtype=np.int32)
+        self.trip_service = np.array(
+            [self._service_index.get(s, -1) for s in trips.service_id], dtype=np.int32)
+        # Inner joins of DBQuerier: Trip -> Calendar, Route -> Agency
+        trip_agency = np.where(
+            self.trip_route >= 0, self.route_agency[self.trip_route], -1)
+        self.trip_joinable = (self.trip_service >= 0) & (trip_agency >= 0)
+
+        # Services active per day, in calendars order
+        self.calendar = ServiceCalendar(calendars, calendar_dates)
+
+        # Stop times sorted by (trip, sequence)
+        stop_times = self.tables["StopTime"]
+        st_trip = np.array(
+            [self._trip_index.get(t, -1) for t in stop_times.trip_id], dtype=np.int32)
+        st_sequence = pd.to_numeric(stop_times.stop_sequence, errors="coerce")\
+            .fillna(-1).astype(np.int32).values
+        order = np.lexsort((st_sequence, st_trip))
+        stop_times = stop_times.iloc[order].reset_index(drop=True)
+        self.tables["StopTime"] = stop_times
+        self.st_trip = st_trip[order]
+        self.st_sequence = st_sequence[order]
+        self.st_stop = np.array(
+            [self._stop_index.get(s, -1) for s in stop_times.stop_id], dtype=np.int32)
+        self.st_departure = special_times_to_seconds(stop_times.departure_time)\
+            .fillna(-1).astype(np.int32).values
+
+        # Typed columns, as computed in relational database
+        for column, values in typed_stop_times_values(stop_times).items():
+            stop_times[column] = values
+        self.st_joinable = (self.st_trip >= 0) & (self.st_stop >= 0)
+        self.st_joinable[self.st_joinable] &= self.trip_joinable[self.st_trip[self.st_joinable]]
+
+        # Trip slices
+        n_trips = len(trips)
+        self.trip_offsets = np.searchsorted(
+            self.st_trip, np.arange(n_trips + 1), side="left")
+
+        # Trip extents: -1 for trips without extent
+        self.extents = TripExtents(trips, routes, stop_times)
+        extents = self.extents.df.set_index("trip_id")\
+            .reindex(trips.trip_id.values)
+        self.trip_first_departure = extents.first_departure\
+            .fillna(-1).astype(np.int32).values
+        self.trip_last_arrival = extents.last_arrival\
+            .fillna(-1).astype(np.int32).values
+        self._interval_indexes = {}
+
+        # Stop times sorted by (stop, departure)
+        self.by_stop = np.lexsort((self.st_departure, self.st_stop)).astype(np.int32)
+        self.stop_offsets = np.searchsorted(
+            self.st_stop[self.by_stop], np.arange(len(stops) + 1), side="left")
+
+        logger.info("Timetable loaded: %d trips, %d stops, %d stop times.",
+                    n_trips, len(stops), len(stop_times))
+
+    # SERVICES
+    def active_services(self, day):
+        """
+        Returns boolean mask of services active on day ("%Y%m%d"), see
+        utils_calendar.ServiceCalendar.
+        """
+        return self.calendar.active_mask(day)
+
+    # TRIPS
+    def interval_index(self, day, route_short_name=None):
+        """
+        Returns interval index of trips (by row) scheduled on day, optionally
+        only on a line. Indexes are kept for the last days and lines queried.
+
+        :rtype: TripIntervalIndex
+        """
+        key = (day, route_short_name)
+        index = self._interval_indexes.get(key)
+        if index is None:
+            mask = self.trip_joinable & (self.trip_first_departure >= 0)
+            mask &= self.active_services(day)[self.trip_service]
+            if route_short_name:
+                mask &= self.route_short_name[self.trip_route] == route_short_name
+            rows = np.flatnonzero(mask)
+            index = TripIntervalIndex(
+                rows, self.trip_first_departure[rows], self.trip_last_arrival[rows])
+            if len(self._interval_indexes) >= _INTERVAL_INDEXES_SIZE:
+                self._interval_indexes.clear()
+            self._interval_indexes[key] = index
+        return index
+
+    # MODEL INSTANCES
+    def instances(self, model, rows):
+        """
+        Builds model instances (as sqlalchemy would) for given rows of
+        model's table. Instances are not attached to any session.
+
+        :param rows: row numbers
+        :type rows: iterable of int
+        """
+        table = self.tables[model.__name__]
+        columns = _model_columns(model)
+        values = [table[column].values for column in columns]
+        manager = manager_of_class(model)
+        instances = []
+        for row in rows:
+            instance = manager.new_instance()
+            instance.__dict__.update(zip(columns, (v[row] for v in values)))
+            instances.append(instance)
+        return instances
+
+    def __repr__(self):
+        return "<GtfsTimetable(trips='%s', stop_times='%s')>"\
+            % (len(self.trip_route), len(self.st_trip))
+
+    def __str__(self):
+        return self.__repr__()
+
+
+# Timetables loaded per source, checked against source version at most every
+# "version_check_interval" seconds.
+_timetables = {}
+_timetables_lock = threading.Lock()
+
+
+def get_timetable(source=__SCHEDULE_QUERIER__["source"], folder=__GTFS_FOLDER_PATH__,
+                  check_interval=__SCHEDULE_QUERIER__["version_check_interval"]):
+    """
+    Returns timetable of given source ("folder" or "rdb"), loaded once per
+    feed version.
+
+    :rtype: GtfsTimetable
+    """
+    assert source in ("folder", "rdb")
+    key = (source, folder if source == "folder" else None)
+    with _timetables_lock:
+        timetable, checked_at = _timetables.get(key, (None, None))
+        if timetable is not None and time.monotonic() - checked_at < check_interval:
+            return timetable
+
+        if source == "folder":
+            version = GtfsTimetable.folder_version(folder)
+        else:
+            version = GtfsTimetable.rdb_version()
+        if timetable is None or timetable.version != version:
+            logger.info("Loading timetable from %s.", source)
+            if source == "folder":
+                timetable = GtfsTimetable.from_folder(folder)
+            else:
+                timetable = GtfsTimetable.from_rdb()
+        _timetables[key] = (timetable, time.monotonic())
+        return timetable
+
+
+class MemoryQuerier:
+    """ Same methods as DBQuerier, answered from an in-memory timetable
+    (see GtfsTimetable): lookups by trip or by stop use precomputed indexes,
+    other filters are vectorized over arrays.
+
+    Results are sqlalchemy-like: model instances, or rows of several
+    entities with attributes named after models.
+    """
+
+    def __init__(self, scheduled_day=None, timetable=None):
+        self.timetable = timetable or get_timetable()
+        if not scheduled_day:
+            scheduled_day = get_paris_local_datetime_now().strftime("%Y%m%d")
+        else:
+            # Will raise an error if wrong format
+            pd.to_datetime(scheduled_day, format="%Y%m%d")
+        self.scheduled_day = scheduled_day
+
+    def set_date(self, scheduled_day):
+        """Sets date that will define default date for requests.
+        :param scheduled_day:
+        """
+        # Will raise error if wrong format
+        pd.to_datetime(scheduled_day, format="%Y%m%d")
+        self.scheduled_day = scheduled_day
+
+    @staticmethod
+    def _limit(limit):
+        try:
+            return int(limit)
+        except (ValueError, TypeError):
+            return False
+
+    def _day(self, on_day):
+        if on_day is True:
+            on_day = self.scheduled_day
+        if on_day:
+            # Will raise error if wrong format
+            pd.to_datetime(on_day, format="%Y%m%d")
+        return on_day
+
+    def _results(self, entities):
+        """
+        Builds results for entities: list of (model, row numbers) or
+        (column name, values). Single entities give a list of instances,
+        several entities give rows.
+        """
+        columns = []
+        for entity, rows in entities:
+            if isinstance(entity, str):
+                columns.append(list(rows))
+                continue
+            # Same instance for same row, as in a sqlalchemy session
+            distinct_rows, inverse = np.unique(np.asarray(rows, dtype=np.int64), return_inverse=True)
+            instances = self.timetable.instances(entity, distinct_rows)
+            columns.append([instances[i] for i in inverse])
+
+        names = [e if isinstance(e, str) else e.__name__ for e, _ in entities]
+        if len(names) == 1 and not isinstance(entities[0][0], str):
+            return columns[0]
+        Row = _row_type(names)
+        return [Row(*values) for values in zip(*columns)]
+
+    def routes(self, distinct_short_name=True, level=0, limit=None):
+        """ See DBQuerier.routes.
+        """
+        tt = self.timetable
+        routes = tt.tables["Route"]
+        rows = [i for i in range(len(routes)) if tt.route_agency[i] >= 0]
+        if distinct_short_name:
+            seen = set()
+            distinct = []
+            for i in rows:
+                if tt.route_short_name[i] not in seen:
+                    seen.add(tt.route_short_name[i])
+                    distinct.append(i)
+            rows = distinct
+        limit = self._limit(limit)
+        if limit:
+            rows = rows[:limit]
+
+        if level == 1:
+            return self._results([(Route, rows)])
+        if level == 2:
+            return self._results(
+                [(Route, rows), (Agency, tt.route_agency[rows])])
+        return self._results([("route_id", routes.route_id.values[rows])])
+
+    def stations(self, stop_id=None, on_route_short_name=None, level=0, limit=None):
+        """ See DBQuerier.stations.
+        """
+        tt = self.timetable
+        stops = tt.tables["Stop"]
+        # Writable copy: values of pandas objects may be read-only
+        mask = np.array(stops.stop_id.str.startswith("StopPoint"), dtype=bool)
+        if stop_id:
+            mask &= (stops.stop_id == stop_id).values
+        if on_route_short_name:
+            served = np.zeros(len(stops), dtype=bool)
+            trip_mask = tt.route_short_name[tt.trip_route] == str(on_route_short_name)
+            trip_mask &= tt.trip_route >= 0
+            st_mask = (tt.st_trip >= 0) & (tt.st_stop >= 0)
+            st_mask[st_mask] &= trip_mask[tt.st_trip[st_mask]]
+            served[tt.st_stop[st_mask]] = True
+            mask &= served
+        rows = np.flatnonzero(mask)
+        rows = rows[np.argsort(stops.stop_id.values[rows], kind="stable")]
+        limit = self._limit(limit)
+        if limit:
+            rows = rows[:limit]
+
+        if level == 0:
+            return self._results([("stop_id", stops.stop_id.values[rows])])
+        return self._results([(Stop, rows)])
+
+    def services(self, on_day=None, level=0, limit=None):
+        """ See DBQuerier.services.
+        """
+        on_day = self._day(on_day)
+        tt = self.timetable
+        calendars = tt.tables["Calendar"]
+        if on_day:
+            rows = np.flatnonzero(tt.active_services(on_day))
+        else:
+            rows = np.arange(len(calendars))
+        limit = self._limit(limit)
+        if limit:
+            rows = rows[:limit]
+
+        if level == 0:
+            return self._results([("service_id", calendars.service_id.values[rows])])
+        return self._results([(Calendar, rows)])
+
+    def _trips_mask(self, on_day=None, has_begun_at_time=None,
+                    not_yet_arrived_at_time=None, trip_id=None, on_route_short_name=None):
+        tt = self.timetable
+        mask = tt.trip_joinable.copy()
+        if on_route_short_name:
+            mask &= tt.route_short_name[tt.trip_route] == on_route_short_name
+        if trip_id:
+            trip_mask = np.zeros(len(mask), dtype=bool)
+            if trip_id in tt._trip_index:
+                trip_mask[tt._trip_index[trip_id]] = True
+            mask &= trip_mask
+        if on_day:
+            active = tt.active_services(on_day)
+            mask &= active[tt.trip_service]
+        if has_begun_at_time:
+            seconds = special_time_to_seconds(has_begun_at_time)
+            mask &= (tt.trip_first_departure >= 0) & (tt.trip_first_departure <= seconds)
+        if not_yet_arrived_at_time:
+            seconds = special_time_to_seconds(not_yet_arrived_at_time)
+            mask &= (tt.trip_last_arrival >= 0) & (tt.trip_last_arrival >= seconds)
+        return mask
+
+    def trips(
+        self, on_day=None, active_at_time=None, has_begun_at_time=None,
+        not_yet_arrived_at_time=None, trip_id=None, on_route_short_name=None, level=0, limit=None, count=None
+    ):
+        """ See DBQuerier.trips.
+        """
+        on_day = self._day(on_day)
+        if active_at_time is True:
+            active_at_time = get_paris_local_datetime_now().strftime("%H:%M:%S")
+        has_begun_at_time = has_begun_at_time or active_at_time
+        not_yet_arrived_at_time = not_yet_arrived_at_time or active_at_time
+
+        tt = self.timetable
+        limit = self._limit(limit)
+        if on_day and has_begun_at_time and has_begun_at_time == not_yet_arrived_at_time:
+            # Trips rolling at time: from interval index of day (and line)
+            seconds = special_time_to_seconds(has_begun_at_time)
+            index = tt.interval_index(on_day, on_route_short_name)
+            if count and not trip_id and not limit:
+                return index.count_at(seconds)
+            rows = np.sort(index.trips_at(seconds))
+            if trip_id:
+                rows = rows[tt.tables["Trip"].trip_id.values[rows] == trip_id]
+        else:
+            rows = np.flatnonzero(self._trips_mask(
+                on_day=on_day, has_begun_at_time=has_begun_at_time,
+                not_yet_arrived_at_time=not_yet_arrived_at_time, trip_id=trip_id,
+                on_route_short_name=on_route_short_name
+            ))
+        if limit:
+            rows = rows[:limit]
+        if count:
+            return len(rows)
+
+        trips = tt.tables["Trip"]
+        route_rows = tt.trip_route[rows]
+        entities = {
+            0: [("trip_id", trips.trip_id.values[rows])],
+            1: [(Trip, rows)],
+            2: [(Trip, rows), (Calendar, tt.trip_service[rows])],
+            3: [(Trip, rows), (Calendar, tt.trip_service[rows]), (Route, route_rows)],
+            4: [(Trip, rows), (Calendar, tt.trip_service[rows]), (Route, route_rows),
+                (Agency, tt.route_agency[route_rows])],
+        }.get(level, [(Trip, rows)])
+        return self._results(entities)
+
+    def stoptimes(
+        self, on_day=None, trip_id_filter=None, uic_filter=None, stop_id=None,
+        trip_active_at_time=None, on_route_short_name=None, level=0, limit=None,
+        departure_time_below=None, departure_time_above=None, count=None
+    ):
+        """ See DBQuerier.stoptimes.
+        """
+        on_day = self._day(on_day)
+        if uic_filter:
+            uic_filter = str(uic_filter)
+            if len(uic_filter) == 8:
+                uic_filter = uic_filter[:-1]
+            elif len(uic_filter) != 7:
+                raise ValueError("uic_filter length must be 7 or 8")
+        below = special_time_to_seconds(departure_time_below) if departure_time_below else None
+        above = special_time_to_seconds(departure_time_above) if departure_time_above else None
+
+        tt = self.timetable
+        stops = tt.tables["Stop"]
+
+        # Candidate stop times from indexes
+        if stop_id or uic_filter:
+            if uic_filter:
+                stop_rows = [
+                    i for i, s in enumerate(stops.stop_id.values)
+                    if s.endswith(uic_filter) and (not stop_id or s == stop_id)
+                ]
+            else:
+                stop_rows = [tt._stop_index[stop_id]] if stop_id in tt._stop_index else []
+            candidates = []
+            for stop_row in stop_rows:
+                begin, end = tt.stop_offsets[stop_row], tt.stop_offsets[stop_row + 1]
+                departures = tt.st_departure[tt.by_stop[begin:end]]
+                if above is not None:
+                    begin += np.searchsorted(departures, above, side="left")
+                    departures = tt.st_departure[tt.by_stop[begin:end]]
+                if below is not None:
+                    end = begin + np.searchsorted(departures, below, side="right")
+                candidates.append(tt.by_stop[begin:end])
+            rows = np.concatenate(candidates) if candidates else np.array([], dtype=np.int32)
+        elif trip_id_filter:
+            if not isinstance(trip_id_filter, list):
+                trip_id_filter = [trip_id_filter]
+            rows = np.concatenate([
+                np.arange(tt.trip_offsets[t], tt.trip_offsets[t + 1])
+                for t in (tt._trip_index[trip] for trip in trip_id_filter if trip in tt._trip_index)
+            ] or [np.array([], dtype=np.int64)])
+        else:
+            rows = np.arange(len(tt.st_trip))
+
+        mask = tt.st_joinable[rows]
+        if trip_id_filter:
+            if not isinstance(trip_id_filter, list):
+                trip_id_filter = [trip_id_filter]
+            trip_mask = np.zeros(len(tt.trip_route), dtype=bool)
+            trip_mask[[tt._trip_index[t] for t in trip_id_filter if t in tt._trip_index]] = True
+            mask &= trip_mask[tt.st_trip[rows]]
+        if on_route_short_name or on_day or trip_active_at_time:
+            if trip_active_at_time is True:
+                trip_active_at_time = get_paris_local_datetime_now().strftime("%H:%M:%S")
+            trip_mask = self._trips_mask(
+                on_day=on_day, on_route_short_name=on_route_short_name,
+                has_begun_at_time=trip_active_at_time,
+                not_yet_arrived_at_time=trip_active_at_time
+            )
+            mask &= trip_mask[tt.st_trip[rows]]
+        if below is not None:
+            mask &= tt.st_departure[rows] <= below
+        if above is not None:
+            mask &= tt.st_departure[rows] >= above
+        rows = rows[mask]
+
+        limit = self._limit(limit)
+        if limit:
+            rows = rows[:limit]
+        if count:
+            return len(rows)
+
+        stop_times = tt.tables["StopTime"]
+        trip_rows = tt.st_trip[rows]
+        stop_rows = tt.st_stop[rows]
+        entities = {
+            0: [("stop_id", stop_times.stop_id.values[rows]),
+                ("trip_id", stop_times.trip_id.values[rows])],
+            1: [(StopTime, rows)],
+            2: [(StopTime, rows), (Trip, trip_rows)],
+            3: [(StopTime, rows), (Trip, trip_rows), (Stop, stop_rows)],
+            4: [(StopTime, rows), (Trip, trip_rows), (Stop, stop_rows),
+                (Route, tt.trip_route[trip_rows]), (Calendar, tt.trip_service[trip_rows])],
+        }.get(level, [("stop_id", stop_times.stop_id.values[rows])])
+        return self._results(entities)
+
+    def departure_times(self, on_day=None):
+        """ See DBQuerier.departure_times.
+        """
+        on_day = on_day or self.scheduled_day
+        pd.to_datetime(on_day, format="%Y%m%d")
+        tt = self.timetable
+        active = tt.active_services(on_day)
+        mask = (tt.st_trip >= 0)
+        mask[mask] &= (tt.trip_service[tt.st_trip[mask]] >= 0)
+        mask[mask] &= active[tt.trip_service[tt.st_trip[mask]]]
+        stop_times = tt.tables["StopTime"]
+        return list(zip(
+            stop_times.stop_id.values[mask], stop_times.departure_time.values[mask]))
+
+    def __repr__(self):
+        return "<MemoryQuerier(scheduled_day='%s', timetable='%s')>"\
+            % (self.scheduled_day, self.timetable)
+
+    def __str__(self):
+        return self.__repr__()
@@ -19,7 +19,9 @@ import collections
 import pandas as pd
 from pynamodb.exceptions import DoesNotExist
 
-from api_etl.utils_misc import get_paris_local_datetime_now, DateConverter
+from api_etl.utils_misc import (
+    get_paris_local_datetime_now, special_datetime_to_seconds
+)
 from api_etl.data_models import RealTimeDeparture, StopTime
 
 logger = logging.getLogger(__name__)
@@ -84,9 +86,10 @@ class StopTimeState:
         rtdt = self._RealTime.expected_passage_time
         rtdd = self._RealTime.expected_passage_day
         # Schedule and realtime are both in special format
-        # allowing hour to go up to 27
-        delay = DateConverter(special_date=rtdd, special_time=rtdt)\
-            .compute_delay_from(special_date=sdd, special_time=sdt)
+        # allowing hour to go up to 27: compared in seconds since
+        # scheduled day midnight
+        delay = special_datetime_to_seconds(rtdd, rtdt, service_date=sdd)\
+            - special_datetime_to_seconds(sdd, sdt)
         self.delay = delay
 
 
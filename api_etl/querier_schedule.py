@@ -4,16 +4,40 @@ Module used to query schedule data contained in relational databases.
 
 import logging
 from datetime import datetime
+from sqlalchemy import inspect
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import aliased, defer
 from sqlalchemy.sql import func
 
-from api_etl.utils_misc import get_paris_local_datetime_now
+from api_etl.utils_misc import get_paris_local_datetime_now, special_time_to_seconds
 from api_etl.utils_rdb import rdb_provider
+from api_etl.utils_calendar import WEEKDAYS
+from api_etl.utils_rdb_migration import TYPED_COLUMNS, typed_expression
+from api_etl.settings import __SCHEDULE_QUERIER__
 from api_etl.data_models import (
-    Calendar, CalendarDate, Trip, StopTime, Stop, Agency, Route
+    Calendar, CalendarDate, ServiceDay, TripExtent, Trip, StopTime, Stop,
+    Agency, Route
 )
 
 logger = logging.getLogger(__name__)
 
+
+def schedule_querier(scheduled_day=None, backend=__SCHEDULE_QUERIER__["backend"]):
+    """
+    Returns querier of configured backend: DBQuerier ("rdb"), or
+    MemoryQuerier ("memory"), with same methods.
+
+    :param scheduled_day: default day of requests ("%Y%m%d"), default today
+    :param backend: "rdb" or "memory"
+    """
+    if backend == "memory":
+        from api_etl.querier_memory import MemoryQuerier
+        return MemoryQuerier(scheduled_day=scheduled_day)
+    if backend != "rdb":
+        raise ValueError("Unknown schedule querier backend %s" % backend)
+    return DBQuerier(scheduled_day=scheduled_day)
+
+
 class DBQuerier:
     """ This class allows you to easily query information available in
     databases: both RDB containing schedules, and Dynamo DB containing
@@ -33,6 +57,11 @@ class DBQuerier:
             # Will raise an error if wrong format
             datetime.strptime(scheduled_day, "%Y%m%d")
         self.scheduled_day = scheduled_day
+        # Availability of precomputed tables, per model
+        self._precomputed = {}
+        # Typed columns of stop times: None until checked, then whether
+        # they exist, and whether they were computed
+        self._typed_columns = None
 
     def set_date(self, scheduled_day):
         """Sets date that will define default date for requests.
@@ -42,6 +71,75 @@ class DBQuerier:
         datetime.strptime(scheduled_day, "%Y%m%d")
         self.scheduled_day = scheduled_day
 
+    def _precomputed_available(self, session, model):
+        """ Whether a precomputed table (ServiceDay, see
+        utils_calendar.ServiceCalendar, or TripExtent, see
+        utils_trip_extents.TripExtents) was computed.
+        """
+        if model not in self._precomputed:
+            try:
+                self._precomputed[model] = session.query(model).first() is not None
+            except DBAPIError:
+                # Table not created
+                session.rollback()
+                self._precomputed[model] = False
+        return self._precomputed[model]
+
+    def _typed_columns_state(self, session):
+        """ Whether typed columns of stop times (see
+        utils_rdb_migration.TYPED_COLUMNS) exist, and whether they were
+        computed. Databases created by earlier versions are queried on GTFS
+        string columns until they are migrated (see
+        utils_rdb_migration.migrate_schedule_schema).
+
+        :rtype: tuple (bool, bool)
+        """
+        if self._typed_columns is None:
+            columns = {
+                column["name"] for column in
+                inspect(session.get_bind()).get_columns(StopTime.__tablename__)
+            }
+            exist = all(typed.key in columns for typed, _, _ in TYPED_COLUMNS)
+            computed = exist and session.query(StopTime.departure_seconds)\
+                .filter(StopTime.departure_seconds.isnot(None)).first() is not None
+            if not computed:
+                logger.warning("Typed columns of stop times are not available: "
+                               "they are computed from GTFS string columns.")
+            self._typed_columns = (exist, computed)
+        return self._typed_columns
+
+    def _typed(self, session, typed_column, stop_time=StopTime):
+        """ Typed column of stop times (or of an alias of StopTime), or, if
+        it is not available, its value computed from GTFS string column.
+        """
+        if self._typed_columns_state(session)[1]:
+            return getattr(stop_time, typed_column.key)
+        for typed, column, kind in TYPED_COLUMNS:
+            if typed.key == typed_column.key:
+                return typed_expression(getattr(stop_time, column.key), kind)
+        raise ValueError("%s is not a typed column" % typed_column.key)
+
+    def _active_service_ids(self, session, on_day):
+        """ Ids of services active on day: a ServiceDay subquery if
+        available, else computed from calendars (see services method).
+        """
+        if self._precomputed_available(session, ServiceDay):
+            return session.query(ServiceDay.service_id)\
+                .filter(ServiceDay.date == on_day)
+        return [service[0] for service in self.services(on_day=on_day)]
+
+    def _trip_sequence_bound(self, session, aggregate):
+        """ Subquery of first (func.min) or last (func.max) stop sequence of
+        queried trip.
+        """
+        trip_stop_time = aliased(StopTime)
+        return session\
+            .query(aggregate(self._typed(
+                session, StopTime.stop_sequence_number, trip_stop_time)))\
+            .filter(trip_stop_time.trip_id == Trip.trip_id)\
+            .correlate(Trip)\
+            .as_scalar()
+
     def routes(self, distinct_short_name=True, level=0, limit=None):
         """ Multiple options available.
 
@@ -154,7 +252,9 @@ class DBQuerier:
         Return services.
 
         Filter:
-        - of day
+        - of day: services whose date range contains day and running on its
+        weekday, plus added exceptions, minus removed exceptions. Read from
+        ServiceDay table if it was computed.
 
         Entity levels:
         - 0: only ids
@@ -197,10 +297,21 @@ class DBQuerier:
             session.close()
             return end_result
 
-        # Query if day filter
+        # Query if day filter: precomputed services of day if available
+        if self._precomputed_available(session, ServiceDay):
+            results = results.filter(
+                Calendar.service_id.in_(self._active_service_ids(session, on_day)))
+            if limit:
+                results = results.limit(limit)
+            end_result = results.all()
+            session.close()
+            return end_result
+
+        weekday = WEEKDAYS[datetime.strptime(on_day, "%Y%m%d").weekday()]
         serv_regular = results\
             .filter(Calendar.start_date <= on_day)\
-            .filter(Calendar.end_date >= on_day)
+            .filter(Calendar.end_date >= on_day)\
+            .filter(getattr(Calendar, weekday) == "1")
 
         # Get service exceptions
         # 1 = service (instead of usually not)
@@ -234,8 +345,9 @@ class DBQuerier:
 
         Possible filters:
         - active_at_time: "hh:mm:ss" (if set only to boolean True, time "now")
-        - has_begun_at_time
-        - not_yet_arrived_at_time
+        - has_begun_at_time: departure from first stop
+        - not_yet_arrived_at_time: arrival at last stop
+        Read from TripExtent table if it was computed.
 
         Entity levels:
         - 0: only ids
@@ -314,7 +426,22 @@ class DBQuerier:
 
         if on_day:
             results = results\
-                .filter(Trip.service_id.in_(self.services(on_day=on_day)))
+                .filter(Trip.service_id.in_(
+                    self._active_service_ids(session, on_day)))
+
+        if (has_begun_at_time or not_yet_arrived_at_time) and \
+                self._precomputed_available(session, TripExtent):
+            # Precomputed first departure and last arrival of trips
+            results = results.filter(TripExtent.trip_id == Trip.trip_id)
+            if has_begun_at_time:
+                results = results.filter(
+                    TripExtent.first_departure
+                    <= special_time_to_seconds(has_begun_at_time))
+            if not_yet_arrived_at_time:
+                results = results.filter(
+                    TripExtent.last_arrival
+                    >= special_time_to_seconds(not_yet_arrived_at_time))
+            has_begun_at_time = not_yet_arrived_at_time = None
 
         if has_begun_at_time:
             # Begin constraint: "hh:mm:ss" up to 26 hours
@@ -322,22 +449,28 @@ class DBQuerier:
             # => first stop departure_time must be < time
             begin_results = base_results\
                 .filter(StopTime.trip_id == Trip.trip_id)\
-                .filter(StopTime.stop_sequence == "0")\
-                .filter(StopTime.departure_time <= has_begun_at_time)\
+                .filter(
+                    self._typed(session, StopTime.stop_sequence_number)
+                    == self._trip_sequence_bound(session, func.min)
+                )\
+                .filter(
+                    self._typed(session, StopTime.departure_seconds)
+                    <= special_time_to_seconds(has_begun_at_time))
 
-            results = base_results.intersect(begin_results)
+            results = results.intersect(begin_results)
 
         if not_yet_arrived_at_time:
             # End constraint: trips not arrived at time
-            # => last stop departure_time must be > time
+            # => last stop arrival_time must be > time
             end_results = base_results\
                 .filter(StopTime.trip_id == Trip.trip_id)\
                 .filter(
-                    StopTime.stop_sequence == session
-                    .query(func.max(StopTime.stop_sequence))
-                    .correlate(Trip)
+                    self._typed(session, StopTime.stop_sequence_number)
+                    == self._trip_sequence_bound(session, func.max)
                 )\
-                .filter(StopTime.departure_time >= not_yet_arrived_at_time)
+                .filter(
+                    self._typed(session, StopTime.arrival_seconds)
+                    >= special_time_to_seconds(not_yet_arrived_at_time))
 
             results = results.intersect(end_results)
 
@@ -418,11 +551,12 @@ class DBQuerier:
         except (ValueError, TypeError):
             limit = False
 
-        # Departure times
+        # Departure times: "hh:mm:ss" up to 27 hours, as seconds
+        # Will raise error if wrong format
         if departure_time_above:
-            datetime.strptime(departure_time_above, "%H:%M:%S")
+            departure_time_above = special_time_to_seconds(departure_time_above)
         if departure_time_below:
-            datetime.strptime(departure_time_below, "%H:%M:%S")
+            departure_time_below = special_time_to_seconds(departure_time_below)
 
         # QUERY
         session = self.provider.get_session()
@@ -436,22 +570,29 @@ class DBQuerier:
             .filter(Route.route_id == Trip.route_id)\
             .filter(Agency.agency_id == Route.agency_id)
 
+        if any(entity is StopTime for entity in entities)\
+                and not self._typed_columns_state(session)[0]:
+            # Typed columns missing in database: not loaded
+            results = results.options(*[
+                defer(typed, raiseload=True) for typed, _, _ in TYPED_COLUMNS])
+
         if on_route_short_name:
             results = results\
                 .filter(Route.route_short_name == on_route_short_name)
 
         if on_day:
             results = results\
-                .filter(Trip.service_id.in_(self.services(on_day=on_day)))
+                .filter(Trip.service_id.in_(
+                    self._active_service_ids(session, on_day)))
 
         if trip_active_at_time:
             results = results.filter(
-                Trip.trip_id.in_(
-                    self.trips(
+                Trip.trip_id.in_([
+                    trip[0] for trip in self.trips(
                         on_day=on_day,
                         active_at_time=trip_active_at_time
                     )
-                ))
+                ]))
 
         if trip_id_filter:
             # accepts list or single element
@@ -463,7 +604,7 @@ class DBQuerier:
 
         if uic_filter:
             results = results\
-                .filter(Stop.stop_id.like("%"))
+                .filter(Stop.stop_id.like("%" + uic_filter))
 
         if stop_id:
             results = results\
@@ -471,11 +612,13 @@ class DBQuerier:
 
         if departure_time_below:
             results = results\
-                .filter(StopTime.departure_time <= departure_time_below)
+                .filter(self._typed(session, StopTime.departure_seconds)
+                        <= departure_time_below)
 
         if departure_time_above:
             results = results\
-                .filter(StopTime.departure_time <= departure_time_above)
+                .filter(self._typed(session, StopTime.departure_seconds)
+                        >= departure_time_above)
 
         if limit:
             results = results.limit(limit)
@@ -488,3 +631,24 @@ class DBQuerier:
         end_result = results.all()
         session.close()
         return end_result
+
+    def departure_times(self, on_day=None):
+        """ Returns (stop_id, departure_time) of all stoptimes of trips
+        scheduled on given day (default to querier's day). Lighter than
+        "stoptimes" method: only two columns are loaded.
+
+        :param on_day: day in "%Y%m%d" format
+        :return: list of (stop_id, departure_time) tuples
+        """
+        on_day = on_day or self.scheduled_day
+        # Will raise error if wrong format
+        datetime.strptime(on_day, "%Y%m%d")
+
+        session = self.provider.get_session()
+        end_result = session\
+            .query(StopTime.stop_id, StopTime.departure_time)\
+            .filter(Trip.trip_id == StopTime.trip_id)\
+            .filter(Trip.service_id.in_(self._active_service_ids(session, on_day)))\
+            .all()
+        session.close()
+        return end_result
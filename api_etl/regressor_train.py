@@ -3,9 +3,9 @@ This module contains functions and classes to train regressors and save them int
 """
 
 import logging
-from os import path
-from glob import glob
 import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 import codecs
 
@@ -21,8 +21,10 @@ from sklearn.pipeline import Pipeline
 
 from api_etl.settings import (
     __S3_BUCKETS__, __TRAINING_FEATURE_NAMES__, __ACCEPTED_LINES__,
-    __TRAINING_SET_FOLDER_PATH__, __TRAINING_SET_FOLDER_NAME__, __DATA_PATH__)
+    __TRAINING_SET_FOLDER_PATH__, __TRAINING_SET_FOLDER_NAME__, __DATA_PATH__,
+    __MULTI_LINE_TRAINING__)
 from api_etl.utils_misc import S3Bucket
+from api_etl.utils_training_set import TrainingSetStore, TrainingArrayCache
 from api_etl.utils_rdb import rdb_provider
 from api_etl.data_models import Predictor
 
@@ -35,6 +37,64 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 
+def download_training_sets(tempo):
+    """
+    Downloads training sets of given tempo from S3 in data folder.
+    """
+    # Load relevant bucket
+    bucket_provider = S3Bucket(__S3_BUCKETS__["training-sets"], create_if_absent=True)
+
+    # Download files from S3
+    logger.info("Get training sets from folder %s, and download them in %s" %
+                (__TRAINING_SET_FOLDER_NAME__ % tempo, __TRAINING_SET_FOLDER_PATH__ % tempo))
+    # Only new or changed files are downloaded
+    bucket_provider.download_folder(
+        remote_prefix=__TRAINING_SET_FOLDER_NAME__ % tempo,
+        local_folder_root=__DATA_PATH__,
+        sync=True
+    )
+    return True
+
+
+# Line partitions of training set, inherited by forked training processes
+# (see MultiLineTrainer)
+_shared_partitions = {}
+
+
+def _train_line(line, features, start_date, end_date, filters, partition=None, cache=None):
+    """
+    Trains pipeline of a line, in a training process. If a TrainingArrayCache
+    is provided, only this line's arrays are memory-mapped; otherwise,
+    training set is taken from inherited partitions, unless provided.
+
+    :return: results, None if line has no training data
+    :rtype: dict
+    """
+    trainer = RegressorTrainer(line=line)
+    trainer.set_feature_cols(*features)
+    trainer.start_date = start_date
+    trainer.end_date = end_date
+    if cache is not None:
+        days = pd.date_range(start_date, end_date, freq="D")\
+            .map(lambda x: x.strftime("%Y%m%d")).tolist()
+        trainer._load_arrays_from_cache(
+            tempo=cache.store.tempo, days=days, cache=cache, **filters)
+        if not len(trainer.sel):
+            return None
+        trainer._split_train_test()
+    else:
+        dfm = partition if partition is not None else _shared_partitions[line]
+        trainer.use_training_set(dfm, **filters)
+    trainer.build_pipeline()
+    trainer.train_pipeline()
+    return {
+        "line": line,
+        "pipeline": trainer.pipeline,
+        "score_description": trainer.score_pipeline(),
+        "rows": len(trainer.sel),
+    }
+
+
 class RegressorTrainer:
     """
     This class allows you to easily load datasets and train regressors for a given line, and save it in a database.
@@ -68,15 +128,19 @@ class RegressorTrainer:
 
     def set_feature_cols(self, *args):
         args = args or __TRAINING_FEATURE_NAMES__
-        self.features = args
+        self.features = list(args)
 
     def build_training_set(self, start_date="20170215", end_date="20170401",
-                           tempo=30, **kwargs):
+                           tempo=30, memory_map=False, **kwargs):
         """
         Either from folder, either from S3
         :param start_date:
         :param end_date:
         :param tempo:
+        :param memory_map: if True, training set is loaded from memory-mapped
+        arrays cache (see TrainingArrayCache): only selected rows of the line
+        are loaded in memory, but selection has no index (analyze_scores is
+        not available).
         :return:
         """
 
@@ -92,14 +156,32 @@ class RegressorTrainer:
         days = dti.map(lambda x: x.strftime("%Y%m%d")).tolist()
 
         self._load_files_from_s3(tempo=tempo)
-        dfm = self._load_files_from_folder(tempo=tempo, days=days)
 
+        if memory_map:
+            self._load_arrays_from_cache(tempo=tempo, days=days, **kwargs)
+            self._split_train_test()
+            return
+
+        # Only days and line of interest, and only necessary columns
+        dfm = self._load_files_from_folder(
+            tempo=tempo, days=days, lines=[self.line],
+            columns=list(self.features) + ["label", "P_naive_pred"]
+        )
+        self.use_training_set(dfm, **kwargs)
+
+    def use_training_set(self, dfm, **kwargs):
+        """
+        Uses provided training set (as loaded from training set files),
+        filters it on trainer's line, and splits it in train and test sets.
+        :param dfm: training set
+        :param kwargs: filters (see _apply_filter_to_selection)
+        """
         # delete duplicated columns
         dfm = dfm.loc[:, ~dfm.columns.duplicated()]
         self._raw_training_set = dfm
 
-        # Line selection
-        self.sel = dfm.copy()
+        # Line selection (filters return new dataframes, no copy needed)
+        self.sel = dfm
         # Apply line selection
         self._filter_line(line=self.line)
         # Apply other filter
@@ -114,32 +196,32 @@ class RegressorTrainer:
         2 - Build from folder
         :return:
         """
-        # Load relevant bucket
-        bucket_provider = S3Bucket(__S3_BUCKETS__["training-sets"], create_if_absent=True)
-
-        # Download files from S3
-        logger.info("Get training sets from folder %s, and download them in %s" %
-                    (__TRAINING_SET_FOLDER_NAME__ % tempo, __TRAINING_SET_FOLDER_PATH__ % tempo))
-        bucket_provider.download_folder(
-            remote_prefix=__TRAINING_SET_FOLDER_NAME__ % tempo,
-            local_folder_root=__DATA_PATH__
-        )
-
-        return True
-
-    def _load_files_from_folder(self, tempo, days):
-        # Load training sets from folder
-        __FULL_TRAINING_SETS_FOLDER_PATH__ = __TRAINING_SET_FOLDER_PATH__ % tempo
-
-        # All files in folder
-        training_set_pickles = glob(path.join(__FULL_TRAINING_SETS_FOLDER_PATH__, "*"))
-
-        # Select days
-        training_set_pickles = [p for p in training_set_pickles if path.splitext(path.basename(p))[0] in days]
-
-        # Load and concatenate training sets
-        dataframes = list(map(pd.read_pickle, training_set_pickles))
-        return pd.concat(dataframes)
+        return download_training_sets(tempo=tempo)
+
+    def _load_files_from_folder(self, tempo, days, lines=None, columns=None):
+        # Load training sets from folder: only files of selected days and
+        # lines are read, and only selected columns
+        store = TrainingSetStore(tempo=tempo)
+        return store.load(days=days, lines=lines, columns=columns)
+
+    def _load_arrays_from_cache(self, tempo, days, cache=None, min_diff=1, max_diff=40,
+                                min_delay=-3000, max_delay=10000):
+        # Same filters as _apply_filter_to_selection, applied day by day on
+        # mapped arrays
+        def mask_function(arrays):
+            sequence_diff = arrays["sequence_diff"]
+            label = arrays["label"]
+            return (sequence_diff >= min_diff) & (sequence_diff <= max_diff)\
+                & (label >= min_delay) & (label <= max_delay)
+
+        cache = cache or TrainingArrayCache(
+            features=self.features, store=TrainingSetStore(tempo=tempo))
+        arrays = cache.load_line(days=days, line=self.line, mask_function=mask_function)
+
+        self._raw_training_set = None
+        self.sel = pd.DataFrame(arrays["X"], columns=self.features, copy=False)
+        self.sel["label"] = arrays["label"]
+        self.sel["P_naive_pred"] = arrays["naive_pred"]
 
     def _filter_line(self, line):
         assert line in __ACCEPTED_LINES__
@@ -268,10 +350,11 @@ class RegressorTrainer:
         message += "\n%s Mean absolute error: %s" % (name, mean_absolute_error(y_true, y_pred))
         return message
 
-    def save_in_database(self):
+    def save_in_database(self, score_description=None):
         assert self._fitted
 
         pickled_pipeline = codecs.encode(pickle.dumps(self.pipeline), "base64").decode()
+        score_description = score_description or self.score_pipeline()
 
         # init predictor
         predictor = Predictor(
@@ -283,7 +366,7 @@ class RegressorTrainer:
             training_set_end=self.end_date,
             sklearn_version=sklearn.__version__,
             pipeline_steps=self.pipeline.steps.__str__(),
-            score_description=self.score_pipeline()
+            score_description=score_description
         )
 
         # save in db
@@ -335,3 +418,172 @@ class RegressorTrainer:
         plt.show()
 
 
+
+
+class MultiLineTrainer:
+    """
+    Trains regressors of several lines, in parallel, by a pool of processes.
+    Training sets are downloaded from S3 once, for all lines. Then, either:
+    - training sets are loaded once (default), for all lines and only
+    necessary columns, and partitioned by line in one pass. Processes are
+    forked, so that partitions are inherited, not copied through pipes.
+    - or memory-mapped: each training process maps arrays of its own line
+    only (see TrainingArrayCache), so that memory holds selected rows of
+    lines being trained.
+
+    Daemonic processes (celery prefork workers) cannot have children: lines
+    are then trained by a pool of threads, sharing partitions (numpy and
+    scikit-learn computations release the GIL).
+
+    Trained pipelines are saved in database by the calling process.
+    """
+
+    def __init__(self, lines=None, start_date="20170101", end_date="20170701",
+                 tempo=30, features=None, processes=__MULTI_LINE_TRAINING__["processes"],
+                 memory_map=__MULTI_LINE_TRAINING__["memory_map"], store=None, cache=None):
+
+        self.lines = list(lines or __ACCEPTED_LINES__)
+        for line in self.lines:
+            assert line in __ACCEPTED_LINES__
+        datetime.strptime(start_date, "%Y%m%d")
+        datetime.strptime(end_date, "%Y%m%d")
+        assert isinstance(tempo, int)
+
+        self.start_date = start_date
+        self.end_date = end_date
+        self.tempo = tempo
+        self.features = list(features or __TRAINING_FEATURE_NAMES__)
+        self.processes = processes
+        self.memory_map = memory_map
+        self.store = store or TrainingSetStore(tempo=tempo)
+        self.cache = None
+        if memory_map:
+            self.cache = cache or TrainingArrayCache(features=self.features, store=self.store)
+        self.partitions = None
+        self.results = {}
+
+    def load(self):
+        """
+        Loads training sets of all lines, and partitions them by line (when
+        not memory-mapped).
+        """
+        days = pd.date_range(self.start_date, self.end_date, freq="D")\
+            .map(lambda x: x.strftime("%Y%m%d")).tolist()
+
+        # Downloaded once, whatever the number of lines
+        download_training_sets(tempo=self.tempo)
+        dfm = self.store.load(
+            days=days, lines=self.lines,
+            columns=self.features + ["label", "P_naive_pred"]
+        )
+        dfm = dfm.loc[:, ~dfm.columns.duplicated()]
+
+        self.partitions = {line: dfm.iloc[:0] for line in self.lines}
+        if len(dfm):
+            grouped = dfm.groupby(
+                level="Route_route_short_name_ix", observed=True, sort=False)
+            for line, partition in grouped:
+                if line in self.partitions:
+                    self.partitions[line] = partition
+        logger.info("Training sets loaded: %s rows per line", {
+            line: len(partition) for line, partition in self.partitions.items()})
+        return self.partitions
+
+    def _processes(self):
+        """Number of lines trained at the same time."""
+        if self.processes is None or self.processes <= 1:
+            return 1
+        return min(self.processes, len(self.lines))
+
+    def train(self, **filters):
+        """
+        Trains pipelines of all lines with a training set.
+
+        :param filters: filters (see RegressorTrainer._apply_filter_to_selection)
+
+        :return: results per line (pipeline, score_description, rows)
+        :rtype: dict
+        """
+        global _shared_partitions
+        if self.memory_map:
+            download_training_sets(tempo=self.tempo)
+            lines = self.lines
+        else:
+            if self.partitions is None:
+                self.load()
+            lines = [line for line in self.lines if len(self.partitions[line])]
+
+        args = (self.features, self.start_date, self.end_date, filters)
+        processes = self._processes()
+        if processes == 1:
+            results = [
+                _train_line(
+                    line, *args, cache=self.cache,
+                    partition=None if self.memory_map else self.partitions[line])
+                for line in lines
+            ]
+        elif multiprocessing.current_process().daemon:
+            # Daemonic processes (celery prefork workers) cannot have children
+            logger.info("Daemonic process: lines are trained by %d threads.", processes)
+            with ThreadPoolExecutor(max_workers=processes) as executor:
+                futures = [
+                    executor.submit(
+                        _train_line, line, *args, cache=self.cache,
+                        partition=None if self.memory_map else self.partitions[line])
+                    for line in lines
+                ]
+                results = [future.result() for future in futures]
+        elif self.memory_map:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [
+                    executor.submit(_train_line, line, *args, cache=self.cache)
+                    for line in lines
+                ]
+                results = [future.result() for future in futures]
+        else:
+            fork = "fork" in multiprocessing.get_all_start_methods()
+            if fork:
+                _shared_partitions = self.partitions
+                context = multiprocessing.get_context("fork")
+            else:
+                context = None
+            try:
+                with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+                    futures = [
+                        executor.submit(
+                            _train_line, line, *args,
+                            partition=None if fork else self.partitions[line])
+                        for line in lines
+                    ]
+                    results = [future.result() for future in futures]
+            finally:
+                _shared_partitions = {}
+
+        self.results = {result["line"]: result for result in results if result}
+        for line in self.lines:
+            if line not in self.results:
+                logger.warning("No training data for line %s.", line)
+        for line, result in self.results.items():
+            logger.info("Line %s trained on %d rows.%s",
+                        line, result["rows"], result["score_description"])
+        return self.results
+
+    def save_in_database(self):
+        """
+        Saves trained pipelines in database.
+        """
+        for line, result in self.results.items():
+            trainer = RegressorTrainer(line=line)
+            trainer.set_feature_cols(*self.features)
+            trainer.start_date = self.start_date
+            trainer.end_date = self.end_date
+            trainer.pipeline = result["pipeline"]
+            trainer._fitted = True
+            trainer.save_in_database(score_description=result["score_description"])
+
+    def __repr__(self):
+        return "<MultiLineTrainer(lines='%s', start='%s', end='%s', tempo='%s')>"\
+            % (",".join(self.lines), self.start_date, self.end_date, self.tempo)
+
+    def __str__(self):
+        return self.__repr__()
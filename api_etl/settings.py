@@ -16,10 +16,88 @@ __S3_BUCKETS__ = {
     "gtfs-files": "%s.gtfs-files" % __S3_PREFIX__,
     "training-sets": "%s.training-sets" % __S3_PREFIX__,
 }
+# Folders synchronization: only new or changed files are transferred, by
+# "workers" threads. State of last transfers is kept in a manifest file, in
+# synchronized local folder.
+# Transfers of files bigger than "multipart_threshold" bytes are split in
+# parts of "part_size" bytes, transferred by "threads" threads. Batch
+# operations transfer "batch_workers" files at a time.
+__S3_TRANSFER__ = {
+    "multipart_threshold": 8 * 1024 * 1024,
+    "part_size": 8 * 1024 * 1024,
+    "threads": 8,
+    "batch_workers": 4,
+}
+__S3_SYNC__ = {
+    "workers": 8,
+    "manifest_name": ".s3-sync-%s.json",
+}
+
+# ##### TRANSILIEN API #####
+# Requests are spread by a token bucket: "burst" requests can be sent at once,
+# then requests flow at a steady rate so that any sliding minute stays under
+# "max_per_minute".
+__API_RATE_LIMIT__ = {
+    "max_per_minute": 350,
+    "burst": 10,
+}
+# Connection pool kept by persistent clients across extraction cycles:
+# keep-alive must be longer than delay between cycles (2 minutes).
+__API_CONNECTION_POOL__ = {
+    "limit_per_host": 20,
+    "keepalive_timeout": 150,
+    "dns_cache_ttl": 600,
+}
+# Adaptive polling (seconds): stations with scheduled passages within
+# "imminent_horizon" (or passed less than "late_margin" ago) are requested at
+# every cycle, others every "idle_interval". Stations not answering while
+# passages are imminent are requested every "unresponsive_interval".
+# Disabled by default: all stations are requested at every cycle.
+__ADAPTIVE_POLLING__ = {
+    "enabled": False,
+    "cycle_seconds": 120,
+    "imminent_horizon": 1800,
+    "late_margin": 900,
+    "idle_interval": 900,
+    "unresponsive_after": 5,
+    "unresponsive_interval": 1800,
+}
+# Passage polling (seconds): each station is requested "lead" seconds before
+# its next scheduled passage, at most every "min_interval". Due stations are
+# picked every "tick_seconds". A schedule that cannot be loaded is tried again
+# after "schedule_retry_seconds".
+__PASSAGE_POLLING__ = {
+    "lead": 180,
+    "min_interval": 120,
+    "tick_seconds": 10,
+    "schedule_retry_seconds": 120,
+}
+
+# ##### DATE PARSING #####
+# Parsed dates and times are memoized: a day of data holds only a few
+# thousand distinct api dates and departure times.
+__DATE_PARSING_CACHE__ = {
+    "maxsize": 16384,
+}
 
 # ##### DATA PATH #####
 __DATA_PATH__ = path.join(__BASE_DIR__, "data")
 __GTFS_FOLDER_PATH__ = path.join(__DATA_PATH__, "gtfs-folder")
+# Schedule queries (see querier_schedule.schedule_querier): "rdb" backend
+# queries relational database, "memory" backend answers from a timetable held
+# in memory, loaded from "source" ("rdb" or "folder": GTFS files) and reloaded
+# when feed changes (checked at most every "version_check_interval" seconds).
+__SCHEDULE_QUERIER__ = {
+    "backend": "rdb",
+    "source": "rdb",
+    "version_check_interval": 300,
+}
+
+# GTFS files are loaded in relational database by chunks of "chunksize" rows,
+# in staging tables swapped with schedule tables once all files are loaded.
+__GTFS_BULK_LOAD__ = {
+    "chunksize": 50000,
+}
 
 __GTFS_CSV_URL__ = 'https://ressources.data.sncf.com/explore/dataset/sncf-transilien-gtfs/' \
                    + 'download/?format=csv&timezone=Europe/Berlin&use_labels_for_header=true'
@@ -28,6 +106,29 @@ __RAW_DAYS_FOLDER_NAME__ = "raw_days"
 __RAW_DAYS_FOLDER_PATH__ = path.join(__DATA_PATH__, __RAW_DAYS_FOLDER_NAME__)
 __TRAINING_SET_FOLDER_NAME__ = "training_set-tempo-%s-min"
 __TRAINING_SET_FOLDER_PATH__ = path.join(__DATA_PATH__, __TRAINING_SET_FOLDER_NAME__)
+# Local cache of training sets as memory-mapped arrays (per day and line),
+# rebuilt from training set files when they change.
+__TRAINING_ARRAYS_FOLDER_NAME__ = "training_arrays-tempo-%s-min"
+__TRAINING_ARRAYS_FOLDER_PATH__ = path.join(__DATA_PATH__, __TRAINING_ARRAYS_FOLDER_NAME__)
+
+# Training of several lines (see regressor_train.MultiLineTrainer): lines are
+# trained by "processes" processes (threads in daemonic processes, such as
+# celery workers), on training sets loaded once for all lines, or on
+# memory-mapped arrays of their line if "memory_map".
+__MULTI_LINE_TRAINING__ = {
+    "processes": 4,
+    "memory_map": False,
+}
+
+# Local columnar archive of realtime departures, appended by batches of
+# "batch_size" departures during each cycle by the extraction service if
+# enabled. Days older than "keep_days" (None: all kept) are removed.
+__REALTIME_ARCHIVE__ = {
+    "enabled": False,
+    "path": path.join(__DATA_PATH__, "realtime_archive"),
+    "batch_size": 5000,
+    "keep_days": 30,
+}
 
 
 # Stations files paths
@@ -48,6 +149,23 @@ __DYNAMO_REALTIME__ = {
         "write": 80
     }
 }
+# Batch writes: items are written by requests of 25 items, sent by "workers"
+# threads. Rejected items are retried with a jittered exponential backoff
+# (seconds) at most "max_retries" times.
+__DYNAMO_BATCH_WRITE__ = {
+    "workers": 4,
+    "max_retries": 8,
+    "base_backoff": 0.05,
+    "max_backoff": 5,
+}
+# Departures are written again only if one of "fields" changed since last
+# write. Cache is kept by the extraction service (and on disk if "path" is
+# set), entries of days older than "keep_days" are evicted.
+__DYNAMO_WRITE_SKIP_CACHE__ = {
+    "fields": ["date", "etat", "miss", "term"],
+    "keep_days": 1,
+    "path": None,
+}
 
 # LOGGING
 
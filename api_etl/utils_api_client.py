@@ -5,12 +5,13 @@ Module used to query Transilien's API.
 from os import path
 import logging
 import asyncio
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientError, TCPConnector
 from datetime import datetime, timedelta
 import requests
 import time
 
 from api_etl.utils_secrets import get_secret
+from api_etl.settings import __API_RATE_LIMIT__, __API_CONNECTION_POOL__
 
 logger = logging.getLogger(__name__)
 
@@ -21,18 +22,155 @@ API_PASSWORD = get_secret("API_PASSWORD")
 _RETRIABLE_STATUSES = {500, 503, 504}
 
 
+def _retry_delay(retry_counter):
+    """
+    Backoff policy shared by single and asynchronous queries.
+
+    0.5 * (1.5 ^ i) is an increased sleep time of 1.5x per iteration,
+    starting at 0.5s when retry_counter=0. The first retry will occur
+    at 1, so subtract that first.
+    """
+    return 0.5 * 1.5 ** (retry_counter - 1)
+
+
+class TokenBucket:
+    """
+    Asynchronous token bucket used to spread requests at a steady rate.
+
+    The bucket holds at most "capacity" tokens and is refilled continuously at
+    "rate" tokens per second. Each request consumes one token, and waits if
+    none is available.
+    """
+
+    def __init__(self, rate, capacity=1):
+        assert rate > 0
+        assert capacity >= 1
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = None
+        self._lock_loop = None
+
+    @classmethod
+    def from_max_per_minute(cls, max_per_minute, burst=1):
+        """
+        Builds a bucket that never exceeds "max_per_minute" requests on any
+        sliding minute: burst tokens are subtracted from the steady rate.
+        """
+        assert max_per_minute > burst
+        return cls(rate=(max_per_minute - burst) / 60., capacity=burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._last_refill = now
+
+    async def acquire(self):
+        """
+        Waits until a token is available, then consumes it.
+        """
+        # Lock is created lazily so that it is bound to the running loop, and
+        # created again if bucket is used on another loop (a persistent client
+        # opens a new loop once closed)
+        loop = asyncio.get_event_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def __repr__(self):
+        return "<TokenBucket(rate='%.2f/s', capacity='%s')>"\
+            % (self.rate, self.capacity)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class StationResponse:
+    """
+    Result of an asynchronous query for a given station, with meta
+    information about how it was obtained.
+    """
+
+    def __init__(self, station):
+        self.station = station
+        self.content = None
+        self.status = None
+        self.error = None
+        # Latency of last attempt, in seconds
+        self.latency = None
+        self.attempts = 0
+        self._released_size = 0
+
+    @property
+    def size(self):
+        """Number of bytes received."""
+        if self.content is None:
+            return self._released_size
+        return len(self.content)
+
+    def release(self):
+        """
+        Drops content (once it has been parsed), keeping its size.
+        """
+        self._released_size = self.size
+        self.content = None
+
+    def is_ok(self):
+        # content is always read when a status is received
+        return self.status == 200
+
+    def __repr__(self):
+        return "<StationResponse(station='%s', status='%s', attempts='%s', latency='%s', size='%s', error='%s')>"\
+            % (self.station, self.status, self.attempts, self.latency, self.size, self.error)
+
+    def __str__(self):
+        return self.__repr__()
+
+
 class ApiClient:
     """
     This class provide a client to process requests to transilien's API.
     It provides methods to process either single queries, or asynchronous batch queries that rely on asyncio library.
+
+    If "persistent" is set, the client keeps its own event loop and a
+    keep-alive connection pool across batch queries: it must then be closed
+    with "close" method (or used as a context manager).
     """
 
-    def __init__(self, user=API_USER, password=API_PASSWORD, retry_timeout=20, core_url='http://api.transilien.com/'):
+    def __init__(self, user=API_USER, password=API_PASSWORD, retry_timeout=20, core_url='http://api.transilien.com/',
+                 max_per_minute=__API_RATE_LIMIT__["max_per_minute"], burst=__API_RATE_LIMIT__["burst"],
+                 max_concurrency=20, request_timeout=10, persistent=False,
+                 limit_per_host=__API_CONNECTION_POOL__["limit_per_host"],
+                 keepalive_timeout=__API_CONNECTION_POOL__["keepalive_timeout"],
+                 dns_cache_ttl=__API_CONNECTION_POOL__["dns_cache_ttl"]):
         self.core_url = core_url
         self.user = user
         self.password = password
         self.retry_timeout = retry_timeout
+        # Asynchronous batch queries: number of simultaneous connections, and
+        # timeout (in seconds) of each attempt
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        # Connection pool
+        self.persistent = persistent
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._loop = None
+        self._session = None
         self.requested_urls = []
+        # Asynchronous batch queries are spread to respect API quota
+        self.rate_limiter = TokenBucket.from_max_per_minute(
+            max_per_minute=max_per_minute, burst=burst)
 
     def _get(self, url, extra_params=None, verbose=False, first_request_time=None, retry_counter=0):
         """
@@ -49,11 +187,7 @@ class ApiClient:
             raise TimeoutError
 
         if retry_counter > 0:
-            # 0.5 * (1.5 ^ i) is an increased sleep time of 1.5x per iteration,
-            # starting at 0.5s when retry_counter=0. The first retry will occur
-            # at 1, so subtract that first.
-            delay_seconds = 0.5 * 1.5 ** (retry_counter - 1)
-            time.sleep(delay_seconds)
+            time.sleep(_retry_delay(retry_counter))
 
         full_url = path.join(self.core_url, url)
 
@@ -107,52 +241,161 @@ class ApiClient:
             full_url_list.append(full_url)
         return full_url_list
 
+    async def _fetch_station(self, station, url, session, semaphore):
+        """
+        Asynchronous query of a single station, with same retry policy as
+        single queries: retriable statuses, timeouts and connection errors are
+        retried with increasing delays until "retry_timeout" is reached.
+        """
+        result = StationResponse(station)
+        first_request_time = time.monotonic()
+
+        while True:
+            if result.attempts > 0:
+                if time.monotonic() - first_request_time > self.retry_timeout:
+                    logger.debug("Giving up on station %s after %d attempts",
+                                 station, result.attempts)
+                    break
+                await asyncio.sleep(_retry_delay(result.attempts))
+
+            await self.rate_limiter.acquire()
+            result.attempts += 1
+            begin = time.monotonic()
+            try:
+                async with semaphore:
+                    result.status, result.content = await asyncio.wait_for(
+                        self._read(url, session), timeout=self.request_timeout)
+                result.error = None
+            except (asyncio.TimeoutError, ClientError) as e:
+                result.status = None
+                result.content = None
+                result.error = repr(e)
+            result.latency = time.monotonic() - begin
+
+            if result.status is not None and result.status not in _RETRIABLE_STATUSES:
+                break
+            logger.debug("Retry number %d for station %s: %s",
+                         result.attempts, station, result)
+
+        return result
+
+    @staticmethod
+    async def _read(url, session):
+        async with session.get(url) as response:
+            content = await response.read()
+            return response.status, content
+
     def request_stations(self, station_list):
         """
         This method process asynchronous batch queries.
         It will return answers with station ids so that you can identify stations answers.
 
+        Requests are spread by the client's rate limiter, so that the API
+        quota (max requests per minute) is respected whatever the number of
+        stations, and at most "max_concurrency" requests are processed
+        simultaneously.
+
         :param station_list: list of station_ids in the 8 digits format used by transilien's API
         to identify stations (warning: different than station ids in GTFS files that are 7 digits).
         :type station_list: list of str
 
-        :rtype: list of tuples (api_response, station_id)
+        :rtype: list of StationResponse (in same order as station_list)
         """
-        def url_to_station(url):
-            station = url.split("/")[-2]
-            return station
+        return self.run(self.fetch_stations(station_list))
+
+    async def fetch_stations(self, station_list, on_response=None):
+        """
+        Coroutine processing asynchronous batch queries (see request_stations).
+
+        :param station_list: list of station_ids in the 8 digits format.
+        :type station_list: list of str
 
+        :param on_response: optional coroutine function, awaited with each
+        StationResponse as soon as it is received (so that responses can be
+        processed while other stations are still being requested).
+
+        :rtype: list of StationResponse (in same order as station_list)
+        """
         full_urls = self._stations_to_full_urls(station_list)
 
-        async def fetch(url, session):
-            async with session.get(url) as response:
-                station = url_to_station(url)
-                try:
-                    resp = await response.read()
-                    return [resp, station]
-                except:
-                    logger.debug(
-                        "Error getting station %s information", station)
-                    return [False, station]
-
-        async def run(url_list):
-            tasks = []
-            # Fetch all responses within one Client session,
-            # keep connection alive for all requests.
-            async with ClientSession() as session:
-                for url in url_list:
-                    task = asyncio.ensure_future(
-                        fetch(url, session))
-                    tasks.append(task)
-
-                responses = await asyncio.gather(*tasks)
-                # you now have all response bodies in this variable
-                # print(responses)
-                return responses
-
-        # def print_responses(result):
-        #    print(result)
-        loop = asyncio.get_event_loop()
-        future = asyncio.ensure_future(run(full_urls))
-        loop.run_until_complete(future)
-        return future.result()
+        async def fetch(station, url, session, semaphore):
+            response = await self._fetch_station(station, url, session, semaphore)
+            if on_response is not None:
+                await on_response(response)
+            return response
+
+        async def fetch_all(session):
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            tasks = [
+                asyncio.ensure_future(
+                    fetch(str(station), url, session, semaphore))
+                for station, url in zip(station_list, full_urls)
+            ]
+            try:
+                return await asyncio.gather(*tasks)
+            finally:
+                # If a response could not be processed (or if cancelled),
+                # other stations are not requested
+                pending = [task for task in tasks if not task.done()]
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.wait(pending)
+
+        if self.persistent:
+            # Reuse connections opened during previous batch queries
+            session = await self._get_session()
+            return await fetch_all(session)
+        # Fetch all responses within one Client session,
+        # keep connection alive for all requests.
+        async with ClientSession(connector=self._new_connector()) as session:
+            return await fetch_all(session)
+
+    def run(self, coroutine):
+        """
+        Runs coroutine until complete on client's event loop (the persistent
+        one if client is persistent).
+        """
+        return self._get_loop().run_until_complete(coroutine)
+
+    def _new_connector(self):
+        return TCPConnector(
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl
+        )
+
+    def _get_loop(self):
+        if not self.persistent:
+            return asyncio.get_event_loop()
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    async def _get_session(self):
+        # Must be called from persistent loop, so that session is bound to it
+        if self._session is None or self._session.closed:
+            logger.debug("Opening new persistent client session.")
+            self._session = ClientSession(connector=self._new_connector())
+        return self._session
+
+    def close(self):
+        """
+        Closes persistent connection pool and event loop (no effect if client
+        is not persistent).
+        """
+        if self._loop is None or self._loop.is_closed():
+            self._session = None
+            self._loop = None
+            return
+        if self._session is not None and not self._session.closed:
+            self._loop.run_until_complete(self._session.close())
+        self._session = None
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
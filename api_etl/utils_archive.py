@@ -0,0 +1,305 @@
+"""
+Module used to keep a local archive of realtime departures, in a columnar
+format (Parquet), so that days of realtime data can be loaded without
+querying Dynamo.
+"""
+
+from os import path, makedirs, listdir, remove, replace
+import os
+import time
+from shutil import rmtree
+from datetime import datetime, timedelta
+import logging
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from api_etl.utils_misc import StationProvider, special_times_to_seconds
+from api_etl.settings import __REALTIME_ARCHIVE__, __ACCEPTED_LINES__
+
+logger = logging.getLogger(__name__)
+
+# Partitions: "day=20170215/line=C/"
+_PARTITIONING = ds.partitioning(
+    pa.schema([("day", pa.string()), ("line", pa.string())]), flavor="hive")
+# Files being written start with "_": ignored by readers
+_COMPACTED_FILE = "data.parquet"
+# Lock of a partition being compacted, considered stale after timeout (s)
+_COMPACT_LOCK = "_compact.lock"
+_COMPACT_LOCK_TIMEOUT = 3600
+_UNKNOWN_LINE = "other"
+
+# Compact schema of archived departures (day and line are partitions):
+# - expected passage time as seconds since service day midnight
+# - request day and time as a single timestamp
+# - repeated strings dictionary encoded
+ARCHIVE_COLUMNS = [
+    "station_id", "train_num", "term", "miss", "etat",
+    "expected_passage_seconds", "request_datetime", "data_freshness"
+]
+_DICTIONARY_COLUMNS = ["station_id", "term", "miss", "etat"]
+
+
+def _decode_dictionaries(table):
+    for column in _DICTIONARY_COLUMNS:
+        i = table.schema.get_field_index(column)
+        table = table.set_column(
+            i, column, table.column(column).cast(pa.string()))
+    return table
+
+
+def _encode_dictionaries(table):
+    for column in _DICTIONARY_COLUMNS:
+        i = table.schema.get_field_index(column)
+        table = table.set_column(
+            i, column, table.column(column).dictionary_encode())
+    return table
+
+
+def departures_to_table(records):
+    """
+    Converts parsed departures (see extract_api.parse_api_response) to an
+    arrow table with the archive's compact schema, plus "day" column.
+
+    :param records: parsed departures
+    :type records: list of dicts
+
+    :rtype: pyarrow.Table
+    """
+    df = pd.DataFrame(records, columns=[
+        "station_id", "train_num", "term", "miss", "etat",
+        "expected_passage_day", "expected_passage_time", "request_day",
+        "request_time", "data_freshness"
+    ])
+    columns = {
+        "day": pa.array(df.expected_passage_day, pa.string()),
+        "train_num": pa.array(df.train_num, pa.string()),
+        "expected_passage_seconds": pa.array(
+            special_times_to_seconds(df.expected_passage_time), pa.int32()),
+        "request_datetime": pa.array(
+            pd.to_datetime(df.request_day + df.request_time,
+                           format="%Y%m%d%H:%M:%S"),
+            pa.timestamp("s")),
+        "data_freshness": pa.array(
+            pd.to_numeric(df.data_freshness, errors="coerce"), pa.int32()),
+    }
+    for column in _DICTIONARY_COLUMNS:
+        columns[column] = pa.array(df[column], pa.string()).dictionary_encode()
+    return pa.table({
+        column: columns[column] for column in ["day"] + ARCHIVE_COLUMNS
+    })
+
+
+class RealtimeArchive:
+    """ Append-only local archive of realtime departures, partitioned by
+    service day and line, in Parquet files:
+
+    root/day=20170215/line=C/part-<...>.parquet
+
+    - "append" writes each call (a cycle) as new part files.
+    - "compact" merges parts of a day in one sorted file per line (without
+    duplicates), so that a day is read with one sequential scan per line.
+    - "read" loads departures of a day range, with optional line and station
+    filters, and column projection.
+    - "prune" removes days older than "keep_days".
+
+    Stations are assigned to their first line (in __ACCEPTED_LINES__
+    order), stations without known line are in "other" line.
+    """
+
+    def __init__(self, root=__REALTIME_ARCHIVE__["path"], station_lines=None,
+                 keep_days=__REALTIME_ARCHIVE__["keep_days"]):
+        self.root = root
+        self.keep_days = keep_days
+        self._station_lines = station_lines
+
+    @property
+    def station_lines(self):
+        """Line of each station (7 digits)."""
+        if self._station_lines is None:
+            df = StationProvider().get_stations_per_line(
+                lines=__ACCEPTED_LINES__, full_df=True)
+            station_lines = {}
+            for line in __ACCEPTED_LINES__:
+                for uic in df[df[line].notnull()].Code_UIC:
+                    station_lines.setdefault(str(uic)[:7], line)
+            self._station_lines = station_lines
+        return self._station_lines
+
+    def _partition_path(self, day, line):
+        return path.join(self.root, "day=%s" % day, "line=%s" % line)
+
+    def append(self, records):
+        """
+        Writes departures in new part files (one per day and line).
+
+        :param records: parsed departures
+        :type records: list of dicts
+
+        :return: number of departures written
+        """
+        if not records:
+            return 0
+        table = departures_to_table(records)
+        lines = pa.array(
+            [self.station_lines.get(station, _UNKNOWN_LINE)
+             for station in table.column("station_id").to_pylist()],
+            pa.string()
+        )
+        df_keys = pd.DataFrame({
+            "day": table.column("day").to_pandas(),
+            "line": lines.to_pandas()
+        })
+        part_name = "part-%s.parquet" % uuid.uuid4().hex
+        for (day, line), indices in df_keys.groupby(["day", "line"]).indices.items():
+            partition = self._partition_path(day, line)
+            makedirs(partition, exist_ok=True)
+            part = table.take(pa.array(indices)).drop(["day"])
+            tmp_path = path.join(partition, "_%s" % part_name)
+            pq.write_table(part, tmp_path)
+            replace(tmp_path, path.join(partition, part_name))
+        logger.debug("Archived %d departures", len(records))
+        return len(records)
+
+    def days(self):
+        """Archived days, sorted."""
+        if not path.isdir(self.root):
+            return []
+        return sorted(
+            name.split("=", 1)[1] for name in listdir(self.root)
+            if name.startswith("day=")
+        )
+
+    @staticmethod
+    def _lock_partition(partition):
+        """
+        Creates partition's compaction lock file, returns False if another
+        process holds it (stale locks, of crashed processes, are replaced).
+        """
+        lock_path = path.join(partition, _COMPACT_LOCK)
+        for _ in range(2):
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - path.getmtime(lock_path) < _COMPACT_LOCK_TIMEOUT:
+                        return False
+                    remove(lock_path)
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def compact(self, day):
+        """
+        Merges all files of each line partition of a day in a single file,
+        sorted by station and expected passage time, without duplicates.
+
+        Several processes can compact the same day: a partition locked by
+        another process is skipped, and parts already removed by another
+        process are ignored.
+        """
+        day_path = path.join(self.root, "day=%s" % day)
+        if not path.isdir(day_path):
+            return
+        for line_dir in listdir(day_path):
+            partition = path.join(day_path, line_dir)
+            if not self._lock_partition(partition):
+                logger.info("Partition %s is being compacted by another process",
+                            partition)
+                continue
+            try:
+                self._compact_partition(partition)
+            finally:
+                try:
+                    remove(path.join(partition, _COMPACT_LOCK))
+                except FileNotFoundError:
+                    pass
+
+    def _compact_partition(self, partition):
+        files = [
+            path.join(partition, name) for name in sorted(listdir(partition))
+            if name.endswith(".parquet") and not name.startswith("_")
+        ]
+        parts = [f for f in files if path.basename(f) != _COMPACTED_FILE]
+        if not parts:
+            return
+        try:
+            table = pa.concat_tables(
+                [_decode_dictionaries(pq.read_table(f)) for f in files])
+        except FileNotFoundError:
+            logger.info("Partition %s was compacted by another process", partition)
+            return
+        df = table.to_pandas()\
+            .drop_duplicates(subset=["station_id", "train_num", "request_datetime"])\
+            .sort_values(["station_id", "expected_passage_seconds", "request_datetime"])
+        compacted = _encode_dictionaries(
+            pa.Table.from_pandas(df, schema=table.schema, preserve_index=False))
+        tmp_path = path.join(partition, "_%s.parquet" % uuid.uuid4().hex)
+        pq.write_table(compacted, tmp_path)
+        replace(tmp_path, path.join(partition, _COMPACTED_FILE))
+        for f in parts:
+            try:
+                remove(f)
+            except FileNotFoundError:
+                pass
+        logger.info("Compacted %d files of %s in %d rows",
+                    len(files), partition, compacted.num_rows)
+
+    def prune(self, day):
+        """
+        Removes archived days more than "keep_days" days before day (nothing
+        if keep_days is None).
+
+        :param day: current day ("%Y%m%d")
+        :return: removed days
+        :rtype: list of str
+        """
+        if self.keep_days is None:
+            return []
+        first_kept = (datetime.strptime(day, "%Y%m%d") - timedelta(days=self.keep_days))\
+            .strftime("%Y%m%d")
+        removed = [archived for archived in self.days() if archived < first_kept]
+        for archived in removed:
+            rmtree(path.join(self.root, "day=%s" % archived), ignore_errors=True)
+        if removed:
+            logger.info("Removed %d archived days before %s", len(removed), first_kept)
+        return removed
+
+    def read(self, day_from, day_to=None, lines=None, stations=None, columns=None):
+        """
+        Loads archived departures of days in [day_from, day_to].
+
+        :param day_from: first day ("%Y%m%d")
+        :param day_to: last day, default to day_from
+        :param lines: lines to load, default all
+        :type lines: list of str
+        :param stations: stations (7 digits) to load, default all
+        :type stations: list of str
+        :param columns: columns to load (among "day", "line" and
+        ARCHIVE_COLUMNS), default all
+        :type columns: list of str
+
+        :rtype: pandas DataFrame (dictionary columns as categories)
+        """
+        day_to = day_to or day_from
+        if not path.isdir(self.root):
+            return pd.DataFrame(columns=columns or ["day", "line"] + ARCHIVE_COLUMNS)
+
+        dataset = ds.dataset(
+            self.root, format="parquet", partitioning=_PARTITIONING)
+        condition = (ds.field("day") >= day_from) & (ds.field("day") <= day_to)
+        if lines:
+            condition &= ds.field("line").isin(list(lines))
+        if stations:
+            condition &= ds.field("station_id").isin(list(map(str, stations)))
+        return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+    def __repr__(self):
+        return "<RealtimeArchive(root='%s', keep_days='%s')>" % (self.root, self.keep_days)
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,150 @@
+"""
+Module used to precompute services active on each day of a GTFS feed, from
+calendars (date ranges and weekdays) and calendar dates (exceptions).
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from api_etl.data_models import Calendar, CalendarDate
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def _days(dates):
+    """GTFS dates ("%Y%m%d") to numpy days."""
+    return pd.to_datetime(pd.Series(dates, dtype=str), format="%Y%m%d")\
+        .values.astype("datetime64[D]")
+
+
+class ServiceCalendar:
+    """ Services active on each day of feed's validity window, as a bitmap:
+    one row per day, one bit per service (in calendar's order).
+
+    A service is active on a day if:
+    - day is in its date range, and its weekday flag is set, unless removed
+    on that day (exception type "2")
+    - or it is added on that day (exception type "1")
+
+    Days outside validity window have no active service.
+    """
+
+    def __init__(self, calendars, calendar_dates):
+        """
+        :param calendars: calendars table (columns of Calendar model)
+        :type calendars: pandas DataFrame
+        :param calendar_dates: calendar dates table (columns of CalendarDate
+        model)
+        :type calendar_dates: pandas DataFrame
+        """
+        self.service_ids = calendars.service_id.astype(str).values
+        service_index = {s: i for i, s in enumerate(self.service_ids)}
+
+        starts = _days(calendars.start_date)
+        ends = _days(calendars.end_date)
+        exceptions = calendar_dates[calendar_dates.service_id.isin(service_index)]
+        exception_days = _days(exceptions.date)
+
+        bounds = np.concatenate([starts, ends, exception_days])
+        bounds = bounds[~np.isnat(bounds)]
+        if len(bounds):
+            self.first_day, self.last_day = bounds.min(), bounds.max()
+        else:
+            # Empty window
+            self.first_day = np.datetime64("1970-01-01")
+            self.last_day = self.first_day - 1
+        days = np.arange(self.first_day, self.last_day + 1)
+
+        # Weekday of days: 1970-01-01 is a thursday (3)
+        weekdays = (days.astype(np.int64) + 3) % 7
+        weekday_flags = np.stack([
+            pd.to_numeric(calendars[weekday], errors="coerce").fillna(0).values == 1
+            for weekday in WEEKDAYS
+        ], axis=1)
+        active = (days[:, None] >= starts[None, :]) & (days[:, None] <= ends[None, :])
+        active &= weekday_flags[:, weekdays].T
+
+        day_rows = (exception_days - self.first_day).astype(np.int64)
+        service_columns = exceptions.service_id.map(service_index).values.astype(np.int64)
+        exception_types = exceptions.exception_type.astype(str).values
+        added = exception_types == "1"
+        removed = exception_types == "2"
+        active[day_rows[added], service_columns[added]] = True
+        active[day_rows[removed], service_columns[removed]] = False
+
+        self.bitmap = np.packbits(active, axis=1)
+        logger.info("Computed active services of %d services on %d days.",
+                    len(self.service_ids), len(days))
+
+    @classmethod
+    def from_rdb(cls, provider=None, calendars_table=Calendar.__tablename__,
+                 calendar_dates_table=CalendarDate.__tablename__):
+        """
+        Computes calendar from Calendar and CalendarDate tables (or tables
+        with same columns, such as staging tables).
+        """
+        if provider is None:
+            from api_etl.utils_rdb import rdb_provider as provider
+        engine = provider.get_engine()
+        return cls(
+            pd.read_sql_table(calendars_table, engine),
+            pd.read_sql_table(calendar_dates_table, engine)
+        )
+
+    @property
+    def days(self):
+        """Days of validity window, as "%Y%m%d" strings."""
+        return [
+            str(day).replace("-", "")
+            for day in np.arange(self.first_day, self.last_day + 1)
+        ]
+
+    def active_mask(self, day):
+        """
+        Returns boolean mask of services (in calendar's order) active on day.
+
+        :param day: day ("%Y%m%d")
+        :rtype: numpy array of bool
+        """
+        row = (_days([day])[0] - self.first_day).astype(np.int64)
+        if not 0 <= row < len(self.bitmap):
+            return np.zeros(len(self.service_ids), dtype=bool)
+        return np.unpackbits(
+            self.bitmap[row], count=len(self.service_ids)).astype(bool)
+
+    def active_services(self, day):
+        """
+        Returns ids of services active on day.
+
+        :param day: day ("%Y%m%d")
+        :rtype: list of str
+        """
+        return list(self.service_ids[self.active_mask(day)])
+
+    def frames(self, chunksize):
+        """
+        Active services of each day (columns of ServiceDay model), as
+        DataFrames of at most chunksize rows.
+
+        :rtype: iterator of pandas DataFrames
+        """
+        active = np.unpackbits(
+            self.bitmap, axis=1, count=len(self.service_ids)).astype(bool)
+        day_rows, service_columns = np.nonzero(active)
+        days = np.array(self.days, dtype=object)
+        for i in range(0, len(day_rows), chunksize):
+            yield pd.DataFrame({
+                "date": days[day_rows[i:i + chunksize]],
+                "service_id": self.service_ids[service_columns[i:i + chunksize]]
+            })
+
+    def __repr__(self):
+        return "<ServiceCalendar(services='%s', first_day='%s', last_day='%s')>"\
+            % (len(self.service_ids), self.first_day, self.last_day)
+
+    def __str__(self):
+        return self.__repr__()
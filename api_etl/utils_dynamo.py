@@ -0,0 +1,360 @@
+"""
+Module used to write in Dynamo tables.
+"""
+
+from os import path, replace
+import logging
+import random
+import threading
+import time
+import pickle
+import hashlib
+from collections import Counter
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from pynamodb.exceptions import PutError
+
+from api_etl.settings import __DYNAMO_BATCH_WRITE__, __DYNAMO_WRITE_SKIP_CACHE__
+from api_etl.utils_misc import get_paris_local_datetime_now
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of items accepted by a BatchWriteItem request
+_MAX_BATCH_SIZE = 25
+_THROTTLING_ERRORS = {
+    "ProvisionedThroughputExceededException", "ThrottlingException",
+    "RequestLimitExceeded"
+}
+
+
+def _serialized_attributes(item):
+    """
+    Attributes of a pynamodb model instance, as expected in "put_items" of
+    low-level batch_write_item (as pynamodb BatchWrite does).
+    """
+    return item._serialize(attr_map=True)["attributes"]
+
+
+def _error_code(error):
+    """
+    Dynamo error code (for instance "ThrottlingException") of a pynamodb
+    exception, from the botocore error it was raised from (None if unknown).
+    """
+    response = getattr(getattr(error, "cause", None), "response", None) or {}
+    return response.get("Error", {}).get("Code")
+
+
+class CapacityPacer:
+    """
+    Thread-safe token bucket used to pace writes to a provisioned
+    throughput: refilled continuously at "rate" units per second, it holds at
+    most "capacity" units.
+    """
+
+    def __init__(self, rate, capacity=None):
+        assert rate > 0
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._units = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units=1):
+        """
+        Blocks until "units" units are available, then consumes them. Returns
+        time waited in seconds.
+        """
+        units = min(units, self.capacity)
+        waited = 0
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._units = min(
+                    self.capacity,
+                    self._units + (now - self._last_refill) * self.rate
+                )
+                self._last_refill = now
+                if self._units >= units:
+                    self._units -= units
+                    return waited
+                delay = (units - self._units) / self.rate
+                time.sleep(delay)
+                waited += delay
+
+    def __repr__(self):
+        return "<CapacityPacer(rate='%.1f/s', capacity='%s')>"\
+            % (self.rate, self.capacity)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class WriteSkipCache:
+    """ Remembers what was last written for each departure, so that
+    unchanged departures are not written again at each cycle.
+
+    Entries are keyed by (station_id, day_train_num) and hold a hash of
+    "fields" values. They are grouped by day (prefix of day_train_num), so
+    that days older than "keep_days" are evicted at once.
+
+    Filtered items are pending until "commit" is called (once written), or
+    "rollback" (if write failed, so that they are written next time).
+
+    If "path" is set, cache is loaded from this file, and saved by "save".
+    """
+
+    def __init__(self, fields=None, keep_days=__DYNAMO_WRITE_SKIP_CACHE__["keep_days"],
+                 path=__DYNAMO_WRITE_SKIP_CACHE__["path"]):
+        self.fields = list(fields or __DYNAMO_WRITE_SKIP_CACHE__["fields"])
+        self.keep_days = keep_days
+        self.path = path
+        self.counters = Counter()
+        self._days = {}
+        self._pending = {}
+        if self.path:
+            self._load()
+
+    def _load(self):
+        if not path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                days = pickle.load(f)
+            assert isinstance(days, dict)
+        except Exception as e:
+            logger.warning("Cannot load write cache %s: %s", self.path, e)
+            return
+        self._days = days
+        logger.info("Loaded write cache of %d entries from %s", len(self), self.path)
+
+    def save(self):
+        """
+        Writes cache on disk (if path is set).
+        """
+        if not self.path:
+            return
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self._days, f, protocol=pickle.HIGHEST_PROTOCOL)
+        replace(tmp_path, self.path)
+
+    def _hash(self, item):
+        values = "\x1f".join(
+            str(getattr(item, field, None)) for field in self.fields)
+        return hashlib.blake2b(values.encode("utf-8"), digest_size=8).digest()
+
+    def filter(self, items):
+        """
+        Generator of items that changed (or are new) since last commit.
+
+        :param items: items with station_id and day_train_num attributes
+        :type items: iterable of RealTimeDeparture
+        """
+        for item in items:
+            day = item.day_train_num.split("_", 1)[0]
+            key = (item.station_id, item.day_train_num)
+            digest = self._hash(item)
+            self.counters["checked"] += 1
+            if self._days.get(day, {}).get(key) == digest:
+                self.counters["skipped"] += 1
+                continue
+            self._pending[key] = (day, digest)
+            yield item
+
+    def commit(self):
+        for key, (day, digest) in self._pending.items():
+            self._days.setdefault(day, {})[key] = digest
+        self._pending = {}
+
+    def rollback(self):
+        self._pending = {}
+
+    def evict(self, today=None):
+        """
+        Drops entries of days older than "keep_days" before today.
+
+        :param today: day in "%Y%m%d" format, default to current day in
+        Paris (as departures days).
+        :type today: str
+        """
+        today = datetime.strptime(today, "%Y%m%d") if today\
+            else get_paris_local_datetime_now()
+        limit = (today - timedelta(days=self.keep_days)).strftime("%Y%m%d")
+        for day in [day for day in self._days if day < limit]:
+            del self._days[day]
+
+    def skipped_ratio(self):
+        if not self.counters["checked"]:
+            return 0.
+        return self.counters["skipped"] / self.counters["checked"]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._days.values())
+
+    def __repr__(self):
+        return "<WriteSkipCache(entries='%s', days='%s', path='%s')>"\
+            % (len(self), sorted(self._days), self.path)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class DynamoBatchWriter:
+    """ Writes pynamodb model instances in their table with BatchWriteItem
+    requests of at most 25 items, sent concurrently by a small thread pool.
+
+    - items rejected by Dynamo (UnprocessedItems, or throttling errors) are
+    sent again after a jittered exponential backoff.
+    - requests are paced to "write_capacity" write units per second (an item
+    smaller than 1KB consumes one unit), so that the table provisioned
+    throughput is not exceeded.
+
+    Counters ("saved", "batches", "retries", "throttled", "failed",
+    "latency" in seconds) are returned by each write call, and accumulated in
+    "counters" attribute.
+
+    The low-level connection can be provided (for instance a local stand-in):
+    it must have a pynamodb-like "batch_write_item(put_items=...)" method.
+    """
+
+    def __init__(self, model, write_capacity=None, workers=__DYNAMO_BATCH_WRITE__["workers"],
+                 batch_size=_MAX_BATCH_SIZE, max_retries=__DYNAMO_BATCH_WRITE__["max_retries"],
+                 base_backoff=__DYNAMO_BATCH_WRITE__["base_backoff"],
+                 max_backoff=__DYNAMO_BATCH_WRITE__["max_backoff"], connection=None):
+
+        assert 0 < batch_size <= _MAX_BATCH_SIZE
+        self.model = model
+        self.table_name = model.Meta.table_name
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.pacer = CapacityPacer(write_capacity) if write_capacity else None
+        self.counters = Counter()
+        self._connection = connection
+        self._executor = None
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = self.model._get_connection()
+        return self._connection
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _backoff(self, retry_counter):
+        # "Full jitter": avoids retries of all threads at the same time
+        return random.uniform(
+            0, min(self.max_backoff, self.base_backoff * 2 ** retry_counter))
+
+    def _write_batch(self, put_items):
+        """
+        Sends one batch until all its items are processed, or max retries is
+        reached. Returns a Counter.
+        """
+        stats = Counter()
+        retries = 0
+        while put_items:
+            if self.pacer:
+                self.pacer.acquire(len(put_items))
+            begin = time.monotonic()
+            try:
+                data = self._get_connection().batch_write_item(put_items=put_items)
+            except PutError as e:
+                code = _error_code(e)
+                if code not in _THROTTLING_ERRORS:
+                    raise
+                stats["throttled"] += 1
+                unprocessed = put_items
+            else:
+                unprocessed = [
+                    item["PutRequest"]["Item"] for item in
+                    (data or {}).get("UnprocessedItems", {}).get(self.table_name, [])
+                ]
+                if unprocessed:
+                    stats["throttled"] += 1
+            finally:
+                stats["latency"] += time.monotonic() - begin
+
+            stats["batches"] += 1
+            stats["saved"] += len(put_items) - len(unprocessed)
+            put_items = unprocessed
+            if not put_items:
+                break
+            if retries >= self.max_retries:
+                logger.error(
+                    "%d items not written in %s after %d retries",
+                    len(put_items), self.table_name, retries
+                )
+                stats["failed"] += len(put_items)
+                break
+            retries += 1
+            stats["retries"] += 1
+            time.sleep(self._backoff(retries))
+        return stats
+
+    def _iter_batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(_serialized_attributes(item))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def write(self, items):
+        """
+        Writes items (an iterable of model instances, possibly a generator),
+        and returns a Counter of this call. Items are serialized lazily: at
+        most two batches per worker are pending at a time.
+
+        :param items: items to save
+        :type items: iterable of pynamodb Model instances
+
+        :rtype: Counter
+        """
+        executor = self._get_executor()
+        stats = Counter()
+        pending = set()
+
+        def collect(done):
+            for future in done:
+                stats.update(future.result())
+
+        try:
+            for batch in self._iter_batches(items):
+                if len(pending) >= 2 * self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(self._write_batch, batch))
+        finally:
+            # Waits for pending batches, even if an error occurred
+            done, _ = wait(pending)
+            try:
+                collect(done)
+            finally:
+                self.counters.update(stats)
+        return stats
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return "<DynamoBatchWriter(table='%s', workers='%s', pacer='%s')>"\
+            % (self.table_name, self.workers, self.pacer)
+
+    def __str__(self):
+        return self.__repr__()
@@ -3,24 +3,31 @@ Module containing some useful functions that might be used by all other
 modules.
 """
 
-from os import sys, path, listdir, rmdir, remove, makedirs
+from os import sys, path, listdir, rmdir, remove, makedirs, walk, stat, replace
 from os.path import isfile, join
 import logging
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
 from dateutil.tz import tzlocal
 import pytz
 from datetime import datetime, timedelta
+from functools import lru_cache
 from urllib.parse import quote_plus
 
 import numpy as np
 import pandas as pd
 import boto3
+from boto3.s3.transfer import TransferConfig
 
 from api_etl.settings import (
     __DATA_PATH__, __RESPONDING_STATIONS_PATH__,
     __ALL_STATIONS_PATH__, __TOP_STATIONS_PATH__,
     __SCHEDULED_STATIONS_PATH__, __LOGS_PATH__,
-    __STATIONS_PER_LINE_PATH__
+    __STATIONS_PER_LINE_PATH__, __DATE_PARSING_CACHE__, __S3_SYNC__,
+    __S3_TRANSFER__
 )
 from api_etl.utils_secrets import get_secret
 
@@ -139,6 +146,171 @@ class StationProvider:
         return list(station_ids)
 
 
+def dt_to_special_datetime(dt):
+    """
+    Returns (special_date, special_time) strings of a datetime: dates between
+    0 and 3 AM are transformed in +24h time format with day as previous day.
+
+    :param dt: datetime to convert
+    :type dt: datetime
+
+    :rtype: tuple of str ("20170215", "25:26:00")
+    """
+    # For hours between 00:00:00 and 02:59:59: we add 24h and say it
+    # is from the day before
+    if dt.hour in (0, 1, 2):
+        # say this train is departed the day before
+        special_dt = dt - timedelta(days=1)
+        # +24: 01:44:00 -> 25:44:00
+        return special_dt.strftime("%Y%m%d"), "%s:%s" % (dt.hour + 24, dt.strftime("%M:%S"))
+    return dt.strftime("%Y%m%d"), dt.strftime("%H:%M:%S")
+
+
+@lru_cache(maxsize=__DATE_PARSING_CACHE__["maxsize"])
+def parse_api_date(api_date):
+    """
+    Parses an api date ("16/02/2017 01:26"). Memoized.
+
+    :rtype: datetime
+    """
+    return datetime.strptime(api_date, "%d/%m/%Y %H:%M")
+
+
+@lru_cache(maxsize=__DATE_PARSING_CACHE__["maxsize"])
+def api_date_to_special_datetime(api_date):
+    """
+    Returns (special_date, special_time) strings of an api date
+    ("16/02/2017 01:26" -> ("20170215", "25:26:00")). Memoized.
+
+    :rtype: tuple of str
+    """
+    return dt_to_special_datetime(parse_api_date(api_date))
+
+
+@lru_cache(maxsize=__DATE_PARSING_CACHE__["maxsize"])
+def parse_special_datetime(special_date, special_time, force_regular_date=False):
+    """
+    Parses a special date and time ("20170215", "25:26:00") to a datetime: 25h
+    is 01h the day after, unless "force_regular_date" is set. Memoized.
+
+    :rtype: datetime
+    """
+    hour = special_time[:2]
+    assert (0 <= int(hour) < 29)
+    add_day = False
+    if int(hour) in (24, 25, 26, 27):
+        hour = str(int(hour) - 24)
+        add_day = True
+    corr_sp_t = hour + special_time[2:]
+    full_str_dt = "%s%s" % (special_date, corr_sp_t)
+    dt = datetime.strptime(full_str_dt, "%Y%m%d%H:%M:%S")
+    if add_day and not force_regular_date:
+        dt = dt + timedelta(days=1)
+    return dt
+
+
+@lru_cache(maxsize=__DATE_PARSING_CACHE__["maxsize"])
+def special_time_to_seconds(special_time):
+    """
+    Converts a special time to the number of seconds since midnight of its
+    service day ("25:26:00" -> 91560). Hours go up to 27.
+
+    :param special_time: special time
+    :type special_time: str
+
+    :rtype: int
+    """
+    hours, minutes, seconds = special_time.split(":")
+    hours = int(hours)
+    if not 0 <= hours < 28:
+        raise ValueError("Invalid special time %s" % special_time)
+    return hours * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def seconds_to_special_time(seconds):
+    """
+    Converts a number of seconds since service day midnight to a special time
+    (91560 -> "25:26:00").
+
+    :param seconds: seconds since service day midnight
+    :type seconds: int
+
+    :rtype: str
+    """
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+_DATE_PARSING_CACHED = (
+    parse_api_date, api_date_to_special_datetime, parse_special_datetime,
+    special_time_to_seconds
+)
+
+
+def date_parsing_cache_info():
+    """
+    Returns hits, misses and size of memoized date parsing functions.
+
+    :rtype: dict of dicts
+    """
+    info = {}
+    for func in _DATE_PARSING_CACHED:
+        cache_info = func.cache_info()
+        info[func.__name__] = {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "size": cache_info.currsize,
+            "maxsize": cache_info.maxsize,
+        }
+    return info
+
+
+def clear_date_parsing_caches():
+    for func in _DATE_PARSING_CACHED:
+        func.cache_clear()
+
+
+def special_datetime_to_seconds(special_date, special_time, service_date=None):
+    """
+    Converts a special datetime to the number of seconds since midnight of
+    another service day (by default its own service day), so that special
+    datetimes of different days can be compared by integer subtraction.
+
+    :param special_date: special date ("20170215")
+    :type special_date: str
+
+    :param special_time: special time ("25:26:00")
+    :type special_time: str
+
+    :param service_date: reference service day ("20170215")
+    :type service_date: str
+
+    :rtype: int
+    """
+    seconds = special_time_to_seconds(special_time)
+    if service_date and service_date != special_date:
+        days = datetime.strptime(special_date, "%Y%m%d")\
+            - datetime.strptime(service_date, "%Y%m%d")
+        seconds += days.days * 86400
+    return seconds
+
+
+def dt_to_service_seconds(dt, service_date):
+    """
+    Returns the number of seconds between midnight of a service day and a
+    datetime: 01:26 the day after is 91560.
+
+    :param dt: datetime
+    :type dt: datetime
+
+    :param service_date: service day ("20170215")
+    :type service_date: str
+
+    :rtype: int
+    """
+    return int((dt - datetime.strptime(service_date, "%Y%m%d")).total_seconds())
+
+
 class DateConverter:
     """Class to convert dates from and to our special format, from and to api
     date format, and to and from our regular format:
@@ -185,7 +357,7 @@ class DateConverter:
 
     def _api_date_to_dt(self):
         assert self.api_date
-        self.dt = datetime.strptime(self.api_date, "%d/%m/%Y %H:%M")
+        self.dt = parse_api_date(self.api_date)
 
     def _normal_datetime_to_dt(self):
         assert (self.normal_date and self.normal_time)
@@ -195,18 +367,8 @@ class DateConverter:
 
     def _special_datetime_to_dt(self, force_regular_date):
         assert(self.special_date and self.special_time)
-        hour = self.special_time[:2]
-        assert (0 <= int(hour) < 29)
-        add_day = False
-        if int(hour) in (24, 25, 26, 27):
-            hour = str(int(hour) - 24)
-            add_day = True
-        corr_sp_t = hour + self.special_time[2:]
-        full_str_dt = "%s%s" % (self.special_date, corr_sp_t)
-        dt = datetime.strptime(full_str_dt, "%Y%m%d%H:%M:%S")
-        if add_day and not force_regular_date:
-            dt = dt + timedelta(days=1)
-        self.dt = dt
+        self.dt = parse_special_datetime(
+            self.special_date, self.special_time, bool(force_regular_date))
 
     def _dt_to_special_datetime(self):
         """
@@ -214,18 +376,7 @@ class DateConverter:
         day as previous day.
         """
         assert self.dt
-        # For hours between 00:00:00 and 02:59:59: we add 24h and say it
-        # is from the day before
-        if self.dt.hour in (0, 1, 2):
-            # say this train is departed the day before
-            special_dt = self.dt - timedelta(days=1)
-            self.special_date = special_dt.strftime("%Y%m%d")
-            # +24: 01:44:00 -> 25:44:00
-            self.special_time = "%s:%s" % (
-                self.dt.hour + 24, self.dt.strftime("%M:%S"))
-        else:
-            self.special_date = self.dt.strftime("%Y%m%d")
-            self.special_time = self.dt.strftime("%H:%M:%S")
+        self.special_date, self.special_time = dt_to_special_datetime(self.dt)
 
     def compute_delay_from(
         self, dc=None, dt=None, api_date=None, normal_date=None,
@@ -260,6 +411,191 @@ class DateConverter:
         return time_delta.total_seconds()
 
 
+# Vectorized date conversions: same conventions as DateConverter, applied on
+# whole columns (pandas Series) at once. Invalid or missing values are
+# converted to NaT/NaN.
+
+def _on_distinct_values(values, func):
+    """
+    Applies a vectorized conversion (returning a Series or a DataFrame) only
+    on distinct values, then broadcasts results: columns of a day contain at
+    most a few thousand distinct dates and times.
+    """
+    values = pd.Series(values)
+    codes, uniques = pd.factorize(values)
+    results = func(pd.Series(uniques))
+    # missing values have code -1: reindex gives NaN/NaT
+    results = results.reset_index(drop=True).reindex(codes)
+    results.index = values.index
+    return results
+
+
+def api_dates_to_datetimes(api_dates):
+    """
+    Converts api dates ("16/02/2017 01:26") to datetimes.
+
+    :param api_dates: api dates
+    :type api_dates: pandas Series of str
+
+    :rtype: pandas Series of datetime64
+    """
+    return _on_distinct_values(
+        api_dates,
+        lambda x: pd.to_datetime(x, format="%d/%m/%Y %H:%M", errors="coerce")
+    )
+
+
+def _special_times_to_timedeltas(special_times):
+    # distinct values are never missing, but column can be fully missing
+    special_times = special_times.astype(str)
+    hours = pd.to_numeric(special_times.str.slice(0, 2), errors="coerce")
+    deltas = pd.to_timedelta(special_times, errors="coerce")
+    # Hours above 27 are not valid special times
+    deltas[hours >= 28] = pd.NaT
+    return deltas
+
+
+def special_datetimes_to_datetimes(special_dates, special_times, force_regular_date=False):
+    """
+    Converts special dates ("20170215") and special times ("25:26:00") to
+    datetimes: hours from 24 to 27 are on next day, unless
+    "force_regular_date" is set (then 25:26:00 is 01:26:00 on special date).
+
+    :param special_dates: special dates, either one for all times, or one
+    per time.
+    :type special_dates: str OR pandas Series of str
+
+    :param special_times: special times
+    :type special_times: pandas Series of str
+
+    :param force_regular_date: same as in DateConverter.
+    :type force_regular_date: boolean
+
+    :rtype: pandas Series of datetime64
+    """
+    special_times = pd.Series(special_times)
+    if isinstance(special_dates, str):
+        days = pd.Timestamp(datetime.strptime(special_dates, "%Y%m%d"))
+    else:
+        days = _on_distinct_values(
+            pd.Series(special_dates, index=special_times.index),
+            lambda x: pd.to_datetime(x, format="%Y%m%d", errors="coerce")
+        )
+
+    deltas = _on_distinct_values(special_times, _special_times_to_timedeltas)
+    if force_regular_date:
+        deltas = deltas % pd.Timedelta(days=1)
+    return days + deltas
+
+
+def special_times_to_seconds(special_times):
+    """
+    Vectorized special_time_to_seconds.
+
+    :param special_times: special times
+    :type special_times: pandas Series of str
+
+    :rtype: pandas Series of float (NaN if invalid or missing)
+    """
+    return _on_distinct_values(
+        special_times,
+        lambda x: _special_times_to_timedeltas(x).dt.total_seconds()
+    )
+
+
+def special_datetimes_to_seconds(special_dates, special_times, service_date):
+    """
+    Vectorized special_datetime_to_seconds.
+
+    :param special_dates: special dates
+    :type special_dates: pandas Series of str
+
+    :param special_times: special times
+    :type special_times: pandas Series of str
+
+    :param service_date: reference service day ("20170215")
+    :type service_date: str
+
+    :rtype: pandas Series of float (NaN if invalid or missing)
+    """
+    special_times = pd.Series(special_times)
+    reference = pd.Timestamp(datetime.strptime(service_date, "%Y%m%d"))
+    day_offsets = _on_distinct_values(
+        pd.Series(special_dates, index=special_times.index),
+        lambda x: (pd.to_datetime(x, format="%Y%m%d", errors="coerce")
+                   - reference).dt.total_seconds()
+    )
+    return special_times_to_seconds(special_times) + day_offsets
+
+
+def service_seconds_to_datetimes(seconds, service_date):
+    """
+    Converts seconds since service day midnight to datetimes.
+
+    :param seconds: seconds since service day midnight
+    :type seconds: pandas Series of float
+
+    :param service_date: service day ("20170215")
+    :type service_date: str
+
+    :rtype: pandas Series of datetime64
+    """
+    return pd.Timestamp(datetime.strptime(service_date, "%Y%m%d"))\
+        + pd.to_timedelta(seconds, unit="s")
+
+
+def _datetimes_to_special_strings(datetimes):
+    # Day starts at 3 AM in special format
+    special_days = (datetimes - pd.Timedelta(hours=3)).dt.normalize()
+    seconds = (datetimes - special_days).dt.total_seconds()
+    valid = seconds.notnull()
+    seconds = seconds[valid].astype(int)
+
+    special = pd.DataFrame(
+        np.nan, index=datetimes.index, columns=["date", "time"], dtype=object)
+    special.loc[valid, "date"] = special_days[valid].dt.strftime("%Y%m%d")
+    special.loc[valid, "time"] = (seconds // 3600).map("{:02d}".format)\
+        + (seconds % 3600 // 60).map(":{:02d}".format)\
+        + (seconds % 60).map(":{:02d}".format)
+    return special
+
+
+def datetimes_to_special_datetimes(datetimes):
+    """
+    Converts datetimes to special dates ("20170215") and special times
+    ("25:26:00"): dates between 0 and 3 AM are transformed in +24h time format
+    with day as previous day.
+
+    :param datetimes: datetimes
+    :type datetimes: pandas Series of datetime64
+
+    :rtype: tuple of pandas Series of str (special_dates, special_times)
+    """
+    special = _on_distinct_values(datetimes, _datetimes_to_special_strings)
+    return special["date"], special["time"]
+
+
+def compute_delays(datetimes, from_datetimes):
+    """
+    Vectorized DateConverter.compute_delay_from: returns in seconds the delay:
+    - positive if datetimes > from_datetimes (delayed)
+    - negative if datetimes < from_datetimes (advance)
+
+    :param datetimes: datetimes
+    :type datetimes: pandas Series of datetime64 OR datetime
+
+    :param from_datetimes: datetimes compared to
+    :type from_datetimes: pandas Series of datetime64 OR datetime
+
+    :rtype: pandas Series of float (NaN if one datetime is missing)
+    """
+    if isinstance(datetimes, datetime):
+        return -compute_delays(from_datetimes, datetimes)
+    # Division by one second is exact, Series.dt.total_seconds is not on
+    # all pandas versions
+    return (pd.Series(datetimes) - from_datetimes) / np.timedelta64(1, "s")
+
+
 def get_paris_local_datetime_now(tz_naive=True):
     """
     Return paris local time (necessary for operations operated on other time
@@ -317,11 +653,28 @@ def s3_ressource():
 
 
 class S3Bucket:
+    """ Transfers of files to and from a bucket.
+
+    Files are transferred with boto3 managed transfers: files bigger than
+    "multipart_threshold" are split in parts of "part_size" bytes, sent or
+    received by "threads" threads. Batch operations (send_files,
+    download_files) transfer several files at a time, and return counters
+    of files, bytes and seconds (also accumulated in "counters").
+    """
 
-    def __init__(self, name, create_if_absent=False):
+    def __init__(self, name, create_if_absent=False, part_size=__S3_TRANSFER__["part_size"],
+                 threads=__S3_TRANSFER__["threads"],
+                 multipart_threshold=__S3_TRANSFER__["multipart_threshold"]):
         self._s3 = s3_ressource()
         self.bucket_name = name
         self._selected_bucket_objects_keys = []
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=part_size,
+            max_concurrency=threads,
+            use_threads=threads > 1
+        )
+        self.counters = Counter()
         self._check_if_accessible()
         if create_if_absent and not self._accessible:
             self._create_bucket()
@@ -365,13 +718,36 @@ class S3Bucket:
 
         logger.info("Saving file '%s', as '%s' in bucket '%s'." %
                     (file_local_path, file_remote_path, self.bucket_name))
-        self._s3.Object(self.bucket_name, file_remote_path)\
-            .put(Body=open(file_local_path, 'rb'))
+        self._upload_one(file_local_path, file_remote_path)
 
         if delete:
             remove(file_local_path)
 
-    def send_folder(self, folder_local_path, folder_remote_path=None, delete=False, ignore_hidden=True):
+    def send_files(self, files, delete=False, workers=__S3_TRANSFER__["batch_workers"]):
+        """
+        Sends several files, "workers" at a time.
+
+        :param files: local paths (remote names relative to data folder), or
+        (local path, remote name) tuples.
+        :type files: list
+        :param delete: delete local files once sent
+        :param workers: number of files transferred at a time
+
+        :return: Counter of "files", "bytes" and "seconds"
+        :rtype: Counter
+        """
+        jobs = [
+            (f, path.relpath(f, start=__DATA_PATH__)) if isinstance(f, str) else tuple(f)
+            for f in files
+        ]
+        stats = self._batch(self._upload_one, jobs, workers, "sent")
+        if delete:
+            for file_local_path, _ in jobs:
+                remove(file_local_path)
+        return stats
+
+    def send_folder(self, folder_local_path, folder_remote_path=None, delete=False, ignore_hidden=True,
+                    sync=False, workers=__S3_SYNC__["workers"]):
         """Will keep same names for files inside folder.
 
         Note: in S3, there is no folder, just files with names as path.
@@ -379,6 +755,9 @@ class S3Bucket:
         :param folder_remote_path:
         :param delete:
         :param ignore_hidden:
+        :param sync: if True, only files that are new or changed since last
+        synchronization are sent, by "workers" threads (see sync_upload).
+        :param workers:
         """
         # if no new name specified, use existing name
         if not folder_remote_path:
@@ -389,6 +768,11 @@ class S3Bucket:
             if folder_name.startswith("."):
                 return None
 
+        if sync:
+            assert not delete
+            return self.sync_upload(
+                folder_local_path, folder_remote_path, workers=workers, ignore_hidden=ignore_hidden)
+
         logger.info("Saving folder '%s', as '%s' in bucket '%s'." %
                     (folder_local_path, folder_remote_path, self.bucket_name))
 
@@ -437,15 +821,36 @@ class S3Bucket:
             if file_name.startswith("."):
                 return None
         logger.info("Download of '%s' as '%s'." % (file_remote_key, file_local_path))
-        self.bucket.download_file(Key=file_remote_key, Filename=file_local_path)
+        self._download_one(file_remote_key, file_local_path)
+
+    def download_files(self, keys, local_folder_root=None, workers=__S3_TRANSFER__["batch_workers"]):
+        """
+        Downloads several objects, "workers" at a time, in local folder
+        according to key hierarchy.
+
+        :param keys: keys of objects
+        :type keys: list of str
+        :param local_folder_root: default to data folder
+        :param workers: number of files transferred at a time
+
+        :return: Counter of "files", "bytes" and "seconds"
+        :rtype: Counter
+        """
+        local_folder_root = local_folder_root or __DATA_PATH__
+        jobs = [(key, path.join(local_folder_root, key)) for key in keys]
+        return self._batch(self._download_one, jobs, workers, "downloaded")
 
 
-    def download_folder(self, remote_prefix=None, local_folder_root=None, ignore_hidden=True):
+    def download_folder(self, remote_prefix=None, local_folder_root=None, ignore_hidden=True,
+                        sync=False, workers=__S3_SYNC__["workers"]):
         """
         Everything is saved in data folder, according to key hierarchy.
 
         :param remote_prefix:
         :param ignore_hidden:
+        :param sync: if True, only objects that are new or changed since last
+        synchronization are downloaded (see sync_download).
+        :param workers: number of files transferred at a time
         :return:
         """
 
@@ -456,20 +861,231 @@ class S3Bucket:
 
         local_folder_root = local_folder_root or path.join(__DATA_PATH__, "downloads")
 
+        if sync:
+            return self.sync_download(remote_prefix, local_folder_root, workers=workers)
+
         # check all files in <remote_prefix> (key beginning with <remote_prefix>)
         # if None, takes everything in bucket
         keys_to_download = self.list_bucket_objects(prefix=remote_prefix)
 
-        # download
-        for key in keys_to_download:
+        # download, several files at a time
+        return self.download_files(
+            [key for key in keys_to_download if not key.endswith("/")],
+            local_folder_root=local_folder_root, workers=workers
+        )
+
+
+    def list_bucket_objects_states(self, prefix=None):
+        """
+        Returns ETag and size of objects, per key.
+
+        :rtype: dict
+        """
+        if not prefix:
+            objects_summaries = self.bucket.objects.all()
+        else:
+            objects_summaries = self.bucket.objects.filter(Prefix=prefix)
+        return {
+            obj.key: {"etag": obj.e_tag, "size": obj.size}
+            for obj in objects_summaries
+        }
+
+    def _manifest_path(self, local_folder):
+        return path.join(local_folder, __S3_SYNC__["manifest_name"] % self.bucket_name)
+
+    def _load_manifest(self, local_folder):
+        """
+        Manifest holds, per key, the state of local file and remote object
+        when they were last known identical: {"etag", "size", "mtime"}.
+        """
+        try:
+            with open(self._manifest_path(local_folder)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, local_folder, manifest):
+        makedirs(local_folder, exist_ok=True)
+        manifest_path = self._manifest_path(local_folder)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        replace(manifest_path + ".tmp", manifest_path)
+
+    @staticmethod
+    def _local_state(file_path):
+        try:
+            file_stat = stat(file_path)
+        except OSError:
+            return None
+        return {"size": file_stat.st_size, "mtime": file_stat.st_mtime}
+
+    @staticmethod
+    def _local_unchanged(entry, local_state):
+        return local_state is not None and entry.get("size") == local_state["size"]\
+            and entry.get("mtime") == local_state["mtime"]
+
+    def _transfer(self, function, jobs, workers, on_result=None):
+        """
+        Runs function on each job (tuple of args) with a pool of threads,
+        and returns results, in jobs order.
+
+        If on_result is given, it is called with (job, result) of each
+        successful job, even if others fail: first error is then raised once
+        all jobs are over.
+        """
+        if on_result is None:
+            if workers <= 1 or len(jobs) <= 1:
+                return [function(*job) for job in jobs]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(function, *job) for job in jobs]
+                return [future.result() for future in futures]
+
+        results = []
+        error = None
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(function, *job) for job in jobs]
+            for job, future in zip(jobs, futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("Transfer of %s failed: %s", job[0], e)
+                    error = error or e
+                    continue
+                on_result(job, result)
+                results.append(result)
+        if error is not None:
+            raise error
+        return results
+
+    def _batch(self, function, jobs, workers, action):
+        begin = time.monotonic()
+        local_states = self._transfer(function, jobs, workers)
+        stats = Counter(
+            files=len(jobs),
+            bytes=sum(state["size"] for state in local_states),
+            seconds=time.monotonic() - begin
+        )
+        self.counters.update(stats)
+        logger.info("%d files %s (bucket '%s'): %.1f MB in %.1fs (%.1f MB/s)." %
+                    (stats["files"], action, self.bucket_name, stats["bytes"] / 1e6,
+                     stats["seconds"], self.throughput(stats)))
+        return stats
+
+    @staticmethod
+    def throughput(stats):
+        """Throughput in MB per second of transfers counters."""
+        if not stats["seconds"]:
+            return 0.
+        return stats["bytes"] / 1e6 / stats["seconds"]
+
+    def _download_one(self, key, file_local_path):
+        makedirs(path.dirname(file_local_path) or ".", exist_ok=True)
+        # boto3 clients (not resources) can be shared by threads
+        self._s3.meta.client.download_file(
+            self.bucket_name, key, file_local_path, Config=self.transfer_config)
+        return self._local_state(file_local_path)
+
+    def _upload_one(self, file_local_path, key):
+        local_state = self._local_state(file_local_path)
+        self._s3.meta.client.upload_file(
+            file_local_path, self.bucket_name, key, Config=self.transfer_config)
+        return local_state
+
+    def sync_download(self, remote_prefix, local_folder_root, workers=__S3_SYNC__["workers"]):
+        """
+        Downloads objects under prefix (in local_folder_root, according to
+        key hierarchy), only if they are new, changed in S3 (ETag or size),
+        or missing/changed locally (size or mtime) since last
+        synchronization.
+
+        :return: Counter of "transferred", "skipped" files, and "bytes"
+        transferred.
+        :rtype: Counter
+        """
+        stats = Counter()
+        manifest = self._load_manifest(local_folder_root)
+        remote_states = self.list_bucket_objects_states(prefix=remote_prefix)
+
+        jobs = []
+        for key, remote_state in sorted(remote_states.items()):
+            if key.endswith("/"):
+                continue
             file_local_path = path.join(local_folder_root, key)
-            file_dir = path.dirname(file_local_path)
-            if not path.exists(file_dir):
-                logger.info("Creating directory %s" % file_dir)
-                makedirs(file_dir)
+            entry = manifest.get(key, {})
+            if entry.get("etag") == remote_state["etag"]\
+                    and self._local_unchanged(entry, self._local_state(file_local_path)):
+                stats["skipped"] += 1
+                continue
+            jobs.append((key, file_local_path))
+
+        def on_result(job, local_state):
+            key = job[0]
+            manifest[key] = dict(local_state, etag=remote_states[key]["etag"])
+            stats["transferred"] += 1
+            stats["bytes"] += remote_states[key]["size"]
 
-            self.download_file(file_remote_key=key, file_local_path=file_local_path)
+        try:
+            self._transfer(self._download_one, jobs, workers, on_result=on_result)
+        finally:
+            # Completed downloads are not done again if others failed
+            self._save_manifest(local_folder_root, manifest)
+        logger.info("Synchronized '%s' from bucket '%s': %d files downloaded, %d unchanged." %
+                    (remote_prefix, self.bucket_name, stats["transferred"], stats["skipped"]))
+        return stats
+
+    def sync_upload(self, folder_local_path, folder_remote_path, workers=__S3_SYNC__["workers"],
+                    ignore_hidden=True):
+        """
+        Sends files of local folder (recursively) under remote prefix, only
+        if they are new, changed locally (size or mtime), or missing/changed
+        in S3 (ETag) since last synchronization.
 
+        :return: Counter of "transferred", "skipped" files, and "bytes"
+        transferred.
+        :rtype: Counter
+        """
+        stats = Counter()
+        manifest = self._load_manifest(folder_local_path)
+        remote_states = self.list_bucket_objects_states(prefix=folder_remote_path)
+        manifest_name = path.basename(self._manifest_path(folder_local_path))
+
+        jobs = []
+        for root, dirs, files in walk(folder_local_path):
+            if ignore_hidden:
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for file_name in sorted(files):
+                if file_name == manifest_name or (ignore_hidden and file_name.startswith(".")):
+                    continue
+                file_local_path = join(root, file_name)
+                key = "/".join(
+                    [folder_remote_path.rstrip("/")]
+                    + path.relpath(file_local_path, folder_local_path).split(path.sep)
+                )
+                entry = manifest.get(key, {})
+                remote_state = remote_states.get(key)
+                if remote_state is not None and entry.get("etag") == remote_state["etag"]\
+                        and self._local_unchanged(entry, self._local_state(file_local_path)):
+                    stats["skipped"] += 1
+                    continue
+                jobs.append((file_local_path, key))
+
+        uploaded = []
+        try:
+            self._transfer(self._upload_one, jobs, workers,
+                           on_result=lambda job, local_state: uploaded.append((job[1], local_state)))
+        finally:
+            # Completed uploads are not done again if others failed
+            if uploaded:
+                # ETags of uploaded objects
+                remote_states = self.list_bucket_objects_states(prefix=folder_remote_path)
+            for key, local_state in uploaded:
+                manifest[key] = dict(local_state, etag=remote_states.get(key, {}).get("etag"))
+                stats["transferred"] += 1
+                stats["bytes"] += local_state["size"]
+            self._save_manifest(folder_local_path, manifest)
+        logger.info("Synchronized '%s' in bucket '%s': %d files sent, %d unchanged." %
+                    (folder_local_path, self.bucket_name, stats["transferred"], stats["skipped"]))
+        return stats
 
     def __repr__(self):
         return "<S3Bucket(name='%s', accessible='%s')>"\
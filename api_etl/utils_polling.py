@@ -0,0 +1,359 @@
+"""
+Module used to decide which stations are requested to Transilien's API, and
+when, based on scheduled passages (GTFS).
+"""
+
+import logging
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, Counter
+
+from api_etl.utils_misc import (
+    get_paris_local_datetime_now, dt_to_special_datetime,
+    dt_to_service_seconds, special_time_to_seconds
+)
+from api_etl.querier_schedule import schedule_querier
+from api_etl.settings import (
+    __ADAPTIVE_POLLING__, __PASSAGE_POLLING__, __API_RATE_LIMIT__
+)
+
+logger = logging.getLogger(__name__)
+
+
+def service_day_and_seconds(dt):
+    """
+    Returns service day ("20170215") of a datetime, and number of seconds
+    since this service day midnight: 01:26 the 16th is ("20170215", 91560).
+
+    :rtype: tuple (str, int)
+    """
+    day, _ = dt_to_special_datetime(dt)
+    return day, dt_to_service_seconds(dt, day)
+
+
+class StationSchedule:
+    """ Scheduled passages of each station on a service day, as sorted
+    numbers of seconds since service day midnight.
+
+    Stations are stored in 7 digits (gtfs) format, but can be queried in 7
+    or 8 digits (api) format.
+    """
+
+    def __init__(self, day, passages):
+        self.day = day
+        self.passages = {
+            station: sorted(seconds) for station, seconds in passages.items()
+        }
+
+    @classmethod
+    def from_departure_times(cls, day, departure_times):
+        """
+        :param departure_times: (stop_id, departure_time) of stoptimes.
+        :type departure_times: iterable of tuples
+        """
+        passages = defaultdict(list)
+        for stop_id, departure_time in departure_times:
+            try:
+                seconds = special_time_to_seconds(departure_time)
+            except (ValueError, AttributeError):
+                continue
+            # "StopPoint:DUA8727100" -> "8727100"
+            passages[stop_id[-7:]].append(seconds)
+        return cls(day, passages)
+
+    @classmethod
+    def from_db(cls, day=None):
+        """
+        Loads schedule of given day (default to current service day) from
+        relational database.
+        """
+        day = day or service_day_and_seconds(get_paris_local_datetime_now())[0]
+        departure_times = schedule_querier(scheduled_day=day).departure_times()
+        schedule = cls.from_departure_times(day, departure_times)
+        logger.info("Loaded schedule of %d stations for day %s",
+                    len(schedule), day)
+        return schedule
+
+    def seconds_to_next_passage(self, station, since_seconds):
+        """
+        Returns number of seconds between "since_seconds" and next
+        scheduled passage in station (at or after "since_seconds"), None if
+        there is none.
+
+        :param station: station in 7 or 8 digits format.
+        :type station: str
+
+        :param since_seconds: seconds since service day midnight.
+        :type since_seconds: int
+        """
+        passages = self.passages.get(str(station)[:7])
+        if not passages:
+            return None
+        i = bisect_left(passages, since_seconds)
+        if i == len(passages):
+            return None
+        return passages[i] - since_seconds
+
+    def count_passages(self, station, after_seconds, until_seconds):
+        """
+        Returns number of scheduled passages in station in
+        ]after_seconds, until_seconds].
+        """
+        passages = self.passages.get(str(station)[:7], [])
+        return bisect_right(passages, until_seconds) - bisect_right(passages, after_seconds)
+
+    def __len__(self):
+        return len(self.passages)
+
+    def __repr__(self):
+        return "<StationSchedule(day='%s', stations='%s')>"\
+            % (self.day, len(self))
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class AdaptivePollingScheduler:
+    """ Selects, at each extraction cycle, which stations are requested:
+    - stations with a scheduled passage in the next "imminent_horizon"
+    seconds (or in the last "late_margin" seconds, since trains can be
+    delayed) are requested at every cycle.
+    - other stations are requested every "idle_interval" seconds.
+    - stations that answered without departure to "unresponsive_after"
+    consecutive requests while passages were imminent are requested every
+    "unresponsive_interval" seconds only, until they give departures again
+    (failed requests are not counted).
+
+    Requests per cycle are bounded by the API quota: if more stations are
+    due, the ones with the closest passages come first, then the most
+    overdue ones.
+
+    If no schedule is available, all stations are requested at every cycle.
+    """
+
+    def __init__(self, stations, schedule=None, max_per_minute=__API_RATE_LIMIT__["max_per_minute"],
+                 cycle_seconds=__ADAPTIVE_POLLING__["cycle_seconds"],
+                 imminent_horizon=__ADAPTIVE_POLLING__["imminent_horizon"],
+                 late_margin=__ADAPTIVE_POLLING__["late_margin"],
+                 idle_interval=__ADAPTIVE_POLLING__["idle_interval"],
+                 unresponsive_after=__ADAPTIVE_POLLING__["unresponsive_after"],
+                 unresponsive_interval=__ADAPTIVE_POLLING__["unresponsive_interval"]):
+
+        self.stations = list(map(str, stations))
+        self.schedule = schedule
+        self.max_per_minute = max_per_minute
+        self.cycle_seconds = cycle_seconds
+        self.imminent_horizon = imminent_horizon
+        self.late_margin = late_margin
+        self.idle_interval = idle_interval
+        self.unresponsive_after = unresponsive_after
+        self.unresponsive_interval = unresponsive_interval
+
+        self.counters = Counter()
+        self._last_poll = {}
+        self._empty_polls = Counter()
+        self._imminent = set()
+
+    @property
+    def budget(self):
+        """Maximum number of stations requested per cycle."""
+        return int(self.max_per_minute * self.cycle_seconds / 60)
+
+    def _seconds_to_passage(self, station, now_seconds):
+        """
+        Seconds until next passage not older than "late_margin" (negative if
+        passed), None if none is left on service day.
+        """
+        to_next = self.schedule.seconds_to_next_passage(
+            station, now_seconds - self.late_margin)
+        if to_next is None:
+            return None
+        return to_next - self.late_margin
+
+    def _poll_interval(self, station, to_passage):
+        if self.schedule is None:
+            return self.cycle_seconds
+        if to_passage is None or to_passage > self.imminent_horizon:
+            return self.idle_interval
+        if self._empty_polls[station] >= self.unresponsive_after:
+            return self.unresponsive_interval
+        return self.cycle_seconds
+
+    def select(self, now=None):
+        """
+        Returns stations to request in this cycle, and marks them as
+        requested.
+
+        :param now: datetime (Paris time, naive), default to now.
+        :type now: datetime
+
+        :rtype: list of str
+        """
+        now = now or get_paris_local_datetime_now()
+        _, now_seconds = service_day_and_seconds(now)
+
+        due = []
+        imminent = set()
+        for station in self.stations:
+            to_passage = None
+            if self.schedule is not None:
+                to_passage = self._seconds_to_passage(station, now_seconds)
+            interval = self._poll_interval(station, to_passage)
+            if interval == self.cycle_seconds:
+                imminent.add(station)
+
+            last_poll = self._last_poll.get(station)
+            if last_poll is not None:
+                elapsed = (now - last_poll).total_seconds()
+                # Cycles are not exactly "cycle_seconds" apart
+                if elapsed + self.cycle_seconds / 2 < interval:
+                    continue
+                overdue = elapsed / interval
+            else:
+                overdue = float("inf")
+
+            if station in imminent:
+                priority = (0, to_passage if to_passage is not None else 0)
+            else:
+                priority = (1, -overdue)
+            due.append((priority, station))
+
+        due.sort()
+        selected = [station for _, station in due[:self.budget]]
+        for station in selected:
+            self._last_poll[station] = now
+        self._imminent = imminent
+
+        self.counters["cycles"] += 1
+        self.counters["selected"] += len(selected)
+        self.counters["deferred"] += len(due) - len(selected)
+        logger.info(
+            "Adaptive polling: %d stations selected out of %d (%d with "
+            "imminent passages, %d deferred for quota)",
+            len(selected), len(self.stations), len(imminent),
+            len(due) - len(selected)
+        )
+        return selected
+
+    def record(self, departures_per_station, statuses):
+        """
+        Updates stations states after a cycle. Only stations that answered
+        (status 200) without departure count as empty polls: failed requests
+        (API errors, timeouts) do not change stations states.
+
+        :param departures_per_station: number of departures received per
+        station.
+        :type departures_per_station: dict
+
+        :param statuses: HTTP status of each station requested in this cycle
+        (None if no answer was received).
+        :type statuses: dict
+        """
+        for station, status in statuses.items():
+            if departures_per_station.get(station, 0):
+                self._empty_polls[station] = 0
+            elif status != 200:
+                self.counters["failed_polls"] += 1
+            elif station in self._imminent:
+                self._empty_polls[station] += 1
+
+    def set_schedule(self, schedule):
+        self.schedule = schedule
+
+    def __repr__(self):
+        return "<AdaptivePollingScheduler(stations='%s', schedule='%s', budget='%s')>"\
+            % (len(self.stations), self.schedule, self.budget)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class PassagePoller:
+    """ Heap of stations ordered by their next useful poll time: "lead"
+    seconds before their next scheduled passage (and at least "min_interval"
+    after their previous poll).
+
+    Each poll covers passages up to "lead" seconds after it: the next poll
+    is planned for the first passage that is not covered yet. Stations with
+    no passage left on the service day leave the heap.
+
+    Times are in seconds since service day midnight.
+    """
+
+    def __init__(self, schedule, stations, lead=__PASSAGE_POLLING__["lead"],
+                 min_interval=__PASSAGE_POLLING__["min_interval"]):
+        self.schedule = schedule
+        self.lead = lead
+        self.min_interval = min_interval
+        self.counters = Counter()
+        # Api needs 8 digits stations, schedule is in 7 digits
+        self._stations = {str(station)[:7]: str(station) for station in stations}
+        self._covered_until = {}
+        self._heap = []
+
+    def start(self, now_seconds):
+        """
+        Plans first poll of each station, for passages not passed yet.
+        """
+        self._heap = []
+        for station in self._stations:
+            self._covered_until[station] = now_seconds - 1
+            self._plan(station, now_seconds)
+        heapq.heapify(self._heap)
+
+    def _plan(self, station, now_seconds, push=False):
+        covered_until = self._covered_until[station]
+        to_next = self.schedule.seconds_to_next_passage(station, covered_until + 1)
+        if to_next is None:
+            return
+        poll_at = max(
+            covered_until + 1 + to_next - self.lead,
+            now_seconds + self.min_interval if push else now_seconds
+        )
+        if push:
+            heapq.heappush(self._heap, (poll_at, station))
+        else:
+            self._heap.append((poll_at, station))
+
+    def next_poll_seconds(self):
+        """Time of next planned poll, None if no poll is planned."""
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now_seconds, max_count=None):
+        """
+        Returns stations (8 digits) whose poll time has come, at most
+        "max_count" (most late first), and plans their next poll.
+
+        :rtype: list of str
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now_seconds:
+            if max_count is not None and len(due) >= max_count:
+                break
+            _, station = heapq.heappop(self._heap)
+            covered_until = now_seconds + self.lead
+            self.counters["polls"] += 1
+            self.counters["passages"] += self.schedule.count_passages(
+                station, self._covered_until[station], covered_until)
+            self._covered_until[station] = covered_until
+            self._plan(station, now_seconds, push=True)
+            due.append(self._stations[station])
+        # Due stations left for next call (quota)
+        self.counters["deferred"] += sum(
+            1 for poll_at, _ in self._heap if poll_at <= now_seconds)
+        return due
+
+    def polls_per_passage(self):
+        if not self.counters["passages"]:
+            return 0.
+        return self.counters["polls"] / self.counters["passages"]
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __repr__(self):
+        return "<PassagePoller(schedule='%s', planned='%s', lead='%s')>"\
+            % (self.schedule, len(self), self.lead)
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,293 @@
+"""
+Module used to load GTFS files in relational databases with their native bulk
+path (COPY for Postgres, executemany for others), through staging tables
+swapped in a single transaction, along with tables computed from them.
+"""
+
+from os import path
+from collections import Counter
+import io
+import logging
+import uuid
+
+import pandas as pd
+from sqlalchemy import MetaData, Table, Column, PrimaryKeyConstraint, inspect
+from sqlalchemy.schema import AddConstraint
+from sqlalchemy.sql import text
+
+from api_etl.utils_misc import get_paris_local_datetime_now
+from api_etl.utils_rdb_migration import typed_stop_times_values
+from api_etl.utils_calendar import ServiceCalendar
+from api_etl.utils_trip_extents import TripExtents
+from api_etl.data_models import (
+    Agency, Route, Trip, StopTime, Stop, Calendar, CalendarDate, ServiceDay,
+    TripExtent, ScheduleVersion
+)
+from api_etl.settings import __GTFS_FOLDER_PATH__, __GTFS_BULK_LOAD__
+
+logger = logging.getLogger(__name__)
+
+# GTFS files, and models they are saved as in relational database
+GTFS_TABLES = [
+    ("agency.txt", Agency),
+    ("routes.txt", Route),
+    ("trips.txt", Trip),
+    ("stops.txt", Stop),
+    ("stop_times.txt", StopTime),
+    ("calendar.txt", Calendar),
+    ("calendar_dates.txt", CalendarDate)
+]
+
+_STAGING_SUFFIX = "_staging"
+
+
+def read_gtfs_file(folder, name, chunksize=None):
+    """
+    Reads GTFS file values as they are written (str), missing values as
+    "nan".
+
+    :param chunksize: if set, returns an iterator of dataframes of chunksize
+    rows
+    :rtype: pandas DataFrame, or iterator of DataFrames
+    """
+    reader = pd.read_csv(path.join(folder, name), dtype=str, chunksize=chunksize)
+    if chunksize is None:
+        return reader.fillna("nan")
+    return (chunk.fillna("nan") for chunk in reader)
+
+
+class GtfsBulkLoader:
+    """ Loads GTFS files in relational database:
+
+    - each file is streamed by chunks in a staging table (without indexes),
+    with COPY on Postgres, and executemany on other databases (SQLite)
+    - tables computed from loaded ones (services active per day, trips
+    extents) are loaded in staging tables the same way
+    - then, in a single transaction, former tables are dropped, staging
+    tables are renamed, indexes (and foreign keys on Postgres) are created,
+    and a new schedule version is recorded (see ScheduleVersion): readers
+    see either former or new schedule.
+
+    Rows with same primary key are saved once (last one).
+    """
+
+    def __init__(self, provider=None, folder=__GTFS_FOLDER_PATH__,
+                 chunksize=__GTFS_BULK_LOAD__["chunksize"]):
+        if provider is None:
+            from api_etl.utils_rdb import rdb_provider as provider
+        self.provider = provider
+        self.folder = folder
+        self.chunksize = chunksize
+        self.engine = provider.get_engine()
+        self.postgres = self.engine.dialect.name == "postgresql"
+
+    def _staging_table(self, model):
+        """
+        Staging table with model's columns. On Postgres, primary key is added
+        after load (see _deduplicate).
+        """
+        table = model.__table__
+        columns = [Column(column.name, column.type) for column in table.columns]
+        constraints = []
+        if not self.postgres:
+            constraints.append(PrimaryKeyConstraint(
+                *[column.name for column in table.primary_key.columns]))
+        return Table(table.name + _STAGING_SUFFIX, MetaData(), *(columns + constraints))
+
+    def _chunks(self, name, model):
+        """Chunks of file, with model's columns only (and typed columns)."""
+        model_columns = [column.name for column in model.__table__.columns]
+        for chunk in read_gtfs_file(self.folder, name, chunksize=self.chunksize):
+            missing = [column.name for column in model.__table__.primary_key.columns
+                       if column.name not in chunk.columns]
+            if missing:
+                raise ValueError("%s misses primary key columns %s." % (name, missing))
+            if model is StopTime:
+                for column, values in typed_stop_times_values(chunk).items():
+                    # Kept as objects: with None, ints would become floats
+                    chunk[column] = pd.Series(values, index=chunk.index, dtype=object)
+            chunk = chunk[[column for column in model_columns if column in chunk.columns]]
+            yield chunk.astype(object).where(chunk.notnull(), None)
+
+    def _copy(self, connection, staging, chunk):
+        """Postgres COPY of chunk, as csv (NULL as unquoted empty values)."""
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, header=False, index=False)
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            "COPY %s (%s) FROM STDIN WITH (FORMAT csv)"
+            % (staging.name, ", ".join(chunk.columns)),
+            buffer
+        )
+
+    def _insert(self, connection, staging, chunk):
+        """Executemany of chunk, replacing rows with same primary key."""
+        connection.execute(
+            staging.insert().prefix_with("OR REPLACE"),
+            chunk.to_dict(orient="records")
+        )
+
+    def _deduplicate(self, connection, staging, model):
+        """Postgres: removes rows with same primary key, adds primary key."""
+        keys = [column.name for column in model.__table__.primary_key.columns]
+        connection.execute(text(
+            "DELETE FROM %(t)s a USING %(t)s b WHERE a.ctid < b.ctid AND %(keys)s" % {
+                "t": staging.name,
+                "keys": " AND ".join("a.%s = b.%s" % (k, k) for k in keys)
+            }))
+        connection.execute(text(
+            "ALTER TABLE %s ADD CONSTRAINT %s_pkey PRIMARY KEY (%s)"
+            % (staging.name, staging.name, ", ".join(keys))))
+
+    def _load_chunks(self, model, chunks):
+        """
+        Loads chunks in model's staging table (created again).
+
+        :return: staging table, and number of rows read
+        """
+        staging = self._staging_table(model)
+        staging.drop(self.engine, checkfirst=True)
+        staging.create(self.engine)
+        rows = 0
+        with self.engine.begin() as connection:
+            for chunk in chunks:
+                if self.postgres:
+                    self._copy(connection, staging, chunk)
+                else:
+                    self._insert(connection, staging, chunk)
+                rows += len(chunk)
+            if self.postgres:
+                self._deduplicate(connection, staging, model)
+        return staging, rows
+
+    def load_staging(self, name, model):
+        """
+        Loads file in model's staging table (created again).
+
+        :return: number of rows read
+        """
+        staging, rows = self._load_chunks(model, self._chunks(name, model))
+        logger.info("Loaded %d rows of %s in %s.", rows, name, staging.name)
+        return rows
+
+    def load_derived(self, models):
+        """
+        Loads in staging tables the tables computed from models being loaded:
+        services active per day (from calendars, read from staging tables if
+        they are loaded), and trips extents (from files).
+
+        :param models: models whose staging tables are loaded
+        :return: number of rows per computed table
+        :rtype: Counter
+        """
+        def table_name(model):
+            return model.__tablename__ + (_STAGING_SUFFIX if model in models else "")
+
+        derived = []
+        if any(model in (Calendar, CalendarDate) for model in models):
+            calendar = ServiceCalendar.from_rdb(
+                self.provider, table_name(Calendar), table_name(CalendarDate))
+            derived.append((ServiceDay, calendar.frames(self.chunksize)))
+        if any(model in (Route, Trip, StopTime) for model in models):
+            extents = TripExtents.from_folder(self.folder)
+            derived.append((TripExtent, extents.frames(self.chunksize)))
+
+        rows = Counter()
+        for model, frames in derived:
+            staging, rows[model.__tablename__] = self._load_chunks(
+                model, (frame.astype(object) for frame in frames))
+            logger.info("Loaded %d computed rows in %s.",
+                        rows[model.__tablename__], staging.name)
+        return rows
+
+    def swap(self, models):
+        """
+        Replaces tables of models by their staging tables, and records a new
+        schedule version, in one transaction.
+        """
+        with self.engine.begin() as connection:
+            if self.engine.dialect.name == "sqlite":
+                # pysqlite does not open transactions before DDL statements
+                connection.exec_driver_sql("BEGIN")
+            existing = set(inspect(connection).get_table_names())
+            for model in models:
+                table = model.__table__
+                if table.name in existing:
+                    connection.execute(text("DROP TABLE %s%s" % (
+                        table.name, " CASCADE" if self.postgres else "")))
+                connection.execute(text("ALTER TABLE %s%s RENAME TO %s" % (
+                    table.name, _STAGING_SUFFIX, table.name)))
+                if self.postgres:
+                    connection.execute(text("ALTER INDEX %s%s_pkey RENAME TO %s_pkey" % (
+                        table.name, _STAGING_SUFFIX, table.name)))
+                for index in table.indexes:
+                    index.create(connection)
+            if self.postgres:
+                self._restore_foreign_keys(connection)
+            self._record_version(connection, models)
+
+    @staticmethod
+    def _record_version(connection, models):
+        """Adds a row in schedule versions table (created if missing)."""
+        ScheduleVersion.__table__.create(connection, checkfirst=True)
+        version = uuid.uuid4().hex
+        connection.execute(ScheduleVersion.__table__.insert().values(
+            version=version,
+            loaded_at=get_paris_local_datetime_now(),
+            tables=",".join(model.__tablename__ for model in models)
+        ))
+        return version
+
+    @staticmethod
+    def _restore_foreign_keys(connection):
+        """
+        Postgres: creates foreign keys of schedule tables dropped with
+        former tables.
+        """
+        inspector = inspect(connection)
+        tables = set(inspector.get_table_names())
+        for _, model in GTFS_TABLES:
+            table = model.__table__
+            if table.name not in tables:
+                continue
+            existing = {
+                tuple(fk["constrained_columns"])
+                for fk in inspector.get_foreign_keys(table.name)
+            }
+            for constraint in table.foreign_key_constraints:
+                if tuple(constraint.column_keys) in existing:
+                    continue
+                if constraint.referred_table.name in tables:
+                    connection.execute(AddConstraint(constraint))
+
+    def load(self, tables=None, derived=True):
+        """
+        Loads GTFS files (default all) in staging tables, and tables computed
+        from them (see load_derived), then swaps them.
+
+        :param tables: subset of GTFS_TABLES, as (file name, model) tuples
+        :param derived: whether computed tables are replaced too
+        :return: number of rows per table
+        :rtype: Counter
+        """
+        tables = tables or GTFS_TABLES
+        models = [model for _, model in tables]
+        rows = Counter()
+        for name, model in tables:
+            rows[model.__tablename__] = self.load_staging(name, model)
+        if derived:
+            loaded = self.load_derived(models)
+            rows.update(loaded)
+            models += [model for model in (ServiceDay, TripExtent)
+                       if model.__tablename__ in loaded]
+        self.swap(models)
+        logger.info("Schedule tables replaced: %s.", dict(rows))
+        return rows
+
+    def __repr__(self):
+        return "<GtfsBulkLoader(folder='%s', dialect='%s')>"\
+            % (self.folder, self.engine.dialect.name)
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,161 @@
+"""
+Module used to migrate schedule tables of relational databases created by
+earlier versions: typed columns and indexes are added to existing tables,
+and typed columns are computed from GTFS string values.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect, Integer
+from sqlalchemy.sql import func, cast, text, case
+
+from api_etl.utils_misc import special_times_to_seconds
+from api_etl.data_models import (
+    Agency, Route, Trip, StopTime, Stop, Calendar, CalendarDate
+)
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_MODELS = [Agency, Route, Trip, Stop, StopTime, Calendar, CalendarDate]
+
+# Typed columns computed from GTFS columns: (typed column, GTFS column, kind)
+TYPED_COLUMNS = [
+    (StopTime.stop_sequence_number, StopTime.stop_sequence, "integer"),
+    (StopTime.arrival_seconds, StopTime.arrival_time, "time"),
+    (StopTime.departure_seconds, StopTime.departure_time, "time"),
+]
+
+
+def seconds_expression(column):
+    """
+    SQL expression converting a "H:MM:SS" (or "HH:MM:SS") time column to
+    seconds since service day midnight, for both Postgres and SQLite.
+    """
+    length = func.length(column)
+    hours = cast(func.substr(column, 1, length - 6), Integer)
+    minutes = cast(func.substr(column, length - 4, 2), Integer)
+    seconds = cast(func.substr(column, length - 1, 2), Integer)
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _valid_and_value(column, kind):
+    """
+    SQL condition of valid GTFS values of column, and expression of their
+    typed value ("time" or "integer" kind, see TYPED_COLUMNS).
+    """
+    if kind == "time":
+        return column.like("%:__:__"), seconds_expression(column)
+    return column.notin_(["", "nan", "None"]), cast(column, Integer)
+
+
+def typed_expression(column, kind):
+    """
+    SQL expression of typed value of a GTFS string column, computed as in
+    backfill_typed_columns: NULL if value is not valid.
+    """
+    valid, value = _valid_and_value(column, kind)
+    return case((valid, value), else_=None)
+
+
+def typed_stop_times_values(stop_times):
+    """
+    Computes typed columns of stop times (see TYPED_COLUMNS) in python, with
+    None for invalid values.
+
+    :param stop_times: stop times (GTFS columns, as str)
+    :type stop_times: pandas DataFrame
+
+    :return: values per typed column
+    :rtype: dict of lists
+    """
+    typed = {}
+    for typed_column, column, kind in TYPED_COLUMNS:
+        if kind == "time":
+            values = special_times_to_seconds(stop_times[column.key])
+        else:
+            values = pd.to_numeric(stop_times[column.key], errors="coerce")
+        typed[typed_column.key] = [
+            None if np.isnan(value) else int(value) for value in values.values
+        ]
+    return typed
+
+
+def upgrade_schedule_schema(provider=None):
+    """
+    Creates missing schedule tables, and adds missing columns and indexes to
+    existing ones. Safe to run several times.
+
+    :return: names of added columns and indexes
+    :rtype: list of str
+    """
+    if provider is None:
+        from api_etl.utils_rdb import rdb_provider as provider
+    engine = provider.get_engine()
+    inspector = inspect(engine)
+    added = []
+
+    for model in SCHEDULE_MODELS:
+        table = model.__table__
+        if not inspector.has_table(table.name):
+            table.create(engine)
+            added.append(table.name)
+            continue
+
+        existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+        with engine.begin() as connection:
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                connection.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    table.name, column.name, column.type.compile(dialect=engine.dialect))))
+                added.append("%s.%s" % (table.name, column.name))
+
+        existing_indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+                added.append(index.name)
+
+    if added:
+        logger.info("Schedule schema upgraded: added %s.", ", ".join(added))
+    return added
+
+
+def backfill_typed_columns(provider=None):
+    """
+    Computes typed columns (see TYPED_COLUMNS) of rows where they are not
+    set yet. Values that are not valid integers or times are left NULL.
+
+    :return: number of updated values per typed column
+    :rtype: dict
+    """
+    if provider is None:
+        from api_etl.utils_rdb import rdb_provider as provider
+    engine = provider.get_engine()
+    updated = {}
+    with engine.begin() as connection:
+        for typed_column, column, kind in TYPED_COLUMNS:
+            valid, value = _valid_and_value(column, kind)
+            table = typed_column.class_.__table__
+            result = connection.execute(
+                table.update()
+                .where(table.c[typed_column.key].is_(None))
+                .where(valid)
+                .values({typed_column.key: value})
+            )
+            updated[typed_column.key] = result.rowcount
+        # Statistics for query planner
+        connection.execute(text("ANALYZE"))
+    logger.info("Typed columns computed: %s.", updated)
+    return updated
+
+
+def migrate_schedule_schema(provider=None):
+    """
+    Upgrades schema, then computes typed columns.
+    """
+    added = upgrade_schedule_schema(provider)
+    updated = backfill_typed_columns(provider)
+    return added, updated
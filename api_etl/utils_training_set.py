@@ -0,0 +1,416 @@
+"""
+Module used to store training sets (and raw days they are computed from) in
+a columnar format (Parquet), instead of pickles.
+
+Training sets are partitioned by day and line, so that loading some days of
+one line only reads files of these days and line, and only requested
+columns.
+"""
+
+from os import path, makedirs, listdir, replace, rename
+from glob import glob
+from shutil import rmtree
+import json
+import logging
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from api_etl.settings import (
+    __TRAINING_SET_FOLDER_PATH__, __RAW_DAYS_FOLDER_PATH__,
+    __TRAINING_ARRAYS_FOLDER_PATH__
+)
+
+logger = logging.getLogger(__name__)
+
+# Partitions: "day=20170215/line=C/"
+_PARTITIONING = ds.partitioning(
+    pa.schema([("day", pa.string()), ("line", pa.string())]), flavor="hive")
+_DATA_FILE = "data.parquet"
+_LINE_COLUMN = "Route_route_short_name_ix"
+_UNKNOWN_LINE = "other"
+# Schema metadata key holding names of index columns
+_INDEX_METADATA_KEY = b"training_set_index"
+
+# Identifiers with few distinct values: stored as dictionaries, loaded as
+# categories (as well as their "_ix" index copies)
+CATEGORY_COLUMNS = [
+    "Route_route_short_name", "RealTime_miss", "Trip_trip_id", "Stop_stop_id",
+    "Stop_stop_name"
+]
+
+
+def typed_training_set(df):
+    """
+    Returns dataframe with compact types: identifiers as categories, floats
+    (delays, features, labels) as float32.
+
+    :param df: training set, without index
+    :type df: pandas DataFrame
+
+    :rtype: pandas DataFrame
+    """
+    df = df.copy()
+    for col in df.columns:
+        base_col = col[:-3] if col.endswith("_ix") else col
+        if base_col in CATEGORY_COLUMNS:
+            df[col] = df[col].astype(str).where(df[col].notnull()).astype("category")
+        elif df[col].dtype == "float64":
+            df[col] = df[col].astype("float32")
+    return df
+
+
+def _arrow_compatible(df):
+    """
+    Object columns mixing types (for instance str and int) cannot be
+    converted to arrow: their values are converted to str.
+    """
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df[col] = df[col].astype(str).where(df[col].notnull())
+    return df
+
+
+def _write_table(table, file_path):
+    makedirs(path.dirname(file_path), exist_ok=True)
+    tmp_path = path.join(path.dirname(file_path), "_%s" % path.basename(file_path))
+    pq.write_table(table, tmp_path)
+    replace(tmp_path, file_path)
+
+
+def save_raw_day(df, day, folder=__RAW_DAYS_FOLDER_PATH__):
+    """
+    Saves raw day dataframe (schedule and realtime data of a day) in
+    "<folder>/<day>.parquet", and returns its path.
+    """
+    file_path = path.join(folder, "%s.parquet" % day)
+    _write_table(pa.Table.from_pandas(_arrow_compatible(df)), file_path)
+    return file_path
+
+
+def load_raw_day(day, folder=__RAW_DAYS_FOLDER_PATH__):
+    """
+    Loads raw day dataframe, from Parquet file or legacy pickle.
+    """
+    file_path = path.join(folder, "%s.parquet" % day)
+    if path.isfile(file_path):
+        return pq.read_table(file_path).to_pandas()
+    return pd.read_pickle(path.join(folder, "%s.pickle" % day))
+
+
+class TrainingSetStore:
+    """ Training sets of a given tempo, stored by day and line:
+
+    root/day=20170215/line=C/data.parquet
+
+    Columns are typed (see typed_training_set), and index columns ("_ix"
+    suffix) are restored as index when loaded.
+
+    Legacy pickled training sets ("root/20170215.pickle") are still loaded
+    for days that have no Parquet partition.
+    """
+
+    def __init__(self, tempo=30, root=None):
+        self.tempo = tempo
+        self.root = root or __TRAINING_SET_FOLDER_PATH__ % tempo
+
+    def _partition_path(self, day, line):
+        return path.join(self.root, "day=%s" % day, "line=%s" % line, _DATA_FILE)
+
+    def save_day(self, df, day):
+        """
+        Saves training set of a day, one file per line, and returns paths of
+        written files.
+
+        :param df: training set of day (as built by DirectPredictionMatrix)
+        :type df: pandas DataFrame
+        :param day: day in "%Y%m%d" format
+        :type day: str
+
+        :rtype: list of str
+        """
+        # Features and identifiers columns overlap
+        df = df.loc[:, ~df.columns.duplicated()]
+        index_columns = [name for name in df.index.names if name is not None]
+        df = typed_training_set(df.reset_index() if index_columns else df)
+
+        if _LINE_COLUMN in df.columns:
+            lines = df[_LINE_COLUMN].astype(object).fillna(_UNKNOWN_LINE)
+        else:
+            lines = pd.Series(_UNKNOWN_LINE, index=df.index)
+
+        written = []
+        for line, line_df in df.groupby(lines.values, sort=True):
+            table = pa.Table.from_pandas(line_df, preserve_index=False)
+            metadata = dict(table.schema.metadata or {})
+            metadata[_INDEX_METADATA_KEY] = json.dumps(index_columns).encode()
+            table = table.replace_schema_metadata(metadata)
+            file_path = self._partition_path(day, line)
+            _write_table(table, file_path)
+            written.append(file_path)
+        logger.info("Saved training set of day %s (%d rows) in %d files",
+                    day, len(df), len(written))
+        return written
+
+    def days(self):
+        """Days available (Parquet or legacy pickle), sorted."""
+        if not path.isdir(self.root):
+            return []
+        days = set()
+        for name in listdir(self.root):
+            if name.startswith("day="):
+                days.add(name.split("=", 1)[1])
+            elif name.endswith(".pickle"):
+                days.add(path.splitext(name)[0])
+        return sorted(days)
+
+    def _files(self, days, lines):
+        # Partitions pruned from directory names: other files are not opened
+        files = []
+        for file_path in sorted(glob(path.join(self.root, "day=*", "line=*", _DATA_FILE))):
+            line_dir = path.dirname(file_path)
+            day = path.basename(path.dirname(line_dir)).split("=", 1)[1]
+            line = path.basename(line_dir).split("=", 1)[1]
+            if (days is None or day in days) and (lines is None or line in lines):
+                files.append(file_path)
+        return files
+
+    def _load_legacy(self, days, lines, columns):
+        parquet_days = {
+            name.split("=", 1)[1] for name in listdir(self.root) if name.startswith("day=")
+        }
+        dataframes = []
+        for file_path in sorted(glob(path.join(self.root, "*.pickle"))):
+            day = path.splitext(path.basename(file_path))[0]
+            if day in parquet_days or (days is not None and day not in days):
+                continue
+            df = pd.read_pickle(file_path)
+            df = df.loc[:, ~df.columns.duplicated()]
+            if lines is not None and _LINE_COLUMN in df.index.names:
+                df = df[df.index.get_level_values(_LINE_COLUMN).isin(lines)]
+            if columns is not None:
+                df = df[[col for col in columns if col in df.columns]]
+            dataframes.append(df)
+        return dataframes
+
+    def load(self, days=None, lines=None, columns=None, filter=None):
+        """
+        Loads training sets of given days and lines.
+
+        :param days: days in "%Y%m%d" format, default all
+        :type days: list of str
+        :param lines: lines, default all
+        :type lines: list of str
+        :param columns: value columns to load, default all (index columns
+        are always loaded)
+        :type columns: list of str
+        :param filter: additional predicate, pushed down to Parquet scan
+        (not applied to legacy pickles)
+        :type filter: pyarrow.dataset.Expression
+
+        :rtype: pandas DataFrame
+        """
+        if not path.isdir(self.root):
+            return pd.DataFrame(columns=columns)
+        days = set(days) if days is not None else None
+        lines = set(lines) if lines is not None else None
+
+        dataframes = []
+        files = self._files(days, lines)
+        if files:
+            dataset = ds.dataset(
+                files, format="parquet", partitioning=_PARTITIONING,
+                partition_base_dir=self.root)
+            index_columns = json.loads(
+                (dataset.schema.metadata or {}).get(_INDEX_METADATA_KEY, b"[]"))
+            if columns is not None:
+                available = set(dataset.schema.names)
+                columns = [col for col in columns if col not in index_columns]
+                projection = [col for col in index_columns + columns if col in available]
+            else:
+                projection = [col for col in dataset.schema.names if col not in ("day", "line")]
+            df = dataset.to_table(columns=projection, filter=filter).to_pandas()
+            if index_columns:
+                df = df.set_index(index_columns)
+            dataframes.append(df)
+
+        legacy = self._load_legacy(days, lines, columns)
+        dataframes += legacy
+        if not dataframes:
+            return pd.DataFrame(columns=columns)
+        logger.info("Loaded training sets from %d Parquet files and %d pickles",
+                    len(files), len(legacy))
+        return pd.concat(dataframes) if len(dataframes) > 1 else dataframes[0]
+
+    def __repr__(self):
+        return "<TrainingSetStore(tempo='%s', root='%s')>" % (self.tempo, self.root)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class TrainingArrayCache:
+    """ Cache of training sets as NumPy arrays, one folder per day and line:
+
+    root/20170215/C/X.npy, label.npy, naive_pred.npy, sequence_diff.npy
+
+    Arrays are memory-mapped when loaded: reading a line of a day only maps
+    its files, and pages are loaded by the OS when they are used. Cached
+    arrays are rebuilt from the TrainingSetStore when the training set file
+    changes, or when features differ.
+
+    - X: features (float32, rows x features, in "features" order)
+    - label, naive_pred ("P_naive_pred"): float32
+    - sequence_diff (from "TS_sequence_diff_ix" index): float32
+    """
+
+    _arrays = ["X", "label", "naive_pred", "sequence_diff"]
+
+    def __init__(self, features, store=None, root=None):
+        self.features = list(features)
+        self.store = store or TrainingSetStore()
+        self.root = root or __TRAINING_ARRAYS_FOLDER_PATH__ % self.store.tempo
+        self.counters = {"built": 0, "mapped": 0}
+
+    def _folder(self, day, line):
+        return path.join(self.root, day, line)
+
+    def _source_mtime(self, day, line):
+        parquet_path = self.store._partition_path(day, line)
+        if path.isfile(parquet_path):
+            return path.getmtime(parquet_path)
+        pickle_path = path.join(self.store.root, "%s.pickle" % day)
+        if path.isfile(pickle_path):
+            return path.getmtime(pickle_path)
+        return None
+
+    def _read_manifest(self, day, line):
+        try:
+            with open(path.join(self._folder(day, line), "manifest.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def build(self, day, line):
+        """
+        Builds (or rebuilds) cached arrays of a day and line from training
+        set files. Returns number of rows.
+        """
+        source_mtime = self._source_mtime(day, line)
+        df = self.store.load(
+            days=[day], lines=[line], columns=self.features + ["label", "P_naive_pred"])
+        df = df.loc[:, ~df.columns.duplicated()]
+        arrays = {
+            "X": np.ascontiguousarray(
+                df.reindex(columns=self.features).values, dtype=np.float32),
+            "label": df["label"].values.astype(np.float32),
+            "naive_pred": df["P_naive_pred"].values.astype(np.float32),
+            "sequence_diff": np.asarray(
+                df.index.get_level_values("TS_sequence_diff_ix")
+                if "TS_sequence_diff_ix" in df.index.names else np.zeros(len(df)),
+                dtype=np.float32),
+        }
+        manifest = {
+            "features": self.features, "rows": len(df), "source_mtime": source_mtime
+        }
+
+        # Written in a temporary folder, then moved: readers never see
+        # partial arrays
+        folder = self._folder(day, line)
+        tmp_folder = path.join(self.root, "_%s" % uuid.uuid4().hex)
+        makedirs(tmp_folder)
+        for name, array in arrays.items():
+            np.save(path.join(tmp_folder, "%s.npy" % name), array)
+        with open(path.join(tmp_folder, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        if path.isdir(folder):
+            rmtree(folder)
+        makedirs(path.dirname(folder), exist_ok=True)
+        rename(tmp_folder, folder)
+        self.counters["built"] += 1
+        logger.debug("Built training arrays of %s line %s (%d rows)", day, line, len(df))
+        return len(df)
+
+    def _ensure(self, day, line):
+        """Returns number of rows of up to date cache, None if no data."""
+        source_mtime = self._source_mtime(day, line)
+        if source_mtime is None:
+            return None
+        manifest = self._read_manifest(day, line)
+        if manifest is None or manifest["features"] != self.features\
+                or manifest["source_mtime"] != source_mtime:
+            return self.build(day, line)
+        return manifest["rows"]
+
+    def iter_arrays(self, days, line):
+        """
+        Generator of (day, arrays) for days that have training data for
+        this line: arrays is a dict of read-only memory-mapped arrays (see
+        class docstring).
+
+        :param days: days in "%Y%m%d" format
+        :type days: list of str
+        :param line: line
+        :type line: str
+        """
+        for day in days:
+            rows = self._ensure(day, line)
+            if not rows:
+                continue
+            folder = self._folder(day, line)
+            arrays = {
+                name: np.load(path.join(folder, "%s.npy" % name), mmap_mode="r")
+                for name in self._arrays
+            }
+            self.counters["mapped"] += 1
+            yield day, arrays
+
+    def load_line(self, days, line, mask_function=None):
+        """
+        Returns arrays of a line over given days, concatenated in memory:
+        output arrays are allocated once, and filled day by day from mapped
+        arrays, so that only this line's selected rows are held in memory.
+
+        :param mask_function: optional function, given a day's arrays,
+        returning a boolean mask of rows to keep.
+        :type mask_function: function
+
+        :rtype: dict of arrays
+        """
+        selections = []
+        for day, arrays in self.iter_arrays(days, line):
+            mask = mask_function(arrays) if mask_function else None
+            selections.append((arrays, mask))
+
+        total = sum(
+            len(arrays["label"]) if mask is None else int(mask.sum())
+            for arrays, mask in selections
+        )
+        result = {
+            "X": np.empty((total, len(self.features)), dtype=np.float32),
+            "label": np.empty(total, dtype=np.float32),
+            "naive_pred": np.empty(total, dtype=np.float32),
+            "sequence_diff": np.empty(total, dtype=np.float32),
+        }
+        begin = 0
+        for arrays, mask in selections:
+            end = begin + (len(arrays["label"]) if mask is None else int(mask.sum()))
+            for name in self._arrays:
+                result[name][begin:end] = arrays[name] if mask is None else arrays[name][mask]
+            begin = end
+        logger.info("Loaded %d rows of line %s from %d days of training arrays",
+                    total, line, len(selections))
+        return result
+
+    def __repr__(self):
+        return "<TrainingArrayCache(root='%s', features='%s')>" % (self.root, len(self.features))
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,145 @@
+"""
+Module used to precompute extents of trips (first departure, last arrival)
+from GTFS stop times, and to find trips rolling at a given time.
+"""
+
+from os import path
+import logging
+
+import numpy as np
+import pandas as pd
+
+from api_etl.utils_misc import special_times_to_seconds
+from api_etl.data_models import TripExtent
+from api_etl.settings import __GTFS_FOLDER_PATH__
+
+logger = logging.getLogger(__name__)
+
+EXTENT_COLUMNS = [column.key for column in TripExtent.__table__.columns]
+
+
+class TripExtents:
+    """ Extent of each trip, from its stop times sorted by stop sequence:
+    - first_departure: departure time of first stop (seconds since service
+    day midnight)
+    - last_arrival: arrival time of last stop (same)
+    - number_of_stops
+    - route_short_name (line), direction_id and service_id of trip
+
+    Trips without stop times, or without valid times, have no extent.
+    """
+
+    def __init__(self, trips, routes, stop_times):
+        """
+        :param trips: trips table (columns of Trip model)
+        :param routes: routes table (columns of Route model)
+        :param stop_times: stop times table (columns of StopTime model)
+        :type trips, routes, stop_times: pandas DataFrame
+        """
+        df = pd.DataFrame({
+            "trip_id": stop_times.trip_id.astype(str).values,
+            "sequence": pd.to_numeric(stop_times.stop_sequence, errors="coerce").values,
+            "departure": special_times_to_seconds(stop_times.departure_time.astype(str)).values,
+            "arrival": special_times_to_seconds(stop_times.arrival_time.astype(str)).values,
+        })
+        df = df[df.sequence.notnull()].sort_values(["trip_id", "sequence"])
+        first = df.drop_duplicates("trip_id", keep="first").set_index("trip_id")
+        last = df.drop_duplicates("trip_id", keep="last").set_index("trip_id")
+        extents = pd.DataFrame({
+            "first_departure": first.departure,
+            "last_arrival": last.arrival,
+            "number_of_stops": df.groupby("trip_id").size(),
+        }).dropna()
+
+        trips = trips[["trip_id", "route_id", "direction_id", "service_id"]].astype(str)
+        routes = routes[["route_id", "route_short_name"]].astype(str)
+        self.df = trips\
+            .merge(routes, on="route_id", how="left")\
+            .join(extents, on="trip_id", how="inner")
+        for column in ["first_departure", "last_arrival", "number_of_stops"]:
+            self.df[column] = self.df[column].astype(np.int32)
+        self.df = self.df[EXTENT_COLUMNS].reset_index(drop=True)
+        logger.info("Computed extents of %d trips.", len(self.df))
+
+    @classmethod
+    def from_folder(cls, folder=__GTFS_FOLDER_PATH__):
+        """
+        Computes extents from GTFS files (only needed columns are read).
+        """
+        def read(name, columns):
+            return pd.read_csv(path.join(folder, name), usecols=columns, dtype=str)
+
+        return cls(
+            read("trips.txt", ["trip_id", "route_id", "direction_id", "service_id"]),
+            read("routes.txt", ["route_id", "route_short_name"]),
+            read("stop_times.txt", ["trip_id", "arrival_time", "departure_time", "stop_sequence"])
+        )
+
+    def frames(self, chunksize):
+        """
+        Extents (columns of TripExtent model), as DataFrames of at most
+        chunksize rows.
+
+        :rtype: iterator of pandas DataFrames
+        """
+        for i in range(0, len(self.df), chunksize):
+            yield self.df.iloc[i:i + chunksize]
+
+    def __repr__(self):
+        return "<TripExtents(trips='%s')>" % len(self.df)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class TripIntervalIndex:
+    """ Interval index of trips (from first departure to last arrival): trips
+    sorted by first departure, and last arrivals sorted.
+
+    - count_at: number of trips rolling at time, with two binary searches
+    - trips_at: trips rolling at time, among trips having begun
+    """
+
+    def __init__(self, trips, first_departures, last_arrivals):
+        """
+        :param trips: trips (any identifier, such as row numbers)
+        :type trips: numpy array
+        :param first_departures: first departures of trips (seconds)
+        :type first_departures: numpy array
+        :param last_arrivals: last arrivals of trips (seconds)
+        :type last_arrivals: numpy array
+        """
+        # Trips arriving before departure are never rolling
+        valid = first_departures <= last_arrivals
+        trips, first_departures, last_arrivals = \
+            trips[valid], first_departures[valid], last_arrivals[valid]
+        order = np.argsort(first_departures, kind="stable")
+        self.trips = trips[order]
+        self.first_departures = first_departures[order]
+        self.last_arrivals = last_arrivals[order]
+        self.sorted_last_arrivals = np.sort(last_arrivals)
+
+    def count_at(self, seconds):
+        """
+        Number of trips having begun at time (first departure <= time), and
+        not yet arrived (last arrival >= time).
+        """
+        begun = np.searchsorted(self.first_departures, seconds, side="right")
+        arrived = np.searchsorted(self.sorted_last_arrivals, seconds, side="left")
+        return int(begun - arrived)
+
+    def trips_at(self, seconds):
+        """
+        Trips having begun at time, and not yet arrived, by first departure.
+        """
+        begun = np.searchsorted(self.first_departures, seconds, side="right")
+        return self.trips[:begun][self.last_arrivals[:begun] >= seconds]
+
+    def __len__(self):
+        return len(self.trips)
+
+    def __repr__(self):
+        return "<TripIntervalIndex(trips='%s')>" % len(self.trips)
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,120 @@
+"""
+Benchmark of transilien's API responses parsing: per-response parse time of
+the streaming parser (extract_api.parse_api_response) against the former
+xmltodict + DataFrame implementation of ApiExtractor._parse_response.
+
+From root directory:
+```
+python benchmarks/bench_parse_response.py --trains 30 --number 200
+```
+"""
+
+from os import sys, path
+import argparse
+import json
+import timeit
+from datetime import datetime
+
+import xmltodict
+import pandas as pd
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+from api_etl.settings import __BASE_DIR__
+from api_etl.utils_misc import DateConverter
+from api_etl.extract_api import parse_api_response
+
+pd.options.mode.chained_assignment = None
+
+STATION = "87393009"
+REQUEST_DT = datetime(2012, 5, 23, 12, 40)
+
+
+def build_response(nb_trains):
+    """
+    Builds an API answer containing nb_trains trains, some of them after
+    midnight, based on the sample answer of tests folder.
+    """
+    trains = []
+    for i in range(nb_trains):
+        hour = (12 + i // 4) % 24
+        day = 23 if hour >= 12 else 24
+        trains.append(
+            '<train><date mode="R">%s/05/2012 %02d:%02d</date>\n'
+            '<num>%s</num>\n<miss>VERI</miss>\n<term>87393843</term>\n</train>'
+            % (day, hour, (i * 7) % 60, 165303 + i)
+        )
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<passages gare="%s">\n%s\n</passages>'\
+        % (STATION, "\n".join(trains))
+
+
+def legacy_parse_response(xml_string, station, request_dt):
+    """
+    Former implementation (without saving in extractor attributes).
+    """
+    mydict = xmltodict.parse(xml_string)
+    trains = mydict["passages"]["train"]
+    df_trains = pd.DataFrame(trains)
+
+    df_trains.loc[:, "date"] = df_trains.date.apply(lambda x: x["#text"])
+    df_trains.loc[:, "dt_conv"] = df_trains["date"]\
+        .apply(lambda x: DateConverter(api_date=x))
+    df_trains.loc[:, "expected_passage_day"] = df_trains["dt_conv"]\
+        .apply(lambda x: x.special_date)
+    df_trains.loc[:, "expected_passage_time"] = df_trains["dt_conv"]\
+        .apply(lambda x: x.special_time)
+    df_trains.loc[:, "request_day"] = request_dt.strftime('%Y%m%d')
+    df_trains.loc[:, "request_time"] = request_dt.strftime('%H:%M:%S')
+    df_trains.loc[:, "station_8d"] = str(station)
+    df_trains.loc[:, "station_id"] = str(station)[:-1]
+    df_trains.rename(columns={'num': 'train_num'}, inplace=True)
+    df_trains.loc[:, "data_freshness"] = df_trains.apply(
+        lambda x: int(x["dt_conv"].compute_delay_from(dt=request_dt)), axis=1)
+    del df_trains["dt_conv"]
+    df_trains.loc[:, "day_train_num"] = df_trains.apply(
+        lambda x: "%s_%s" % (x["expected_passage_day"], x["train_num"]), axis=1)
+    df_trains = df_trains.applymap(str)
+    df_trains.drop_duplicates(subset=["day_train_num", "station_id"], inplace=True)
+
+    jsons = json.loads(df_trains.to_json(orient='records'))
+    dicts = df_trains.to_dict(orient='records')
+    return jsons, dicts
+
+
+def streaming_parse_response(xml_string, station, request_dt):
+    return list(parse_api_response(xml_string, station, request_dt))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--trains", type=int, default=30,
+                        help="number of trains per response (sample file if 0)")
+    parser.add_argument("--number", type=int, default=200,
+                        help="number of parsed responses per implementation")
+    args = parser.parse_args()
+
+    if args.trains:
+        xml_string = build_response(args.trains)
+    else:
+        with open(path.join(__BASE_DIR__, "tests", "files", "api_response.xml")) as xml_file:
+            xml_string = xml_file.read()
+
+    # Both implementations must give same records
+    _, legacy_records = legacy_parse_response(xml_string, STATION, REQUEST_DT)
+    streaming_records = streaming_parse_response(xml_string, STATION, REQUEST_DT)
+    assert len(legacy_records) == len(streaming_records)
+    for legacy, streaming in zip(legacy_records, streaming_records):
+        for key, value in streaming.items():
+            assert legacy[key] == value, (key, legacy[key], value)
+
+    print("Responses of %d trains, %d parses per implementation." % (len(streaming_records), args.number))
+    results = {}
+    for name, func in [("legacy", legacy_parse_response), ("streaming", streaming_parse_response)]:
+        total = timeit.timeit(lambda: func(xml_string, STATION, REQUEST_DT), number=args.number)
+        results[name] = total / args.number
+        print("%-10s %8.3f ms per response" % (name, 1000 * results[name]))
+    print("Speedup: x%.1f" % (results["legacy"] / results["streaming"]))
+
+
+if __name__ == '__main__':
+    main()
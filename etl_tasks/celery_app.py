@@ -8,14 +8,15 @@ from datetime import timedelta
 
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_shutdown
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
 from api_etl.settings import __LOGGING_CONFIG__, __ACCEPTED_LINES__
 from api_etl.utils_rdb import uri
-from api_etl.extract_api import operate_one_cycle
+from api_etl.extract_api import ExtractionService
 from api_etl.extract_schedule import ScheduleExtractorRDB
-from api_etl.regressor_train import RegressorTrainer
+from api_etl.regressor_train import MultiLineTrainer
 from api_etl.builder_feature_matrix import TrainingSetBuilder
 from api_etl.utils_misc import get_paris_local_datetime_now
 
@@ -55,11 +56,31 @@ app.conf.beat_schedule = {
 }
 
 
+# One extraction service per worker process: event loop and connection pool
+# are kept between two cycles.
+_extraction_service = None
+
+
+def get_extraction_service():
+    global _extraction_service
+    if _extraction_service is None:
+        logger.info("Starting extraction service.")
+        _extraction_service = ExtractionService()
+    return _extraction_service
+
+
+@worker_process_shutdown.connect
+def close_extraction_service(**kwargs):
+    if _extraction_service is not None:
+        logger.info("Closing extraction service.")
+        _extraction_service.close()
+
+
 @app.task
 def extract_api_once_all_stations(station_filter=None):
-    # Default: all stations, and max 300 queries per sec
+    # Default: all stations, and max 350 queries per minute
     logger.info("Beginning single cycle extraction")
-    operate_one_cycle(station_filter=station_filter)
+    get_extraction_service().run_cycle(station_filter=station_filter)
     return True
 
 
@@ -93,11 +114,11 @@ def train_models(lines=None):
 
     logger.info("Beginning models training for lines %s." % lines)
 
-    for line in lines:
-        logger.info("Line %s." % line)
-        rt = RegressorTrainer(line=line, auto=True, start_date="20170101", end_date="20170701", tempo=30)
-        logger.info(rt.score_pipeline())
-        rt.save_in_database()
+    # Training sets loaded once for all lines, lines trained by threads in
+    # this (daemonic) worker process
+    trainer = MultiLineTrainer(lines=lines, start_date="20170101", end_date="20170701", tempo=30)
+    trainer.train()
+    trainer.save_in_database()
 
     return True
 
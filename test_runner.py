@@ -14,7 +14,12 @@ if __name__ == '__main__':
 
 from tests import (
     test_extract_api, test_extract_schedule, test_query_schedule,
-    test_match_ids, test_utils_misc, test_utils_rdb
+    test_match_ids, test_utils_misc, test_utils_rdb, test_utils_api_client,
+    test_date_conversions, test_utils_dynamo, test_utils_polling,
+    test_utils_archive, test_utils_training_set, test_s3_bucket,
+    test_querier_memory, test_utils_calendar, test_utils_trip_extents,
+    test_utils_rdb_migration, test_utils_rdb_bulk, test_regressor_train,
+    test_querier_schedule
 )
 
 # initialize the test suite
@@ -25,11 +30,25 @@ suite = unittest.TestSuite()
 suite.addTests(loader.loadTestsFromModule(test_utils_rdb))
 suite.addTests(loader.loadTestsFromModule(test_utils_mongo))
 suite.addTests(loader.loadTestsFromModule(test_utils_misc))
+suite.addTests(loader.loadTestsFromModule(test_utils_api_client))
+suite.addTests(loader.loadTestsFromModule(test_date_conversions))
+suite.addTests(loader.loadTestsFromModule(test_utils_dynamo))
+suite.addTests(loader.loadTestsFromModule(test_utils_polling))
+suite.addTests(loader.loadTestsFromModule(test_utils_archive))
+suite.addTests(loader.loadTestsFromModule(test_utils_training_set))
+suite.addTests(loader.loadTestsFromModule(test_s3_bucket))
+suite.addTests(loader.loadTestsFromModule(test_utils_calendar))
+suite.addTests(loader.loadTestsFromModule(test_utils_trip_extents))
+suite.addTests(loader.loadTestsFromModule(test_utils_rdb_migration))
+suite.addTests(loader.loadTestsFromModule(test_utils_rdb_bulk))
 
 suite.addTests(loader.loadTestsFromModule(test_extract_api))
 suite.addTests(loader.loadTestsFromModule(test_extract_schedule))
 suite.addTests(loader.loadTestsFromModule(test_query_schedule))
+suite.addTests(loader.loadTestsFromModule(test_querier_schedule))
+suite.addTests(loader.loadTestsFromModule(test_querier_memory))
 suite.addTests(loader.loadTestsFromModule(test_match_ids))
+suite.addTests(loader.loadTestsFromModule(test_regressor_train))
 
 # initialize a runner, pass it your suite and run it
 runner = unittest.TextTestRunner(verbosity=3)
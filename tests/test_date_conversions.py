@@ -0,0 +1,173 @@
+import unittest
+import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from api_etl.utils_misc import (
+    DateConverter, api_dates_to_datetimes, special_datetimes_to_datetimes,
+    datetimes_to_special_datetimes, compute_delays, special_time_to_seconds,
+    seconds_to_special_time, special_datetime_to_seconds,
+    dt_to_service_seconds, special_times_to_seconds,
+    special_datetimes_to_seconds, service_seconds_to_datetimes,
+    date_parsing_cache_info, clear_date_parsing_caches
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TestVectorizedDateConversions(unittest.TestCase):
+    """
+    Vectorized conversions must give the same results as DateConverter.
+    """
+
+    def setUp(self):
+        self.api_dates = pd.Series([
+            "16/02/2017 01:26", "16/02/2017 12:55", "16/02/2017 03:00",
+            "15/02/2017 23:59", "16/02/2017 01:26", np.nan
+        ])
+        self.special_times = pd.Series([
+            "25:26:00", "12:55:00", "03:00:00", "23:59:00", "25:26:00",
+            "26:01:30"
+        ])
+        self.special_dates = pd.Series(
+            ["20170215", "20170216", "20170216", "20170215", "20170215",
+             np.nan]
+        )
+
+    def test_api_dates_to_datetimes(self):
+        converted = api_dates_to_datetimes(self.api_dates)
+        for api_date, dt in zip(self.api_dates[:-1], converted[:-1]):
+            self.assertEqual(dt, DateConverter(api_date=api_date).dt)
+        self.assertTrue(pd.isnull(converted.iloc[-1]))
+
+    def test_special_datetimes_to_datetimes(self):
+        converted = special_datetimes_to_datetimes(
+            self.special_dates, self.special_times)
+        for date, time, dt in zip(
+                self.special_dates[:-1], self.special_times[:-1], converted[:-1]):
+            self.assertEqual(
+                dt, DateConverter(special_date=date, special_time=time).dt)
+        self.assertTrue(pd.isnull(converted.iloc[-1]))
+
+        # Single day for all times
+        for force in [True, False]:
+            converted = special_datetimes_to_datetimes(
+                "20170215", self.special_times, force_regular_date=force)
+            for time, dt in zip(self.special_times, converted):
+                self.assertEqual(dt, DateConverter(
+                    special_date="20170215", special_time=time,
+                    force_regular_date=force).dt)
+
+        # Invalid hours
+        converted = special_datetimes_to_datetimes(
+            "20170215", pd.Series(["28:00:00", "not a time"]))
+        self.assertTrue(converted.isnull().all())
+
+    def test_datetimes_to_special_datetimes(self):
+        datetimes = api_dates_to_datetimes(self.api_dates)
+        dates, times = datetimes_to_special_datetimes(datetimes)
+        for dt, date, time in zip(datetimes[:-1], dates[:-1], times[:-1]):
+            dc = DateConverter(dt=dt)
+            self.assertEqual(date, dc.special_date)
+            self.assertEqual(time, dc.special_time)
+        self.assertTrue(pd.isnull(dates.iloc[-1]))
+        self.assertTrue(pd.isnull(times.iloc[-1]))
+
+    def test_compute_delays(self):
+        datetimes = api_dates_to_datetimes(self.api_dates)
+        now = datetime(2017, 2, 16, 2, 0)
+        delays = compute_delays(datetimes, now)
+        reverse = compute_delays(now, datetimes)
+        for dt, delay, rev in zip(datetimes[:-1], delays[:-1], reverse[:-1]):
+            expected = DateConverter(dt=dt).compute_delay_from(dt=now)
+            self.assertEqual(delay, expected)
+            self.assertEqual(rev, -expected)
+        self.assertTrue(np.isnan(delays.iloc[-1]))
+
+
+class TestServiceSeconds(unittest.TestCase):
+    """
+    Special times as integer seconds since service day midnight.
+    """
+
+    def test_special_time_to_seconds(self):
+        self.assertEqual(special_time_to_seconds("00:00:00"), 0)
+        self.assertEqual(special_time_to_seconds("25:26:00"), 91560)
+        self.assertEqual(special_time_to_seconds("27:59:59"), 100799)
+        self.assertRaises(ValueError, special_time_to_seconds, "28:00:00")
+        for time in ["03:00:00", "12:55:07", "25:26:00"]:
+            self.assertEqual(
+                seconds_to_special_time(special_time_to_seconds(time)), time)
+
+    def test_delays_match_date_converter(self):
+        cases = [
+            ("20170215", "25:26:00", "20170215", "23:50:00"),
+            ("20170216", "01:26:00", "20170215", "23:50:00"),
+            ("20170215", "12:00:00", "20170216", "12:00:00"),
+        ]
+        for rtdd, rtdt, sdd, sdt in cases:
+            expected = DateConverter(special_date=rtdd, special_time=rtdt)\
+                .compute_delay_from(special_date=sdd, special_time=sdt)
+            delay = special_datetime_to_seconds(rtdd, rtdt, service_date=sdd)\
+                - special_datetime_to_seconds(sdd, sdt)
+            self.assertEqual(delay, expected)
+
+        at_datetime = datetime(2017, 2, 16, 1, 30)
+        expected = DateConverter(dt=at_datetime)\
+            .compute_delay_from(special_date="20170215", special_time="25:26:00")
+        self.assertEqual(
+            dt_to_service_seconds(at_datetime, "20170215")
+            - special_time_to_seconds("25:26:00"),
+            expected
+        )
+
+    def test_vectorized_seconds(self):
+        times = pd.Series(["25:26:00", "12:00:00", np.nan, "28:00:00"])
+        seconds = special_times_to_seconds(times)
+        self.assertEqual(seconds.iloc[0], 91560)
+        self.assertEqual(seconds.iloc[1], 43200)
+        self.assertTrue(seconds.iloc[2:].isnull().all())
+
+        dates = pd.Series(["20170215", "20170216", "20170216", "20170215"])
+        seconds = special_datetimes_to_seconds(dates, times, "20170215")
+        self.assertEqual(seconds.iloc[0], 91560)
+        self.assertEqual(seconds.iloc[1], 86400 + 43200)
+
+        converted = service_seconds_to_datetimes(seconds, "20170215")
+        expected = special_datetimes_to_datetimes(dates, times)
+        self.assertTrue(
+            (converted[:2] == expected[:2]).all())
+        self.assertTrue(converted[2:].isnull().all())
+
+
+class TestDateParsingCache(unittest.TestCase):
+
+    def setUp(self):
+        clear_date_parsing_caches()
+
+    def test_repeated_parses_are_cache_hits(self):
+        for _ in range(3):
+            dc = DateConverter(api_date="16/02/2017 01:26")
+            self.assertEqual(dc.special_time, "25:26:00")
+            dc = DateConverter(special_date="20170215", special_time="25:26:00")
+            self.assertEqual(dc.dt, datetime(2017, 2, 16, 1, 26))
+
+        info = date_parsing_cache_info()
+        self.assertEqual(info["parse_api_date"]["misses"], 1)
+        self.assertEqual(info["parse_api_date"]["hits"], 2)
+        self.assertEqual(info["parse_special_datetime"]["misses"], 1)
+        self.assertEqual(info["parse_special_datetime"]["hits"], 2)
+
+        # force_regular_date is part of the key
+        dc = DateConverter(special_date="20170215", special_time="25:26:00",
+                           force_regular_date=True)
+        self.assertEqual(dc.dt, datetime(2017, 2, 15, 1, 26))
+
+        clear_date_parsing_caches()
+        self.assertEqual(date_parsing_cache_info()["parse_api_date"]["size"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
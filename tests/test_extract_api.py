@@ -6,16 +6,79 @@ from os import path
 import unittest
 import logging
 import json
+import threading
+from datetime import datetime
+from unittest import mock
 
 from api_etl.settings import __BASE_DIR__
-from api_etl.extract_api import xml_to_json_item_list
+from api_etl.extract_api import parse_api_response, ApiExtractor, ExtractionService
+from api_etl.utils_polling import StationSchedule
+from api_etl.utils_api_client import ApiClient, StationResponse
+from tests.test_utils_api_client import FakeSession
 
 logger = logging.getLogger(__name__)
 
 
+class RecordingWriter:
+    """
+    Stand-in for DynamoBatchWriter: records, for each item written, how many
+    responses still hold their content.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.received = None
+        self.held = []
+
+    def write(self, items):
+        self.received = items
+        saved = 0
+        for _ in items:
+            self.held.append(
+                sum(response.content is not None for response in self.responses))
+            saved += 1
+        return {"saved": saved, "batches": 1, "retries": 0,
+                "throttled": 0, "failed": 0, "latency": 0}
+
+    def close(self):
+        pass
+
+
+class FailingWriter(RecordingWriter):
+
+    def __init__(self):
+        RecordingWriter.__init__(self, [])
+
+    def write(self, items):
+        raise RuntimeError("Dynamo is unavailable")
+
+
+class RecordingArchive:
+    """
+    Stand-in for RealtimeArchive: records size of each append, and number of
+    departures held by extractor's buffer when it is called.
+    """
+
+    def __init__(self):
+        self.extractor = None
+        self.appended = []
+        self.buffered = []
+
+    def append(self, records):
+        self.appended.append(len(records))
+        self.buffered.append(len(self.extractor._archive_buffer))
+        return len(records)
+
+
 class TestExtractModuleFunctions(unittest.TestCase):
 
-    def test_xml_to_json_item_list(self):
+    def _read_sample(self):
+        # Open a xml file that is supposed to be from station 87393009
+        file_path = path.join(__BASE_DIR__, "tests", "files", "api_response.xml")
+        with open(file_path, 'r') as xml_file:
+            return xml_file.read()
+
+    def test_parse_api_response(self):
         """
         Test XML transformation process into json:
         - loads a XML sample file
@@ -25,11 +88,9 @@ class TestExtractModuleFunctions(unittest.TestCase):
         - check that each element contains necessary_fields
         """
 
-        # Open a xml file that is supposed to be from station 87393009
-        file_path = path.join(__BASE_DIR__, "tests", "files", "api_response.xml")
-        with open(file_path, 'r') as xml_file:
-            xml_string = xml_file.read()
-        output = xml_to_json_item_list(xml_string, "87393009")
+        xml_string = self._read_sample()
+        output = list(parse_api_response(
+            xml_string, "87393009", request_dt=datetime(2012, 5, 23, 12, 40)))
 
         necessary_fields = ["date", "request_day",
                             "request_time", "train_num", "miss", "station_id", "expected_passage_day", "expected_passage_time", "day_train_num"]
@@ -55,6 +116,198 @@ class TestExtractModuleFunctions(unittest.TestCase):
             # That we can transform into json
             self.assertTrue(is_jsonable(element))
 
+    def test_parse_api_response_values(self):
+        """
+        Check computed fields, including special format for trains passing
+        after midnight, and duplicates removal.
+        """
+        xml_string = self._read_sample()\
+            .replace("23/05/2012 13:12", "24/05/2012 01:12")\
+            .replace("<num>165412</num>", "<num>165312</num>")\
+            .replace("23/05/2012 13:01", "23/05/2012 12:55")
+        request_dt = datetime(2012, 5, 23, 12, 40)
+        output = list(parse_api_response(xml_string, 87393009, request_dt))
+
+        first = output[0]
+        self.assertEqual(first["train_num"], "165303")
+        self.assertEqual(first["station_8d"], "87393009")
+        self.assertEqual(first["station_id"], "8739300")
+        self.assertEqual(first["expected_passage_day"], "20120523")
+        self.assertEqual(first["expected_passage_time"], "12:52:00")
+        self.assertEqual(first["day_train_num"], "20120523_165303")
+        self.assertEqual(first["data_freshness"], "720")
+        self.assertEqual(first["request_time"], "12:40:00")
+
+        # duplicated train 165312 is kept once
+        self.assertEqual(len(output), 6)
+
+        after_midnight = [el for el in output if el["train_num"] == "148407"][0]
+        self.assertEqual(after_midnight["expected_passage_day"], "20120523")
+        self.assertEqual(after_midnight["expected_passage_time"], "25:12:00")
+
+    def _responses(self, stations):
+        xml_string = self._read_sample()
+        responses = []
+        for station in stations:
+            response = StationResponse(station)
+            response.status = 200
+            response.content = xml_string.encode("utf-8")
+            responses.append(response)
+        return responses
+
+    def test_streaming_save_in_dynamo(self):
+        """
+        In streaming mode, departures are sent to the writer as responses are
+        parsed, and each response is released once parsed.
+        """
+        stations = ["87393009", "87393108", "87393207"]
+        responses = self._responses(stations)
+        writer = RecordingWriter(responses)
+        extractor = ApiExtractor(stations, streaming=True, writer=writer)
+        extractor.raw_responses = responses
+        extractor.request_paris_time = datetime(2012, 5, 23, 12, 40)
+        extractor.save_in_dynamo()
+
+        # Items are not collected before being written
+        self.assertNotIsInstance(writer.received, list)
+        self.assertEqual(extractor.dynamo_objects, [])
+        per_station = len(writer.held) // 3
+        self.assertGreater(per_station, 0)
+        self.assertEqual(extractor.counters["saved_dynamo"], 3 * per_station)
+        # Responses still holding content when each item is written
+        self.assertEqual(
+            writer.held, [2] * per_station + [1] * per_station + [0] * per_station)
+        self.assertTrue(all(r.content is None and r.size > 0 for r in responses))
+
+    def test_archive_by_batches(self):
+        """
+        Departures are appended to archive as soon as a batch is full, not
+        kept until the end of the cycle.
+        """
+        stations = ["873%04d0" % i for i in range(10)]
+        responses = self._responses(stations)
+        archive = RecordingArchive()
+        extractor = ApiExtractor(stations, streaming=True, writer=RecordingWriter([]),
+                                 archive=archive, archive_batch_size=15)
+        archive.extractor = extractor
+        extractor.raw_responses = responses
+        extractor.request_paris_time = datetime(2012, 5, 23, 12, 40)
+        extractor.save_in_dynamo()
+
+        per_station = extractor.station_departures[stations[0]]
+        # Batches are appended as soon as they are full
+        self.assertGreater(len(archive.appended), 1)
+        self.assertTrue(all(
+            15 <= size < 15 + per_station for size in archive.appended))
+        self.assertTrue(all(buffered == 0 for buffered in archive.buffered))
+
+        # Remaining departures are appended at the end
+        self.assertLess(len(extractor._archive_buffer), 15)
+        extractor.save_in_archive()
+        self.assertEqual(extractor._archive_buffer, [])
+        self.assertEqual(sum(archive.appended), 10 * per_station)
+        self.assertEqual(extractor.counters["archived"], 10 * per_station)
+
+    def _run_pipelined(self, stations, writer, **kwargs):
+        """
+        Runs pipelined extraction (with a real client, on a fake session) in
+        a thread, so that a hang fails the test instead of blocking it.
+        """
+        client = ApiClient(user="user", password="password", persistent=True,
+                           max_per_minute=60000, burst=100, max_concurrency=5)
+        session = FakeSession(delay=0.001, content=self._read_sample().encode("utf-8"))
+        client._session = session
+        extractor = ApiExtractor(stations, client=client, streaming=True, writer=writer)
+        errors = []
+
+        def run():
+            try:
+                extractor.request_and_save_pipelined(**kwargs)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                client._session = None
+                client.close()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=20)
+        self.assertFalse(thread.is_alive(), "pipelined extraction is blocked")
+        return extractor, session, errors
+
+    def test_pipelined(self):
+        stations = ["873%04d0" % i for i in range(30)]
+        writer = RecordingWriter([])
+        extractor, session, errors = self._run_pipelined(
+            stations, writer, write_batch_size=10, max_pending_batches=2)
+        self.assertEqual(errors, [])
+        self.assertEqual(session.requests, 30)
+        self.assertEqual(extractor.counters["parsed_stations"], 30)
+        self.assertGreater(extractor.counters["saved_dynamo"], 0)
+        self.assertEqual(
+            extractor.counters["saved_dynamo"], extractor.counters["departures"])
+
+    def test_pipelined_writer_failure(self):
+        """
+        A writer failure stops the extraction and is raised, instead of
+        leaving fetching blocked on the full queue.
+        """
+        stations = ["873%04d0" % i for i in range(200)]
+        extractor, session, errors = self._run_pipelined(
+            stations, FailingWriter(), write_batch_size=1, max_pending_batches=2)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], RuntimeError)
+        # Remaining stations are not requested
+        self.assertLess(session.requests, 200)
+
+    def test_duplicated_stations(self):
+        """
+        A station given twice is requested, parsed and written once; a train
+        passing at several stations gives one departure per station.
+        """
+        stations = ["87393009", "87393108", "87393009"]
+        writer = RecordingWriter([])
+        extractor, session, errors = self._run_pipelined(stations, writer)
+        self.assertEqual(errors, [])
+        self.assertEqual(extractor.stations, ["87393009", "87393108"])
+        self.assertEqual(session.requests, 2)
+        self.assertEqual(extractor.counters["parsed_stations"], 2)
+        per_station = extractor.station_departures["87393009"]
+        self.assertEqual(extractor.station_departures["87393108"], per_station)
+        self.assertEqual(extractor.counters["saved_dynamo"], 2 * per_station)
+
+
+class TestExtractionService(unittest.TestCase):
+
+    def setUp(self):
+        self.service = ExtractionService()
+
+    def tearDown(self):
+        self.service.close()
+
+    @mock.patch("api_etl.extract_api.StationProvider")
+    def test_schedule_retry(self, station_provider):
+        """
+        A schedule that cannot be loaded is not queried again at each tick.
+        """
+        station_provider.return_value.get_stations_per_line.return_value = ["87271007"]
+        schedule = StationSchedule("20170215", {"8727100": [8 * 3600]})
+        with mock.patch("api_etl.extract_api.StationSchedule.from_db",
+                        side_effect=RuntimeError("database is down")) as from_db:
+            for _ in range(3):
+                self.assertIsNone(self.service._get_poller("20170215", 7 * 3600))
+            self.assertEqual(from_db.call_count, 1)
+            # Retried after delay, or for another day
+            self.service._get_poller("20170215", 7 * 3600, retry_seconds=0)
+            self.service._get_poller("20170216", 7 * 3600)
+            self.assertEqual(from_db.call_count, 3)
+
+        with mock.patch("api_etl.extract_api.StationSchedule.from_db",
+                        return_value=schedule):
+            poller = self.service._get_poller("20170215", 7 * 3600, retry_seconds=0)
+        self.assertEqual(poller.schedule, schedule)
+        self.assertIsNone(self.service._poller_failure)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,329 @@
+"""
+Tests for querier_memory module: MemoryQuerier must answer as DBQuerier,
+on a small GTFS feed (files, and sqlite database).
+"""
+
+from os import path, utime
+import unittest
+import logging
+import tempfile
+
+import pandas as pd
+from sqlalchemy.sql import text
+
+from api_etl.utils_rdb import RdbProvider
+from api_etl.utils_misc import seconds_to_special_time
+from api_etl.utils_rdb_bulk import GtfsBulkLoader
+from api_etl.data_models import StopTime, Trip, Stop, Calendar, ServiceDay, TripExtent
+from api_etl.querier_schedule import DBQuerier
+from api_etl.querier_memory import (
+    GtfsTimetable, MemoryQuerier, get_timetable
+)
+
+logger = logging.getLogger(__name__)
+
+STOPS = ["StopPoint:DUA87271%02d" % i for i in range(12)]
+
+
+def write_gtfs_folder(folder):
+    """
+    Feed of 4 trips on lines C and D:
+    - T1 (C) and T3 (D, 11 stops) on service S1 (february, removed on 15th)
+    - T2 (C) on service S2 (march, added on 15th of february)
+    - T4 (C) without service
+    """
+    stop_times = []
+    trips_stops = {
+        "T1": (STOPS[:3], 8 * 3600),
+        "T2": (STOPS[1:4], 9 * 3600),
+        "T3": (STOPS[:11], 7 * 3600),
+        "T4": (STOPS[:2], 8 * 3600),
+    }
+    for trip_id, (stops, start) in trips_stops.items():
+        for sequence, stop_id in enumerate(stops):
+            seconds = start + 600 * sequence
+            # Arrival one minute before departure
+            stop_times.append([
+                trip_id, seconds_to_special_time(seconds - 60),
+                seconds_to_special_time(seconds), stop_id, sequence, 0, 0])
+
+    tables = {
+        "agency.txt": pd.DataFrame(
+            [["A1", "SNCF", "http://sncf.fr", "Europe/Paris", "fr"]],
+            columns=["agency_id", "agency_name", "agency_url", "agency_timezone", "agency_lang"]),
+        "routes.txt": pd.DataFrame(
+            [["R_C", "A1", "C", "Ligne C", 2], ["R_C2", "A1", "C", "Ligne C", 2],
+             ["R_D", "A1", "D", "Ligne D", 2]],
+            columns=["route_id", "agency_id", "route_short_name", "route_long_name", "route_type"]),
+        "trips.txt": pd.DataFrame(
+            [["R_C", "S1", "T1", "ABCD", 0], ["R_C2", "S2", "T2", "ABCD", 1],
+             ["R_D", "S1", "T3", "EFGH", 0], ["R_C", "S3", "T4", "ABCD", 0]],
+            columns=["route_id", "service_id", "trip_id", "trip_headsign", "direction_id"]),
+        "stops.txt": pd.DataFrame(
+            [[stop_id, "Gare %s" % stop_id[-2:], 48.8, 2.3] for stop_id in STOPS]
+            + [["StopArea:DUA8727100", "Zone", 48.8, 2.3]],
+            columns=["stop_id", "stop_name", "stop_lat", "stop_lon"]),
+        "stop_times.txt": pd.DataFrame(
+            stop_times,
+            columns=["trip_id", "arrival_time", "departure_time", "stop_id",
+                     "stop_sequence", "pickup_type", "drop_off_type"]),
+        "calendar.txt": pd.DataFrame(
+            [["S1", 1, 1, 1, 1, 1, 0, 0, 20170201, 20170228],
+             ["S2", 1, 1, 1, 1, 1, 0, 0, 20170301, 20170331]],
+            columns=["service_id", "monday", "tuesday", "wednesday", "thursday",
+                     "friday", "saturday", "sunday", "start_date", "end_date"]),
+        "calendar_dates.txt": pd.DataFrame(
+            [["S2", 20170215, 1], ["S1", 20170215, 2]],
+            columns=["service_id", "date", "exception_type"]),
+    }
+    for name, df in tables.items():
+        df.to_csv(path.join(folder, name), index=False)
+
+
+def write_database(folder, provider):
+    """
+    Saves GTFS files in database, as ScheduleExtractorRDB.save_in_rdb, but
+    without precomputed tables.
+    """
+    GtfsBulkLoader(provider, folder).load(derived=False)
+
+
+def comparable(results):
+    """Results as sorted tuples of primary keys (or values)."""
+    def key(item):
+        if hasattr(item, "__table__"):
+            return tuple(getattr(item, c.key) for c in item.__table__.primary_key)
+        return item
+
+    rows = []
+    for result in results:
+        if hasattr(result, "__table__"):
+            rows.append(key(result))
+        else:
+            rows.append(tuple(key(item) for item in result))
+    return sorted(rows)
+
+
+class TestMemoryQuerier(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        write_gtfs_folder(cls.folder.name)
+        cls.provider = RdbProvider(
+            "sqlite:///%s" % path.join(cls.folder.name, "gtfs.db"))
+        write_database(cls.folder.name, cls.provider)
+        cls.timetable = GtfsTimetable.from_folder(cls.folder.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.provider.get_engine().dispose()
+        cls.folder.cleanup()
+
+    def setUp(self):
+        self.dbq = DBQuerier(scheduled_day="20170215")
+        self.dbq.provider = self.provider
+        self.mq = MemoryQuerier(scheduled_day="20170215", timetable=self.timetable)
+
+    def assertSameResults(self, method, **kwargs):
+        expected = getattr(self.dbq, method)(**kwargs)
+        results = getattr(self.mq, method)(**kwargs)
+        self.assertEqual(comparable(results), comparable(expected), kwargs)
+        return results
+
+    def test_services(self):
+        results = self.assertSameResults("services", on_day="20170215")
+        self.assertEqual(comparable(results), [("S2",)])
+        self.assertSameResults("services", on_day="20170214", level=1)
+        self.assertSameResults("services")
+        # Saturday: weekdays only service
+        self.assertEqual(self.assertSameResults("services", on_day="20170218"), [])
+
+    def test_service_days_table(self):
+        # Computed from calendar staging table, and swapped with it
+        rows = GtfsBulkLoader(self.provider, self.folder.name)\
+            .load([("calendar.txt", Calendar)])
+        self.addCleanup(ServiceDay.__table__.drop, self.provider.get_engine())
+        # S1 on 20 weekdays of february but 15th, S2 on 23 weekdays of march
+        # and 15th of february
+        self.assertEqual(rows["service_days"], 19 + 24)
+
+        for day in ["20170214", "20170215", "20170218", "20170301"]:
+            dbq = DBQuerier(scheduled_day=day)
+            dbq.provider = self.provider
+            self.mq.set_date(day)
+            self.assertEqual(
+                comparable(dbq.services(on_day=True)),
+                comparable(self.mq.services(on_day=True)))
+            self.assertEqual(
+                comparable(dbq.stoptimes(on_day=True, level=2)),
+                comparable(self.mq.stoptimes(on_day=True, level=2)))
+            self.assertEqual(
+                comparable(dbq.trips(on_day=True, active_at_time="08:15:00")),
+                comparable(self.mq.trips(on_day=True, active_at_time="08:15:00")))
+        self.assertTrue(dbq._precomputed_available(dbq.provider.get_session(), ServiceDay))
+
+    def test_trips(self):
+        for kwargs in [
+            {"on_day": "20170214"},
+            {"on_day": True, "level": 4},
+            {"on_day": "20170214", "active_at_time": "08:15:00"},
+            {"on_day": "20170214", "active_at_time": "08:25:00", "level": 2},
+            {"has_begun_at_time": "07:30:00"},
+            # Last stop of T3 has sequence "10"
+            {"not_yet_arrived_at_time": "08:30:00", "level": 1},
+            {"on_route_short_name": "C", "level": 3},
+            {"trip_id": "T3"},
+        ]:
+            self.assertSameResults("trips", **kwargs)
+        self.assertEqual(self.mq.trips(on_day="20170214", count=True), 2)
+
+    def test_trip_extents_table(self):
+        rows = GtfsBulkLoader(self.provider, self.folder.name)\
+            .load([("trips.txt", Trip)])
+        self.addCleanup(TripExtent.__table__.drop, self.provider.get_engine())
+        self.assertEqual(rows["trip_extents"], 4)
+
+        for kwargs in [
+            {"on_day": "20170214", "active_at_time": "08:15:00", "level": 3},
+            # T1 arrives at 08:19:00 at last stop (departure at 08:20:00)
+            {"on_day": "20170214", "active_at_time": "08:20:00"},
+            {"on_day": "20170214", "active_at_time": "08:19:00", "on_route_short_name": "C"},
+            {"has_begun_at_time": "07:30:00"},
+            {"not_yet_arrived_at_time": "08:40:00", "level": 1},
+        ]:
+            self.assertSameResults("trips", **kwargs)
+        self.assertTrue(
+            self.dbq._precomputed_available(self.provider.get_session(), TripExtent))
+
+    def test_rolling_trips(self):
+        for time, expected in [("06:59:00", 0), ("07:00:00", 1), ("08:00:00", 2),
+                               ("08:19:00", 2), ("08:20:00", 1), ("08:39:00", 1),
+                               ("08:40:00", 0)]:
+            self.assertEqual(self.mq.trips(
+                on_day="20170214", active_at_time=time, count=True), expected, time)
+            self.assertEqual(self.dbq.trips(
+                on_day="20170214", active_at_time=time, count=True), expected, time)
+        self.assertEqual(self.mq.trips(
+            on_day="20170214", active_at_time="08:00:00", on_route_short_name="D",
+            count=True), 1)
+        self.assertEqual(self.mq.trips(
+            on_day="20170214", active_at_time="08:00:00", trip_id="T1")[0].trip_id, "T1")
+        self.assertIn(("20170214", "D"), self.timetable._interval_indexes)
+
+    def test_stoptimes(self):
+        for kwargs in [
+            {"on_day": "20170214"},
+            {"on_day": "20170214", "level": 4},
+            {"trip_id_filter": ["T1", "T2"], "level": 2},
+            {"uic_filter": "87271011", "level": 3},
+            {"stop_id": STOPS[1], "departure_time_above": "08:10:00"},
+            {"uic_filter": "8727101", "departure_time_below": "08:10:00",
+             "departure_time_above": "08:00:00"},
+            {"on_day": "20170214", "trip_active_at_time": "08:15:00"},
+            {"on_route_short_name": "D", "level": 1},
+        ]:
+            self.assertSameResults("stoptimes", **kwargs)
+        # T4 has no service: excluded, as by joins
+        self.assertEqual(
+            self.mq.stoptimes(stop_id=STOPS[0], count=True),
+            self.dbq.stoptimes(stop_id=STOPS[0], count=True))
+        self.assertEqual(self.mq.stoptimes(stop_id=STOPS[0], count=True), 2)
+
+    def test_stations_and_routes(self):
+        self.assertSameResults("stations", on_route_short_name="D")
+        self.assertSameResults("stations", stop_id=STOPS[2], level=1)
+        self.assertEqual(len(self.mq.stations()), len(STOPS))
+        self.assertEqual(sorted(r.route_id for r in self.mq.routes()), ["R_C", "R_D"])
+        self.assertEqual(len(self.mq.routes(distinct_short_name=False, level=2)), 3)
+
+    def test_copy_on_write(self):
+        """
+        Masks are not built on values of pandas objects, which are read-only
+        with copy-on-write.
+        """
+        if not hasattr(pd.options.mode, "copy_on_write"):
+            self.skipTest("pandas has no copy-on-write mode")
+        with pd.option_context("mode.copy_on_write", True):
+            mq = MemoryQuerier(
+                scheduled_day="20170215",
+                timetable=GtfsTimetable.from_folder(self.folder.name))
+            self.assertEqual(
+                comparable(mq.stations(on_route_short_name="D", stop_id=STOPS[2])),
+                comparable(self.dbq.stations(on_route_short_name="D", stop_id=STOPS[2])))
+            self.assertEqual(len(mq.stations(on_route_short_name="D")),
+                             len(self.dbq.stations(on_route_short_name="D")))
+
+    def test_departure_times(self):
+        self.assertEqual(
+            sorted(self.mq.departure_times("20170214")),
+            sorted(self.dbq.departure_times("20170214")))
+
+    def test_results_types(self):
+        row = self.mq.stoptimes(trip_id_filter="T1", level=3)[0]
+        self.assertIsInstance(row.StopTime, StopTime)
+        self.assertIsInstance(row.Trip, Trip)
+        self.assertIsInstance(row.Stop, Stop)
+        self.assertEqual(set(row._asdict()), {"StopTime", "Trip", "Stop"})
+        self.assertEqual(row.StopTime.stop_sequence, "0")
+        self.assertEqual(row.StopTime.departure_seconds, 8 * 3600)
+
+        # Same values as in database, typed columns included
+        columns = [c.key for c in StopTime.__table__.columns]
+
+        def values(querier):
+            return sorted(
+                tuple(getattr(st, c) for c in columns)
+                for st in querier.stoptimes(trip_id_filter="T3", level=1))
+
+        self.assertEqual(values(self.mq), values(self.dbq))
+        self.assertEqual(values(self.mq)[-1][columns.index("stop_sequence_number")], 10)
+        self.assertIsInstance(self.mq.services(level=1)[0], Calendar)
+        self.assertEqual(self.mq.trips(trip_id="T1")[0].trip_id, "T1")
+        # Instances are not shared between queries
+        first = self.mq.trips(trip_id="T1", level=1)[0]
+        first.trip_headsign = "changed"
+        self.assertEqual(self.mq.trips(trip_id="T1", level=1)[0].trip_headsign, "ABCD")
+
+    def test_from_rdb(self):
+        timetable = GtfsTimetable.from_rdb(self.provider)
+        mq = MemoryQuerier(scheduled_day="20170214", timetable=timetable)
+        self.assertEqual(
+            comparable(mq.stoptimes(on_day=True, level=4)),
+            comparable(self.mq.stoptimes(on_day="20170214", level=4)))
+        self.assertEqual(
+            timetable.version, GtfsTimetable.rdb_version(self.provider))
+
+    def test_rdb_version(self):
+        """
+        Each load of schedule gives a new version, even with same number of
+        rows; databases loaded without version fall back on calendars dates.
+        """
+        version = GtfsTimetable.rdb_version(self.provider)
+        GtfsBulkLoader(self.provider, self.folder.name).load([("trips.txt", Trip)])
+        reloaded = GtfsTimetable.rdb_version(self.provider)
+        self.assertNotEqual(reloaded, version)
+        self.assertEqual(GtfsTimetable.rdb_version(self.provider), reloaded)
+
+        with self.provider.get_engine().begin() as connection:
+            connection.execute(text("DROP TABLE schedule_versions"))
+        self.assertEqual(
+            GtfsTimetable.rdb_version(self.provider), ("20170201", "20170331"))
+        write_database(self.folder.name, self.provider)
+
+    def test_get_timetable(self):
+        timetable = get_timetable(source="folder", folder=self.folder.name)
+        self.assertIs(
+            get_timetable(source="folder", folder=self.folder.name), timetable)
+        # Feed version checked at most every check_interval seconds
+        utime(path.join(self.folder.name, "trips.txt"), (0, 0))
+        self.assertIs(
+            get_timetable(source="folder", folder=self.folder.name), timetable)
+        reloaded = get_timetable(
+            source="folder", folder=self.folder.name, check_interval=0)
+        self.assertIsNot(reloaded, timetable)
+        self.assertEqual(len(reloaded.trip_route), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
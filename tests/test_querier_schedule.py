@@ -0,0 +1,126 @@
+"""
+Tests for querier_schedule module: DBQuerier filters, on a small GTFS feed
+saved in a sqlite database (see test_querier_memory), also as created or
+migrated by earlier versions (without typed columns of stop times).
+"""
+
+from os import path
+import unittest
+import logging
+import tempfile
+
+from sqlalchemy.sql import text
+
+from api_etl.utils_rdb import RdbProvider
+from api_etl.querier_schedule import DBQuerier
+from tests.test_querier_memory import STOPS, write_gtfs_folder, write_database
+
+logger = logging.getLogger(__name__)
+
+
+class TestDBQuerier(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        write_gtfs_folder(cls.folder.name)
+        cls.provider = RdbProvider(
+            "sqlite:///%s" % path.join(cls.folder.name, "gtfs.db"))
+        write_database(cls.folder.name, cls.provider)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.provider.get_engine().dispose()
+        cls.folder.cleanup()
+
+    def setUp(self):
+        self.dbq = DBQuerier(scheduled_day="20170215")
+        self.dbq.provider = self.provider
+
+    def trip_ids(self, results):
+        return sorted(result[-1] for result in results)
+
+    def test_departure_time_above(self):
+        # T3 leaves at 07:10, T1 at 08:10, T2 at 09:10
+        results = self.dbq.stoptimes(stop_id=STOPS[1], departure_time_above="08:10:00")
+        self.assertEqual(self.trip_ids(results), ["T1", "T2"])
+
+    def test_uic_filter(self):
+        results = self.dbq.stoptimes(uic_filter="8727102")
+        self.assertEqual({stop_id for stop_id, _ in results}, {STOPS[2]})
+        self.assertEqual(self.trip_ids(results), ["T1", "T2", "T3"])
+
+    def test_has_begun_keeps_day(self):
+        # T3 begins at 07:00, on a service removed on the 15th
+        self.assertEqual(
+            self.trip_ids(self.dbq.trips(on_day="20170214", has_begun_at_time="07:30:00")),
+            ["T3"])
+        self.assertEqual(
+            self.dbq.trips(on_day="20170215", has_begun_at_time="07:30:00"), [])
+
+    def test_not_yet_arrived_last_stop(self):
+        # Last stop of T3 has sequence "10" (after "9" as strings), at 08:40
+        self.assertEqual(
+            self.trip_ids(self.dbq.trips(not_yet_arrived_at_time="08:35:00")),
+            ["T2", "T3"])
+        self.assertEqual(
+            self.trip_ids(self.dbq.trips(not_yet_arrived_at_time="08:45:00")),
+            ["T2"])
+
+    def test_trips_and_services_filters(self):
+        # Trips active at 08:15 on the 14th: T1 (3 stops) and T3 (11 stops)
+        self.assertEqual(self.dbq.stoptimes(
+            on_day="20170214", trip_active_at_time="08:15:00", count=True), 14)
+        # Only T2 on the 15th
+        self.assertEqual(
+            set(self.trip_ids(self.dbq.stoptimes(on_day="20170215"))), {"T2"})
+
+    def test_stoptimes_entities(self):
+        stop_times = self.dbq.stoptimes(trip_id_filter="T3", level=1)
+        self.assertEqual(
+            sorted(int(stop_time.stop_sequence) for stop_time in stop_times),
+            list(range(11)))
+
+
+class TestDBQuerierNotComputed(TestDBQuerier):
+    """ Typed columns exist, but were not computed yet.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with cls.provider.get_engine().begin() as connection:
+            connection.execute(text(
+                "UPDATE stop_times SET stop_sequence_number = NULL, "
+                "arrival_seconds = NULL, departure_seconds = NULL"))
+
+    def test_typed_columns_state(self):
+        session = self.provider.get_session()
+        self.assertEqual(self.dbq._typed_columns_state(session), (True, False))
+        session.close()
+
+
+class TestDBQuerierLegacySchema(TestDBQuerier):
+    """ Stop times table of earlier versions, without typed columns.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        columns = ", ".join([
+            "trip_id", "stop_id", "arrival_time", "departure_time",
+            "stop_sequence", "stop_headsign", "pickup_type", "drop_off_type"])
+        with cls.provider.get_engine().begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE legacy_stop_times AS SELECT %s FROM stop_times" % columns))
+            connection.execute(text("DROP TABLE stop_times"))
+            connection.execute(text("ALTER TABLE legacy_stop_times RENAME TO stop_times"))
+
+    def test_typed_columns_state(self):
+        session = self.provider.get_session()
+        self.assertEqual(self.dbq._typed_columns_state(session), (False, False))
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Tests for regressor_train module: training of several lines.
+"""
+
+from os import path
+import unittest
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from api_etl.regressor_train import MultiLineTrainer
+from api_etl.utils_training_set import TrainingSetStore, TrainingArrayCache
+from tests.test_utils_training_set import build_training_set
+
+logger = logging.getLogger(__name__)
+
+
+@mock.patch("api_etl.regressor_train.download_training_sets", lambda tempo: True)
+class TestMultiLineTrainer(unittest.TestCase):
+
+    features = ["TS_last_observed_delay", "TS_sequence_diff", "D_business_day"]
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = TrainingSetStore(
+            tempo=30, root=path.join(self.folder.name, "training_set"))
+        df = build_training_set(rows_per_line=40, lines=("C", "E"))
+        self.store.save_day(df, "20170215")
+        self.store.save_day(df, "20170216")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def _trainer(self, memory_map, processes, lines=("C", "E")):
+        cache = TrainingArrayCache(
+            self.features, store=self.store,
+            root=path.join(self.folder.name, "arrays"))
+        return MultiLineTrainer(
+            lines=lines, start_date="20170214", end_date="20170217",
+            features=self.features, processes=processes,
+            memory_map=memory_map, store=self.store, cache=cache)
+
+    def _check_results(self, results, lines=("C", "E")):
+        self.assertEqual(set(results), set(lines))
+        for line in lines:
+            result = results[line]
+            self.assertEqual(result["line"], line)
+            # 2 days of 40 rows, all within default filters
+            self.assertEqual(result["rows"], 80)
+            self.assertIn("Mean absolute error", result["score_description"])
+            self.assertEqual(len(result["pipeline"].predict([[0., 1., 1.]])), 1)
+
+    def test_sequential(self):
+        for memory_map in (True, False):
+            trainer = self._trainer(memory_map=memory_map, processes=1)
+            self._check_results(trainer.train())
+
+    def test_process_pool(self):
+        for memory_map in (True, False):
+            trainer = self._trainer(memory_map=memory_map, processes=2)
+            self.assertEqual(trainer._processes(), 2)
+            self._check_results(trainer.train())
+
+    def test_daemonic_process(self):
+        """
+        In daemonic processes (celery workers), lines are trained by threads.
+        """
+        daemon = mock.Mock(daemon=True)
+        with mock.patch("api_etl.regressor_train.multiprocessing.current_process",
+                        return_value=daemon), \
+                mock.patch("api_etl.regressor_train.ProcessPoolExecutor",
+                           side_effect=AssertionError("no process in daemon")), \
+                mock.patch("api_etl.regressor_train.ThreadPoolExecutor",
+                           wraps=ThreadPoolExecutor) as thread_pool:
+            for memory_map in (True, False):
+                trainer = self._trainer(memory_map=memory_map, processes=2)
+                self._check_results(trainer.train())
+        self.assertEqual(thread_pool.call_count, 2)
+        thread_pool.assert_called_with(max_workers=2)
+
+    def test_memory_mapped_lines(self):
+        """
+        In memory-mapped mode, training sets are not loaded for all lines.
+        """
+        trainer = self._trainer(memory_map=True, processes=1)
+        trainer.train()
+        self.assertIsNone(trainer.partitions)
+        self.assertEqual(trainer.cache.counters["mapped"], 4)
+
+    def test_empty_line(self):
+        """
+        Lines without training data are skipped.
+        """
+        for memory_map in (True, False):
+            for processes in (1, 2):
+                trainer = self._trainer(
+                    memory_map=memory_map, processes=processes, lines=("C", "D"))
+                with self.assertLogs("api_etl.regressor_train", "WARNING") as logs:
+                    results = trainer.train()
+                self.assertEqual(set(results), {"C"})
+                self.assertIn("No training data for line D.", logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+"""
+Tests for S3Bucket folders synchronization, against a local S3 stand-in
+(moto).
+"""
+
+from os import path, makedirs, utime
+import re
+import unittest
+from unittest import mock
+from importlib.util import find_spec
+import logging
+import tempfile
+
+try:
+    from moto import mock_aws
+except ImportError:
+    try:
+        # moto < 5 (as pinned with boto3 1.4.4)
+        from moto import mock_s3 as mock_aws
+    except ImportError:
+        mock_aws = None
+
+from api_etl import utils_misc
+from api_etl.utils_misc import S3Bucket
+
+logger = logging.getLogger(__name__)
+
+
+def _moto_unsupported():
+    """
+    moto 1.1.22 (pinned with boto3 1.4.4) bundles a version of responses that
+    uses re._pattern_type, removed in python 3.7: it only runs on python 3.6.
+    """
+    if mock_aws is None or hasattr(re, "_pattern_type"):
+        return False
+    try:
+        return find_spec("moto.packages.responses") is not None
+    except ImportError:
+        return False
+
+
+def write_file(file_path, content):
+    makedirs(path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w") as f:
+        f.write(content)
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+@unittest.skipIf(_moto_unsupported(), "installed moto runs on python 3.6 only")
+class TestS3BucketSync(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.region = mock.patch.object(utils_misc, "AWS_DEFAULT_REGION", "eu-west-1")
+        self.region.start()
+        self.bucket = S3Bucket("test-bucket", create_if_absent=True)
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.local = path.join(self.folder.name, "local")
+        self.downloads = path.join(self.folder.name, "downloads")
+        write_file(path.join(self.local, "20170215.parquet"), "a" * 100)
+        write_file(path.join(self.local, "day=20170216", "line=C", "data.parquet"), "b" * 10)
+        write_file(path.join(self.local, ".hidden"), "c")
+
+    def tearDown(self):
+        self.folder.cleanup()
+        self.region.stop()
+        self.mock.stop()
+
+    def test_sync_upload(self):
+        stats = self.bucket.send_folder(self.local, "training", sync=True, workers=4)
+        self.assertEqual(stats["transferred"], 2)
+        self.assertEqual(stats["bytes"], 110)
+        self.assertEqual(
+            sorted(self.bucket.list_bucket_objects(prefix="training")),
+            ["training/20170215.parquet", "training/day=20170216/line=C/data.parquet"])
+
+        # Nothing changed
+        stats = self.bucket.send_folder(self.local, "training", sync=True)
+        self.assertEqual(stats["transferred"], 0)
+        self.assertEqual(stats["skipped"], 2)
+
+        # Changed locally, and deleted remotely
+        write_file(path.join(self.local, "20170215.parquet"), "d" * 100)
+        self.bucket.bucket.Object("training/day=20170216/line=C/data.parquet").delete()
+        stats = self.bucket.send_folder(self.local, "training", sync=True)
+        self.assertEqual(stats["transferred"], 2)
+        body = self.bucket.bucket.Object("training/20170215.parquet").get()["Body"].read()
+        self.assertEqual(body, b"d" * 100)
+
+    def test_sync_download(self):
+        self.bucket.send_folder(self.local, "training", sync=True)
+
+        stats = self.bucket.download_folder("training", self.downloads, sync=True)
+        self.assertEqual(stats["transferred"], 2)
+        local_file = path.join(self.downloads, "training", "20170215.parquet")
+        with open(local_file) as f:
+            self.assertEqual(f.read(), "a" * 100)
+
+        stats = self.bucket.download_folder("training", self.downloads, sync=True)
+        self.assertEqual(stats["transferred"], 0)
+        self.assertEqual(stats["skipped"], 2)
+
+        # Changed remotely
+        self.bucket.bucket.Object("training/20170215.parquet").put(Body=b"e" * 50)
+        # Changed locally
+        utime(path.join(self.downloads, "training", "day=20170216", "line=C", "data.parquet"), (0, 0))
+        stats = self.bucket.download_folder("training", self.downloads, sync=True)
+        self.assertEqual(stats["transferred"], 2)
+        self.assertEqual(stats["bytes"], 60)
+        with open(local_file) as f:
+            self.assertEqual(f.read(), "e" * 50)
+
+    def _failing(self, method, failing_key):
+        """Patched transfer method, failing for keys ending with failing_key."""
+        original = getattr(S3Bucket, method)
+
+        def transfer(bucket, *args):
+            if any(arg.endswith(failing_key) for arg in args):
+                raise OSError("Connection reset by peer")
+            return original(bucket, *args)
+        return mock.patch.object(S3Bucket, method, transfer)
+
+    def test_failed_sync_keeps_completed_transfers(self):
+        """
+        If a transfer fails, completed ones are recorded in manifest (and not
+        done again), and the error is raised.
+        """
+        with self._failing("_upload_one", "data.parquet"):
+            with self.assertRaises(OSError):
+                self.bucket.send_folder(self.local, "training", sync=True, workers=4)
+        stats = self.bucket.send_folder(self.local, "training", sync=True)
+        self.assertEqual(stats["transferred"], 1)
+        self.assertEqual(stats["skipped"], 1)
+
+        with self._failing("_download_one", "20170215.parquet"):
+            with self.assertRaises(OSError):
+                self.bucket.download_folder("training", self.downloads, sync=True)
+        stats = self.bucket.download_folder("training", self.downloads, sync=True)
+        self.assertEqual(stats["transferred"], 1)
+        self.assertEqual(stats["skipped"], 1)
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+@unittest.skipIf(_moto_unsupported(), "installed moto runs on python 3.6 only")
+class TestS3BucketTransfers(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.region = mock.patch.object(utils_misc, "AWS_DEFAULT_REGION", "eu-west-1")
+        self.region.start()
+        # Small parts, so that multipart transfers are used
+        self.bucket = S3Bucket(
+            "test-bucket", create_if_absent=True, part_size=5 * 1024 * 1024,
+            multipart_threshold=5 * 1024 * 1024, threads=4)
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+        self.region.stop()
+        self.mock.stop()
+
+    def test_multipart_send_file(self):
+        file_path = path.join(self.folder.name, "big.parquet")
+        write_file(file_path, "x" * (11 * 1024 * 1024))
+        self.bucket.send_file(file_path, "raw_days/big.parquet")
+
+        obj = self.bucket.bucket.Object("raw_days/big.parquet")
+        self.assertEqual(obj.content_length, 11 * 1024 * 1024)
+        # Multipart ETags end with number of parts
+        self.assertTrue(obj.e_tag.strip('"').endswith("-3"))
+
+        downloaded = path.join(self.folder.name, "downloaded", "big.parquet")
+        self.bucket.download_file("raw_days/big.parquet", downloaded)
+        self.assertEqual(path.getsize(downloaded), 11 * 1024 * 1024)
+
+    def test_batch_transfers(self):
+        files = []
+        for i in range(6):
+            file_path = path.join(self.folder.name, "local", "%d.parquet" % i)
+            write_file(file_path, "y" * 1000)
+            files.append((file_path, "training/%d.parquet" % i))
+
+        stats = self.bucket.send_files(files, workers=3)
+        self.assertEqual(stats["files"], 6)
+        self.assertEqual(stats["bytes"], 6000)
+        self.assertGreater(S3Bucket.throughput(stats), 0)
+
+        stats = self.bucket.download_folder(
+            "training", path.join(self.folder.name, "downloads"), workers=3)
+        self.assertEqual(stats["files"], 6)
+        self.assertTrue(path.isfile(
+            path.join(self.folder.name, "downloads", "training", "5.parquet")))
+        self.assertEqual(self.bucket.counters["files"], 12)
+        self.assertEqual(self.bucket.counters["bytes"], 12000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+"""
+Tests for utils_api_client module.
+"""
+
+import unittest
+import logging
+import asyncio
+import time
+from unittest import mock
+
+from aiohttp import ClientConnectionError
+
+from api_etl.utils_api_client import ApiClient, TokenBucket, StationResponse, _retry_delay
+
+logger = logging.getLogger(__name__)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _acquire_n(self, bucket, n):
+        async def run():
+            for _ in range(n):
+                await bucket.acquire()
+        begin = time.monotonic()
+        self.loop.run_until_complete(run())
+        return time.monotonic() - begin
+
+    def test_burst_is_immediate(self):
+        """
+        Tokens available in bucket are consumed without waiting.
+        """
+        bucket = TokenBucket(rate=1, capacity=5)
+        elapsed = self._acquire_n(bucket, 5)
+        self.assertLess(elapsed, 0.5)
+
+    def test_rate_is_respected(self):
+        """
+        Once bucket is empty, requests are spread at bucket rate.
+        """
+        bucket = TokenBucket(rate=20, capacity=1)
+        elapsed = self._acquire_n(bucket, 11)
+        # 10 tokens to wait for at 20 per second
+        self.assertGreaterEqual(elapsed, 0.45)
+
+    def test_from_max_per_minute(self):
+        """
+        Burst is taken from steady rate so that a sliding minute never
+        exceeds quota.
+        """
+        bucket = TokenBucket.from_max_per_minute(350, burst=10)
+        self.assertEqual(bucket.capacity, 10)
+        self.assertAlmostEqual(bucket.rate * 60 + bucket.capacity, 350)
+        self.assertRaises(AssertionError, TokenBucket.from_max_per_minute, 10, burst=10)
+
+
+class TestStationResponse(unittest.TestCase):
+
+    def test_is_ok(self):
+        response = StationResponse("87393009")
+        self.assertFalse(response.is_ok())
+        self.assertEqual(response.size, 0)
+
+        response.status = 503
+        response.content = b"error"
+        self.assertFalse(response.is_ok())
+
+        response.status = 200
+        response.content = b"<passages/>"
+        self.assertTrue(response.is_ok())
+        self.assertEqual(response.size, 11)
+
+        # size is kept once content is released
+        response.release()
+        self.assertIsNone(response.content)
+        self.assertEqual(response.size, 11)
+
+    def test_retry_delay(self):
+        """
+        Delay starts at 0.5s and is multiplied by 1.5 at each retry.
+        """
+        self.assertEqual(_retry_delay(1), 0.5)
+        self.assertEqual(_retry_delay(2), 0.75)
+        self.assertGreater(_retry_delay(4), _retry_delay(3))
+
+
+class FakeResponse:
+
+    def __init__(self, session, status):
+        self.session = session
+        self.status = status
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return False
+
+    async def read(self):
+        session = self.session
+        session.running += 1
+        session.peak = max(session.peak, session.running)
+        try:
+            await asyncio.sleep(session.delay)
+        finally:
+            session.running -= 1
+        return session.content
+
+
+class FakeSession:
+    """
+    Local stand-in for aiohttp ClientSession: answers each request with next
+    outcome of "outcomes" (status, or exception to raise), then with 200.
+    Responses ("content") take "delay" seconds to be read.
+    """
+
+    def __init__(self, outcomes=(), delay=0, content=b"<passages/>"):
+        self.outcomes = list(outcomes)
+        self.delay = delay
+        self.content = content
+        self.closed = False
+        self.requests = 0
+        self.running = 0
+        self.peak = 0
+
+    def get(self, url):
+        self.requests += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else 200
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(self, outcome)
+
+
+@mock.patch("api_etl.utils_api_client._retry_delay", lambda retry_counter: 0.01)
+class TestFetchStation(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = ApiClient(
+            user="user", password="password", max_per_minute=60000, burst=100,
+            retry_timeout=5, request_timeout=0.2, max_concurrency=3)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _fetch(self, session, stations=("87393009",)):
+        async def run():
+            semaphore = asyncio.Semaphore(self.client.max_concurrency)
+            return await asyncio.gather(*[
+                self.client._fetch_station(station, "url", session, semaphore)
+                for station in stations
+            ])
+        return self.loop.run_until_complete(run())
+
+    def test_retriable_statuses(self):
+        session = FakeSession([503, 500, 504])
+        response, = self._fetch(session)
+        self.assertTrue(response.is_ok())
+        self.assertEqual(response.attempts, 4)
+        self.assertEqual(response.content, b"<passages/>")
+
+    def test_other_statuses_are_not_retried(self):
+        session = FakeSession([404])
+        response, = self._fetch(session)
+        self.assertEqual(response.status, 404)
+        self.assertEqual(response.attempts, 1)
+
+    def test_timeouts_and_client_errors(self):
+        session = FakeSession([ClientConnectionError("refused")])
+        response, = self._fetch(session)
+        self.assertTrue(response.is_ok())
+        self.assertEqual(response.attempts, 2)
+        self.assertIsNone(response.error)
+
+        # Reading takes longer than request timeout
+        session = FakeSession(delay=0.3)
+        self.client.retry_timeout = 0.5
+        response, = self._fetch(session)
+        self.assertFalse(response.is_ok())
+        self.assertIsNone(response.content)
+        self.assertIn("TimeoutError", response.error)
+        self.assertGreater(response.attempts, 1)
+
+    def test_gives_up_after_retry_timeout(self):
+        session = FakeSession([503] * 1000)
+        self.client.retry_timeout = 0.1
+        begin = time.monotonic()
+        response, = self._fetch(session)
+        self.assertLess(time.monotonic() - begin, 1)
+        self.assertEqual(response.status, 503)
+        self.assertFalse(response.is_ok())
+        self.assertEqual(response.attempts, session.requests)
+
+    def test_max_concurrency(self):
+        session = FakeSession(delay=0.05)
+        responses = self._fetch(session, ["8739300%d" % i for i in range(10)])
+        self.assertTrue(all(response.is_ok() for response in responses))
+        self.assertEqual(session.peak, 3)
+
+
+class TestPersistentApiClient(unittest.TestCase):
+
+    def test_loop_is_kept_until_closed(self):
+        """
+        A persistent client reuses its own event loop across batch queries.
+        """
+        with ApiClient(user="user", password="password", persistent=True) as client:
+            loop = client._get_loop()
+            self.assertIs(client._get_loop(), loop)
+            self.assertFalse(loop.is_closed())
+        self.assertTrue(loop.is_closed())
+        self.assertIsNone(client._loop)
+
+    def test_session_is_kept_until_closed(self):
+        """
+        A persistent client reuses the same session and connection pool
+        across batch queries, and releases them once closed.
+        """
+        client = ApiClient(user="user", password="password", persistent=True)
+        session = client.run(client._get_session())
+        connector = session.connector
+        for _ in range(2):
+            self.assertIs(client.run(client._get_session()), session)
+            self.assertIs(session.connector, connector)
+        client.close()
+        self.assertTrue(session.closed)
+        self.assertTrue(connector.closed)
+        self.assertIsNone(client._session)
+
+        # A new session is opened if client is used again
+        with client:
+            self.assertIsNot(client.run(client._get_session()), session)
+
+    def test_rate_limiter_after_close(self):
+        """
+        Requests queued on rate limiter can wait on the new event loop of a
+        client used again once closed.
+        """
+        client = ApiClient(user="user", password="password", persistent=True,
+                           max_per_minute=1201, burst=1)
+
+        async def acquire_several():
+            await asyncio.gather(*[client.rate_limiter.acquire() for _ in range(3)])
+
+        for _ in range(2):
+            with client:
+                client.run(acquire_several())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Tests for utils_archive module.
+"""
+
+from os import path, listdir, utime
+import unittest
+import logging
+import tempfile
+import time
+from datetime import datetime
+from unittest import mock
+
+from api_etl.settings import __BASE_DIR__
+from api_etl.extract_api import parse_api_response
+from api_etl.utils_archive import RealtimeArchive, ARCHIVE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+
+class TestRealtimeArchive(unittest.TestCase):
+
+    def setUp(self):
+        file_path = path.join(__BASE_DIR__, "tests", "files", "api_response.xml")
+        with open(file_path, 'r') as xml_file:
+            xml_string = xml_file.read()
+        request_dt = datetime(2012, 5, 23, 12, 40)
+        self.records = []
+        for station in ["87393009", "87271007", "87000000"]:
+            self.records.extend(
+                parse_api_response(xml_string, station, request_dt))
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.archive = RealtimeArchive(
+            root=self.folder.name,
+            station_lines={"8739300": "C", "8727100": "D"}
+        )
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_append_and_read(self):
+        self.assertEqual(self.archive.append(self.records), len(self.records))
+        self.assertEqual(self.archive.days(), ["20120523"])
+
+        df = self.archive.read("20120523")
+        self.assertEqual(len(df), len(self.records))
+        self.assertEqual(
+            sorted(df.columns), sorted(["day", "line"] + ARCHIVE_COLUMNS))
+        self.assertEqual(sorted(df.line.unique()), ["C", "D", "other"])
+
+        first = df[(df.station_id == "8739300") & (df.train_num == "165303")]\
+            .iloc[0]
+        self.assertEqual(first.expected_passage_seconds, 12 * 3600 + 52 * 60)
+        self.assertEqual(first.data_freshness, 720)
+        self.assertEqual(first.request_datetime, datetime(2012, 5, 23, 12, 40))
+
+        # Filters and projection
+        df = self.archive.read(
+            "20120520", "20120530", lines=["C"], columns=["train_num"])
+        self.assertEqual(list(df.columns), ["train_num"])
+        self.assertEqual(len(df), len(self.records) // 3)
+        df = self.archive.read("20120523", stations=["8727100"])
+        self.assertEqual(set(df.line), {"D"})
+        self.assertEqual(len(self.archive.read("20120524")), 0)
+
+    def test_compact(self):
+        # Two cycles, second one with the same departures
+        self.archive.append(self.records)
+        self.archive.append(self.records)
+        self.assertEqual(len(self.archive.read("20120523")), 2 * len(self.records))
+
+        self.archive.compact("20120523")
+        partition = path.join(self.folder.name, "day=20120523", "line=C")
+        self.assertEqual(listdir(partition), ["data.parquet"])
+        df = self.archive.read("20120523")
+        self.assertEqual(len(df), len(self.records))
+
+        # New parts are merged at next compaction
+        self.archive.append(self.records[:2])
+        self.archive.compact("20120523")
+        self.assertEqual(len(self.archive.read("20120523")), len(self.records))
+
+    def test_concurrent_compact(self):
+        """
+        Partitions locked, or compacted meanwhile, by another process are
+        skipped.
+        """
+        self.archive.append(self.records)
+        self.archive.append(self.records)
+        partition = path.join(self.folder.name, "day=20120523", "line=C")
+        lock_path = path.join(partition, "_compact.lock")
+        open(lock_path, "w").close()
+        self.archive.compact("20120523")
+        self.assertEqual(len(listdir(partition)), 3)
+        self.assertEqual(
+            len(listdir(path.join(self.folder.name, "day=20120523", "line=D"))), 1)
+
+        # Stale lock of a crashed process
+        utime(lock_path, (time.time() - 7200, time.time() - 7200))
+        self.archive.compact("20120523")
+        self.assertEqual(listdir(partition), ["data.parquet"])
+
+        # Parts removed by another process after listing
+        self.archive.append(self.records)
+        with mock.patch("api_etl.utils_archive.pq.read_table",
+                        side_effect=FileNotFoundError("part")):
+            self.archive.compact("20120523")
+        self.assertNotIn("_compact.lock", listdir(partition))
+        self.assertEqual(len(self.archive.read("20120523")), 2 * len(self.records))
+
+    def test_prune(self):
+        self.archive.append(self.records)
+        self.archive.keep_days = 2
+        self.assertEqual(self.archive.prune("20120525"), [])
+        self.assertEqual(self.archive.prune("20120526"), ["20120523"])
+        self.assertEqual(self.archive.days(), [])
+        self.assertEqual(len(self.archive.read("20120523")), 0)
+
+        # All days kept
+        self.archive.append(self.records)
+        self.archive.keep_days = None
+        self.assertEqual(self.archive.prune("20200101"), [])
+        self.assertEqual(self.archive.days(), ["20120523"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Tests for utils_calendar module.
+"""
+
+import unittest
+import logging
+
+import pandas as pd
+
+from api_etl.utils_calendar import ServiceCalendar
+
+logger = logging.getLogger(__name__)
+
+
+class TestServiceCalendar(unittest.TestCase):
+
+    def setUp(self):
+        calendars = pd.DataFrame(
+            [["WEEK", "1", "1", "1", "1", "1", "0", "0", "20170201", "20170228"],
+             ["WEEKEND", "0", "0", "0", "0", "0", "1", "1", "20170201", "20170228"],
+             ["MARCH", "1", "1", "1", "1", "1", "1", "1", "20170301", "20170305"]],
+            columns=["service_id", "monday", "tuesday", "wednesday", "thursday",
+                     "friday", "saturday", "sunday", "start_date", "end_date"])
+        calendar_dates = pd.DataFrame(
+            [["WEEK", "20170215", "2"], ["WEEKEND", "20170215", "1"],
+             ["MARCH", "20170310", "1"], ["UNKNOWN", "20170215", "1"]],
+            columns=["service_id", "date", "exception_type"])
+        self.calendar = ServiceCalendar(calendars, calendar_dates)
+
+    def test_active_services(self):
+        # Tuesday
+        self.assertEqual(self.calendar.active_services("20170214"), ["WEEK"])
+        # Saturday
+        self.assertEqual(self.calendar.active_services("20170218"), ["WEEKEND"])
+        # Exceptions: removed, and added
+        self.assertEqual(self.calendar.active_services("20170215"), ["WEEKEND"])
+        self.assertEqual(self.calendar.active_services("20170310"), ["MARCH"])
+        self.assertEqual(self.calendar.active_services("20170308"), [])
+        # Outside validity window
+        self.assertEqual(self.calendar.active_services("20170131"), [])
+        self.assertEqual(self.calendar.active_services("20170311"), [])
+
+    def test_bitmap(self):
+        days = self.calendar.days
+        self.assertEqual(days[0], "20170201")
+        self.assertEqual(days[-1], "20170310")
+        # One byte per day for 3 services
+        self.assertEqual(self.calendar.bitmap.shape, (len(days), 1))
+        self.assertEqual(
+            list(self.calendar.active_mask("20170301")), [False, False, True])
+
+    def test_empty(self):
+        calendar = ServiceCalendar(
+            pd.DataFrame(columns=["service_id", "monday", "tuesday", "wednesday",
+                                  "thursday", "friday", "saturday", "sunday",
+                                  "start_date", "end_date"]),
+            pd.DataFrame(columns=["service_id", "date", "exception_type"]))
+        self.assertEqual(calendar.days, [])
+        self.assertEqual(calendar.active_services("20170215"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
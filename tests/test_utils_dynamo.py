@@ -0,0 +1,193 @@
+"""
+Tests for utils_dynamo module.
+"""
+
+import unittest
+import logging
+import threading
+import time
+import tempfile
+from os import path
+from datetime import datetime
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from pynamodb.exceptions import PutError
+
+from api_etl.utils_dynamo import DynamoBatchWriter, CapacityPacer, WriteSkipCache
+from api_etl.data_models import RealTimeDeparture
+
+logger = logging.getLogger(__name__)
+
+
+class FakeConnection:
+    """
+    Local stand-in for pynamodb low-level connection: rejects the last item
+    of the first "reject_calls" requests as unprocessed (only for requests
+    of more than one item, unless "reject_single" is set), after raising
+    errors of "error_codes" (one per request).
+    """
+
+    def __init__(self, table_name, reject_calls=0, reject_single=False, error_codes=()):
+        self.table_name = table_name
+        self.reject_calls = reject_calls
+        self.error_codes = list(error_codes)
+        self.min_rejected = 1 if reject_single else 2
+        self.requests = []
+        self.written = []
+        self._lock = threading.Lock()
+
+    def batch_write_item(self, put_items=None, delete_items=None):
+        with self._lock:
+            self.requests.append(len(put_items))
+            if self.error_codes:
+                # As raised by pynamodb connection
+                raise PutError("Failed to batch write items", ClientError(
+                    {"Error": {"Code": self.error_codes.pop(0), "Message": ""}},
+                    "BatchWriteItem"))
+            if self.reject_calls > 0 and len(put_items) >= self.min_rejected:
+                self.reject_calls -= 1
+                self.written.extend(put_items[:-1])
+                return {"UnprocessedItems": {self.table_name: [
+                    {"PutRequest": {"Item": put_items[-1]}}
+                ]}}
+            self.written.extend(put_items)
+            return {"UnprocessedItems": {}}
+
+
+def build_departures(n):
+    return (
+        RealTimeDeparture(
+            station_id="8727100", day_train_num="20170215_%s" % i,
+            date="16/02/2017 01:26", station_8d="87271007",
+            train_num=str(i), term="87384008",
+            expected_passage_day="20170215", expected_passage_time="25:26:00",
+            request_day="20170215", request_time="23:26:00",
+            data_freshness="7200"
+        )
+        for i in range(n)
+    )
+
+
+class TestDynamoBatchWriter(unittest.TestCase):
+
+    def test_batches_and_unprocessed_items(self):
+        """
+        Items are sent by batches of 25, unprocessed items are sent again.
+        """
+        connection = FakeConnection(RealTimeDeparture.Meta.table_name, reject_calls=2)
+        with DynamoBatchWriter(RealTimeDeparture, connection=connection, workers=3,
+                               base_backoff=0.001) as writer:
+            stats = writer.write(build_departures(60))
+
+        self.assertEqual(stats["saved"], 60)
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["throttled"], 2)
+        self.assertEqual(stats["failed"], 0)
+        self.assertEqual(len(connection.written), 60)
+        self.assertLessEqual(max(connection.requests), 25)
+        self.assertEqual(writer.counters["saved"], 60)
+
+    def test_throttling_errors(self):
+        """
+        Requests rejected with a throttling error are sent again, items are
+        sent as attribute maps.
+        """
+        connection = FakeConnection(
+            RealTimeDeparture.Meta.table_name,
+            error_codes=["ProvisionedThroughputExceededException", "ThrottlingException"])
+        with DynamoBatchWriter(RealTimeDeparture, connection=connection, workers=1,
+                               base_backoff=0.001) as writer:
+            stats = writer.write(build_departures(10))
+        self.assertEqual(stats["throttled"], 2)
+        self.assertEqual(stats["saved"], 10)
+        self.assertEqual(connection.written[0]["station_id"], {"S": "8727100"})
+        self.assertEqual(connection.written[0]["train_num"], {"S": "0"})
+
+        # Other errors are raised
+        connection = FakeConnection(
+            RealTimeDeparture.Meta.table_name, error_codes=["ValidationException"])
+        with DynamoBatchWriter(RealTimeDeparture, connection=connection) as writer:
+            self.assertRaises(PutError, writer.write, build_departures(1))
+
+    def test_max_retries(self):
+        connection = FakeConnection(
+            RealTimeDeparture.Meta.table_name, reject_calls=10, reject_single=True)
+        writer = DynamoBatchWriter(RealTimeDeparture, connection=connection, workers=1,
+                                   max_retries=2, base_backoff=0.001)
+        stats = writer.write(build_departures(10))
+        writer.close()
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["saved"], 9)
+
+    def test_pacing(self):
+        """
+        Writes do not exceed write capacity (units per second).
+        """
+        connection = FakeConnection(RealTimeDeparture.Meta.table_name)
+        with DynamoBatchWriter(RealTimeDeparture, connection=connection,
+                               write_capacity=100) as writer:
+            begin = time.monotonic()
+            writer.write(build_departures(150))
+            elapsed = time.monotonic() - begin
+        # First 100 units are available at once, 50 more take half a second
+        self.assertGreater(elapsed, 0.4)
+
+    def test_pacer_burst(self):
+        pacer = CapacityPacer(rate=10, capacity=5)
+        begin = time.monotonic()
+        pacer.acquire(5)
+        self.assertLess(time.monotonic() - begin, 0.1)
+        pacer.acquire(2)
+        self.assertGreater(time.monotonic() - begin, 0.15)
+
+
+class TestWriteSkipCache(unittest.TestCase):
+
+    def test_unchanged_departures_are_skipped(self):
+        cache = WriteSkipCache(fields=["date", "etat", "miss", "term"])
+        self.assertEqual(len(list(cache.filter(build_departures(10)))), 10)
+        cache.commit()
+
+        departures = list(build_departures(10))
+        departures[3].etat = "Retardé"
+        changed = list(cache.filter(departures))
+        self.assertEqual([d.train_num for d in changed], ["3"])
+        self.assertEqual(cache.counters["skipped"], 9)
+        self.assertAlmostEqual(cache.skipped_ratio(), 9 / 20.)
+
+        # Not committed (write failed): written again next time
+        cache.rollback()
+        self.assertEqual(len(list(cache.filter(departures))), 1)
+
+    def test_eviction_and_persistence(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache_path = path.join(folder, "write_cache.pickle")
+            cache = WriteSkipCache(path=cache_path, keep_days=1)
+            list(cache.filter(build_departures(5)))
+            cache.commit()
+            cache.save()
+
+            loaded = WriteSkipCache(path=cache_path, keep_days=1)
+            self.assertEqual(len(loaded), 5)
+            self.assertEqual(len(list(loaded.filter(build_departures(5)))), 0)
+
+            # Departures of 20170215 are kept the day after, not later
+            loaded.evict(today="20170216")
+            self.assertEqual(len(loaded), 5)
+            loaded.evict(today="20170217")
+            self.assertEqual(len(loaded), 0)
+
+    def test_eviction_default_day_is_paris_day(self):
+        cache = WriteSkipCache(keep_days=1)
+        list(cache.filter(build_departures(5)))
+        cache.commit()
+        # Already 20170217 in Paris, while still 20170216 in UTC
+        with mock.patch("api_etl.utils_dynamo.get_paris_local_datetime_now",
+                        return_value=datetime(2017, 2, 17, 0, 30)):
+            cache.evict()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
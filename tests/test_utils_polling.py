@@ -0,0 +1,197 @@
+"""
+Tests for utils_polling module.
+"""
+
+import unittest
+import logging
+from datetime import datetime, timedelta
+
+from api_etl.utils_polling import (
+    StationSchedule, AdaptivePollingScheduler, PassagePoller,
+    service_day_and_seconds
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TestStationSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.schedule = StationSchedule.from_departure_times("20170215", [
+            ("StopPoint:DUA8727100", "12:00:00"),
+            ("StopPoint:DUA8727100", "25:10:00"),
+            ("StopPoint:DUA8727100", "08:00:00"),
+            ("StopPoint:DUA8738400", "07:00:00"),
+            ("StopPoint:DUA8738400", None),
+        ])
+
+    def test_service_day_and_seconds(self):
+        self.assertEqual(
+            service_day_and_seconds(datetime(2017, 2, 16, 1, 26)),
+            ("20170215", 91560)
+        )
+        self.assertEqual(
+            service_day_and_seconds(datetime(2017, 2, 15, 12, 0)),
+            ("20170215", 43200)
+        )
+
+    def test_seconds_to_next_passage(self):
+        self.assertEqual(len(self.schedule), 2)
+        # 8 and 7 digits formats
+        self.assertEqual(
+            self.schedule.seconds_to_next_passage("87271007", 11 * 3600), 3600)
+        self.assertEqual(
+            self.schedule.seconds_to_next_passage("8727100", 12 * 3600), 0)
+        self.assertEqual(
+            self.schedule.seconds_to_next_passage("8727100", 25 * 3600), 600)
+        self.assertIsNone(
+            self.schedule.seconds_to_next_passage("8738400", 8 * 3600))
+        self.assertIsNone(
+            self.schedule.seconds_to_next_passage("8700000", 0))
+
+
+class TestAdaptivePollingScheduler(unittest.TestCase):
+
+    def setUp(self):
+        # Station 1 has passages every 10 minutes from 6:00 to 24:00, station
+        # 2 only once at 12:00, station 3 never
+        departure_times = [
+            ("StopPoint:DUA1000001", "%02d:%02d:00" % (h, m))
+            for h in range(6, 24) for m in range(0, 60, 10)
+        ] + [("StopPoint:DUA2000002", "12:00:00")]
+        self.schedule = StationSchedule.from_departure_times(
+            "20170215", departure_times)
+        self.stations = ["10000010", "20000020", "30000030"]
+
+    def run_cycles(self, scheduler, begin, n, status=200):
+        polled = []
+        for i in range(n):
+            now = begin + timedelta(seconds=120 * i)
+            selected = scheduler.select(now=now)
+            scheduler.record({}, {station: status for station in selected})
+            polled.append(selected)
+        return polled
+
+    def test_imminent_stations_are_polled_each_cycle(self):
+        scheduler = AdaptivePollingScheduler(
+            self.stations, schedule=self.schedule, idle_interval=600,
+            unresponsive_after=100)
+        polled = self.run_cycles(scheduler, datetime(2017, 2, 15, 8, 0), 10)
+        counts = {s: sum(s in p for p in polled) for s in self.stations}
+        self.assertEqual(counts["10000010"], 10)
+        # Idle stations: first cycle, then every 10 minutes
+        self.assertEqual(counts["20000020"], 2)
+        self.assertEqual(counts["30000030"], 2)
+
+    def test_without_schedule_all_stations_are_polled(self):
+        scheduler = AdaptivePollingScheduler(self.stations)
+        polled = self.run_cycles(scheduler, datetime(2017, 2, 15, 8, 0), 3)
+        self.assertTrue(all(len(p) == 3 for p in polled))
+
+    def test_budget(self):
+        scheduler = AdaptivePollingScheduler(
+            self.stations, schedule=self.schedule, max_per_minute=1)
+        self.assertEqual(scheduler.budget, 2)
+        selected = scheduler.select(now=datetime(2017, 2, 15, 11, 50))
+        # Closest passages first
+        self.assertEqual(selected, ["10000010", "20000020"])
+        self.assertEqual(scheduler.counters["deferred"], 1)
+
+    def test_unresponsive_stations(self):
+        scheduler = AdaptivePollingScheduler(
+            self.stations, schedule=self.schedule, unresponsive_after=2,
+            unresponsive_interval=1200, idle_interval=600)
+        polled = self.run_cycles(scheduler, datetime(2017, 2, 15, 8, 0), 12)
+        # Polled twice without answer, then every 20 minutes
+        self.assertEqual(
+            [i for i, p in enumerate(polled) if "10000010" in p], [0, 1, 11])
+
+        # Station answers again: polled at each cycle
+        scheduler.record({"10000010": 12}, {"10000010": 200})
+        selected = scheduler.select(now=datetime(2017, 2, 15, 8, 24))
+        self.assertIn("10000010", selected)
+
+    def test_failed_requests_are_not_empty_polls(self):
+        """
+        API errors and unanswered requests do not make stations unresponsive.
+        """
+        scheduler = AdaptivePollingScheduler(
+            self.stations, schedule=self.schedule, unresponsive_after=2,
+            unresponsive_interval=1200, idle_interval=600)
+        for begin, status in ((datetime(2017, 2, 15, 8, 0), 503),
+                              (datetime(2017, 2, 15, 8, 12), None)):
+            polled = self.run_cycles(scheduler, begin, 6, status=status)
+            self.assertTrue(all("10000010" in p for p in polled))
+        self.assertEqual(scheduler._empty_polls["10000010"], 0)
+        self.assertGreater(scheduler.counters["failed_polls"], 0)
+
+
+class TestPassagePoller(unittest.TestCase):
+
+    def setUp(self):
+        # Station 1: passages at 8:00, 8:01, 8:30, station 2: at 9:00
+        self.schedule = StationSchedule.from_departure_times("20170215", [
+            ("StopPoint:DUA1000001", "08:00:00"),
+            ("StopPoint:DUA1000001", "08:01:00"),
+            ("StopPoint:DUA1000001", "08:30:00"),
+            ("StopPoint:DUA2000002", "09:00:00"),
+        ])
+        self.poller = PassagePoller(
+            self.schedule, ["10000010", "20000020", "30000030"], lead=180,
+            min_interval=120)
+
+    def test_polls_just_before_passages(self):
+        # Starts at 7:00: first polls at 7:57 and 8:57
+        self.poller.start(7 * 3600)
+        self.assertEqual(len(self.poller), 2)
+        self.assertEqual(self.poller.next_poll_seconds(), 7 * 3600 + 57 * 60)
+        self.assertEqual(self.poller.pop_due(7 * 3600 + 56 * 60), [])
+
+        polls = []
+        for now in range(7 * 3600, 10 * 3600, 10):
+            for station in self.poller.pop_due(now):
+                polls.append((station, now))
+
+        self.assertEqual(polls, [
+            ("10000010", 7 * 3600 + 57 * 60),
+            # 8:01 passage: min interval after previous poll
+            ("10000010", 7 * 3600 + 59 * 60),
+            ("10000010", 8 * 3600 + 27 * 60),
+            ("20000020", 8 * 3600 + 57 * 60),
+        ])
+        self.assertEqual(self.poller.counters["passages"], 4)
+        self.assertAlmostEqual(self.poller.polls_per_passage(), 1.)
+
+    def test_close_passages_share_polls(self):
+        poller = PassagePoller(self.schedule, ["10000010"], lead=300,
+                               min_interval=120)
+        poller.start(7 * 3600)
+        # 7:55 poll covers 8:00 passage, 8:01 is polled 2 minutes later and
+        # covers until 8:02
+        self.assertEqual(poller.pop_due(7 * 3600 + 55 * 60), ["10000010"])
+        self.assertEqual(poller.next_poll_seconds(), 7 * 3600 + 57 * 60)
+        self.assertEqual(len(poller), 1)
+        self.assertEqual(poller.pop_due(7 * 3600 + 57 * 60), ["10000010"])
+        # Only 8:30 passage is left
+        self.assertEqual(len(poller), 1)
+        self.assertEqual(poller.next_poll_seconds(), 8 * 3600 + 25 * 60)
+        self.assertEqual(poller.pop_due(8 * 3600 + 25 * 60), ["10000010"])
+        # No passage left
+        self.assertEqual(len(poller), 0)
+        self.assertIsNone(poller.next_poll_seconds())
+        self.assertEqual(poller.counters["polls"], 3)
+        self.assertEqual(poller.counters["passages"], 3)
+
+    def test_quota(self):
+        self.poller.start(9 * 3600 + 60)
+        self.assertEqual(len(self.poller), 0)
+
+        self.poller.start(7 * 3600)
+        due = self.poller.pop_due(9 * 3600, max_count=1)
+        # Most late first
+        self.assertEqual(due, ["10000010"])
+        self.assertEqual(self.poller.counters["deferred"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
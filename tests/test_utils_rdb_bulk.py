@@ -0,0 +1,292 @@
+"""
+Tests for utils_rdb_bulk module, on a sqlite database, and statements sent
+to Postgres (recorded, without server).
+"""
+
+from os import path
+import unittest
+import logging
+import tempfile
+from contextlib import contextmanager
+from unittest import mock
+
+import pandas as pd
+from sqlalchemy import inspect, create_mock_engine
+from sqlalchemy.sql import text
+
+from api_etl.utils_rdb import RdbProvider
+from api_etl.utils_rdb_bulk import GtfsBulkLoader, GTFS_TABLES
+from api_etl.data_models import Trip, Route, StopTime, CalendarDate, ServiceDay, TripExtent
+from tests.test_querier_memory import write_gtfs_folder
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingPostgres:
+    """
+    Stand-in for a Postgres provider, engine, connection and driver
+    connection at once: records statements (compiled for Postgres) and csv
+    sent with COPY.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+        self._mock = create_mock_engine("postgresql://", self.execute)
+        self.dialect = self._mock.dialect
+        self.connection = self
+
+    def __getattr__(self, name):
+        # DDL visitors (create, drop) of mock engine
+        return getattr(self._mock, name)
+
+    def get_engine(self):
+        return self
+
+    @contextmanager
+    def begin(self):
+        yield self
+
+    def execute(self, statement, *multiparams, **params):
+        self.statements.append(str(statement.compile(dialect=self.dialect)).strip())
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, file):
+        self.statements.append(sql)
+        self.copied.append(file.read())
+
+
+class FakeInspector:
+    """Tables of database, and columns having foreign keys per table."""
+
+    def __init__(self, tables, foreign_keys):
+        self.tables = tables
+        self.foreign_keys = foreign_keys
+
+    def get_table_names(self):
+        return list(self.tables)
+
+    def get_foreign_keys(self, table_name):
+        return [{"constrained_columns": list(columns)}
+                for columns in self.foreign_keys.get(table_name, [])]
+
+
+class TestGtfsBulkLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        write_gtfs_folder(self.folder.name)
+        self.provider = RdbProvider(
+            "sqlite:///%s" % path.join(self.folder.name, "gtfs.db"))
+        self.engine = self.provider.get_engine()
+        # Small chunks: several per file
+        self.loader = GtfsBulkLoader(self.provider, self.folder.name, chunksize=5)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.folder.cleanup()
+
+    def query(self, sql):
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(text(sql))]
+
+    def rewrite(self, name, transform):
+        file_path = path.join(self.folder.name, name)
+        transform(pd.read_csv(file_path, dtype=str)).to_csv(file_path, index=False)
+
+    def test_load(self):
+        rows = self.loader.load()
+        self.assertEqual(rows["trips"], 4)
+        self.assertEqual(rows["stop_times"], 3 + 3 + 11 + 2)
+
+        tables = set(inspect(self.engine).get_table_names())
+        for _, model in GTFS_TABLES:
+            self.assertIn(model.__tablename__, tables)
+            self.assertNotIn(model.__tablename__ + "_staging", tables)
+
+        # Values as written, typed columns computed
+        self.assertEqual(
+            self.query("SELECT direction_id FROM trips WHERE trip_id = 'T2'"), [("1",)])
+        self.assertEqual(self.query(
+            "SELECT stop_sequence_number, arrival_seconds, departure_seconds "
+            "FROM stop_times WHERE trip_id = 'T1' ORDER BY stop_sequence_number"
+        ), [(i, 8 * 3600 + 600 * i - 60, 8 * 3600 + 600 * i) for i in range(3)])
+
+        indexes = {i["name"] for i in inspect(self.engine).get_indexes("stop_times")}
+        self.assertIn("ix_stop_times_stop_departure", indexes)
+        self.assertIn("ix_stop_times_trip_sequence", indexes)
+
+        # Computed tables
+        self.assertEqual(rows["service_days"], 19 + 24)
+        self.assertEqual(rows["trip_extents"], 4)
+        self.assertNotIn("service_days_staging", tables)
+        self.assertIn(
+            "ix_trip_extents_line_departure",
+            {i["name"] for i in inspect(self.engine).get_indexes("trip_extents")})
+
+        # Schedule version recorded
+        self.assertEqual(self.query("SELECT count(*) FROM schedule_versions"), [(1,)])
+
+    def test_reload(self):
+        self.loader.load()
+        # Removed trip, changed headsign, duplicated primary key (last kept),
+        # and column unknown to model
+        self.rewrite("trips.txt", lambda df: pd.concat([
+            df[df.trip_id != "T4"].assign(trip_headsign="WXYZ", unknown="x"),
+            df[df.trip_id == "T1"].assign(trip_headsign="LAST", unknown="x"),
+        ]))
+        rows = self.loader.load([("trips.txt", Trip)])
+        self.assertEqual(rows["trips"], 4)
+        self.assertEqual(self.query(
+            "SELECT trip_id, trip_headsign FROM trips ORDER BY trip_id"
+        ), [("T1", "LAST"), ("T2", "WXYZ"), ("T3", "WXYZ")])
+        self.assertIn(
+            "ix_trips_service_id",
+            {i["name"] for i in inspect(self.engine).get_indexes("trips")})
+        # Other tables untouched
+        self.assertEqual(self.query("SELECT count(*) FROM stop_times"), [(19,)])
+
+    def test_failed_load(self):
+        self.loader.load()
+        # File without primary key column: staging load fails
+        self.rewrite("trips.txt", lambda df: df.drop("trip_id", axis=1))
+        with self.assertRaises(ValueError):
+            self.loader.load([("trips.txt", Trip)])
+        self.assertEqual(self.query("SELECT count(*) FROM trips"), [(4,)])
+
+    def test_failed_swap(self):
+        self.loader.load()
+        self.loader.load_staging("trips.txt", Trip)
+        # Second model has no staging table: swap is rolled back
+        with self.assertRaises(Exception):
+            self.loader.swap([Trip, Route])
+        self.assertEqual(self.query("SELECT count(*) FROM trips"), [(4,)])
+        self.assertEqual(self.query("SELECT count(*) FROM routes"), [(3,)])
+        self.assertEqual(self.query("SELECT count(*) FROM schedule_versions"), [(1,)])
+
+    def test_derived_tables(self):
+        """
+        Computed tables are swapped with tables they are computed from.
+        """
+        self.loader.load()
+        # S2 no longer added on 15th of february
+        self.rewrite("calendar_dates.txt", lambda df: df[df.service_id != "S2"])
+        self.loader.load_staging("calendar_dates.txt", CalendarDate)
+        # Computed from calendar dates staging table
+        self.assertEqual(
+            self.loader.load_derived([CalendarDate]), {"service_days": 19 + 23})
+        # Failed swap: former computed table is kept
+        with self.assertRaises(Exception):
+            self.loader.swap([CalendarDate, ServiceDay, Route])
+        self.assertEqual(self.query("SELECT count(*) FROM service_days"), [(19 + 24,)])
+        self.assertEqual(self.query(
+            "SELECT count(*) FROM service_days WHERE date = '20170215'"), [(1,)])
+
+        rows = self.loader.load([("calendar_dates.txt", CalendarDate)])
+        self.assertEqual(set(rows), {"calendar_dates", "service_days"})
+        self.assertEqual(self.query(
+            "SELECT count(*) FROM service_days WHERE date = '20170215'"), [(0,)])
+        self.assertEqual(self.query(
+            "SELECT tables FROM schedule_versions ORDER BY loaded_at DESC LIMIT 1"),
+            [("calendar_dates,service_days",)])
+        # Trips extents untouched
+        self.assertEqual(self.query("SELECT count(*) FROM trip_extents"), [(4,)])
+
+
+class TestGtfsBulkLoaderPostgres(unittest.TestCase):
+    """
+    Statements sent to Postgres: COPY of chunks, deduplication, swap with
+    foreign keys restored.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        write_gtfs_folder(self.folder.name)
+        self.postgres = RecordingPostgres()
+        self.loader = GtfsBulkLoader(self.postgres, self.folder.name, chunksize=3)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_copy(self):
+        rows = self.loader.load_staging("trips.txt", Trip)
+        self.assertEqual(rows, 4)
+        statements = self.postgres.statements
+        self.assertEqual(statements[0], "DROP TABLE trips_staging")
+        # Staging table without primary key
+        self.assertTrue(statements[1].startswith("CREATE TABLE trips_staging"))
+        self.assertNotIn("PRIMARY KEY", statements[1])
+        # Two chunks, with model's columns order
+        copy = ("COPY trips_staging (trip_id, route_id, service_id, trip_headsign, "
+                "direction_id) FROM STDIN WITH (FORMAT csv)")
+        self.assertEqual(statements[2:4], [copy, copy])
+        self.assertEqual(self.postgres.copied[0].splitlines()[0], "T1,R_C,S1,ABCD,0")
+        self.assertEqual(sum(len(c.splitlines()) for c in self.postgres.copied), 4)
+        self.assertTrue(statements[4].startswith("DELETE FROM trips_staging a"))
+        self.assertEqual(
+            statements[5],
+            "ALTER TABLE trips_staging ADD CONSTRAINT trips_staging_pkey "
+            "PRIMARY KEY (trip_id)")
+
+    def test_copy_null_values(self):
+        # Invalid time: typed column is NULL, sent as unquoted empty value
+        self.rewrite_first_departure("xx:00:00")
+        self.loader.load_staging("stop_times.txt", StopTime)
+        first, second = self.postgres.copied[0].splitlines()[:2]
+        self.assertIn(",xx:00:00,", first)
+        self.assertTrue(first.endswith(",28740,"), first)
+        # Other values of column stay integers
+        self.assertTrue(second.endswith(",29340,29400"), second)
+
+    def rewrite_first_departure(self, value):
+        file_path = path.join(self.folder.name, "stop_times.txt")
+        df = pd.read_csv(file_path, dtype=str)
+        df.loc[0, "departure_time"] = value
+        df.to_csv(file_path, index=False)
+
+    def test_deduplicate(self):
+        staging = self.loader._staging_table(StopTime)
+        self.loader._deduplicate(self.postgres, staging, StopTime)
+        self.assertEqual(self.postgres.statements, [
+            "DELETE FROM stop_times_staging a USING stop_times_staging b "
+            "WHERE a.ctid < b.ctid AND a.trip_id = b.trip_id AND a.stop_id = b.stop_id",
+            "ALTER TABLE stop_times_staging ADD CONSTRAINT stop_times_staging_pkey "
+            "PRIMARY KEY (trip_id, stop_id)"
+        ])
+
+    def test_swap(self):
+        tables = {model.__tablename__ for _, model in GTFS_TABLES} - {"agencies"}
+        tables.add("trip_extents")
+        # Foreign key of stop times to stops was not dropped
+        inspector = FakeInspector(tables, {"stop_times": [("stop_id",)]})
+        with mock.patch("api_etl.utils_rdb_bulk.inspect", lambda connection: inspector):
+            self.loader.swap([Trip, TripExtent])
+        statements = self.postgres.statements
+
+        self.assertEqual(statements[:3], [
+            "DROP TABLE trips CASCADE",
+            "ALTER TABLE trips_staging RENAME TO trips",
+            "ALTER INDEX trips_staging_pkey RENAME TO trips_pkey",
+        ])
+        self.assertEqual(
+            statements.index("DROP TABLE trip_extents CASCADE"), 3 + len(Trip.__table__.indexes))
+        self.assertIn("CREATE INDEX ix_trips_service_id ON trips (service_id)", statements)
+        self.assertIn(
+            "CREATE INDEX ix_trip_extents_line_departure ON trip_extents "
+            "(route_short_name, first_departure)", statements)
+
+        # Foreign keys dropped by CASCADE are created again, if referred
+        # table exists
+        foreign_keys = [s for s in statements if "ADD FOREIGN KEY" in s]
+        self.assertEqual(sorted(foreign_keys), [
+            "ALTER TABLE stop_times ADD FOREIGN KEY(trip_id) REFERENCES trips (trip_id)",
+            "ALTER TABLE trips ADD FOREIGN KEY(route_id) REFERENCES routes (route_id)",
+        ])
+        # Then schedule version, in same transaction
+        self.assertTrue(statements[-1].startswith("INSERT INTO schedule_versions"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Tests for utils_rdb_migration module, on a sqlite database created with
+former schedule schema (string columns only, no indexes).
+"""
+
+from os import path
+import unittest
+import logging
+import tempfile
+
+from sqlalchemy import inspect
+from sqlalchemy.sql import text
+
+from api_etl.utils_rdb import RdbProvider
+from api_etl.utils_rdb_migration import migrate_schedule_schema
+
+logger = logging.getLogger(__name__)
+
+LEGACY_SCHEMA = [
+    """CREATE TABLE trips (
+        trip_id VARCHAR(50) PRIMARY KEY, route_id VARCHAR(50),
+        service_id VARCHAR(50), trip_headsign VARCHAR(50),
+        direction_id VARCHAR(50), block_id VARCHAR(50))""",
+    """CREATE TABLE stop_times (
+        trip_id VARCHAR(50), stop_id VARCHAR(50), arrival_time VARCHAR(50),
+        departure_time VARCHAR(50), stop_sequence VARCHAR(50),
+        stop_headsign VARCHAR(50), pickup_type VARCHAR(50),
+        drop_off_type VARCHAR(50), PRIMARY KEY (trip_id, stop_id))""",
+]
+
+STOP_TIMES = [
+    ("T1", "S1", "08:00:00", "08:01:00", "0"),
+    ("T1", "S2", "9:05:00", "9:05:30", "9"),
+    ("T1", "S3", "25:10:00", "25:10:00", "10"),
+    ("T1", "S4", "nan", "nan", "11"),
+]
+
+
+class TestScheduleMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.provider = RdbProvider(
+            "sqlite:///%s" % path.join(self.folder.name, "legacy.db"))
+        with self.provider.get_engine().begin() as connection:
+            for statement in LEGACY_SCHEMA:
+                connection.execute(text(statement))
+            for row in STOP_TIMES:
+                connection.execute(text(
+                    "INSERT INTO stop_times (trip_id, stop_id, arrival_time, "
+                    "departure_time, stop_sequence) VALUES (:t, :s, :a, :d, :q)"
+                ), dict(zip(["t", "s", "a", "d", "q"], row)))
+
+    def tearDown(self):
+        self.provider.get_engine().dispose()
+        self.folder.cleanup()
+
+    def test_migrate(self):
+        added, updated = migrate_schedule_schema(self.provider)
+        self.assertIn("stop_times.departure_seconds", added)
+        self.assertIn("ix_stop_times_stop_departure", added)
+        self.assertIn("ix_trips_service_id", added)
+        # Missing tables are created
+        self.assertIn("calendar_dates", added)
+        self.assertEqual(updated["departure_seconds"], 3)
+        self.assertEqual(updated["stop_sequence_number"], 4)
+
+        inspector = inspect(self.provider.get_engine())
+        indexes = {i["name"]: i["column_names"] for i in inspector.get_indexes("stop_times")}
+        self.assertEqual(
+            indexes["ix_stop_times_stop_departure"], ["stop_id", "departure_seconds"])
+
+        with self.provider.get_engine().connect() as connection:
+            rows = connection.execute(text(
+                "SELECT stop_id, stop_sequence_number, arrival_seconds, departure_seconds "
+                "FROM stop_times ORDER BY stop_sequence_number")).fetchall()
+        self.assertEqual([tuple(row) for row in rows], [
+            ("S1", 0, 8 * 3600, 8 * 3600 + 60),
+            ("S2", 9, 9 * 3600 + 300, 9 * 3600 + 330),
+            ("S3", 10, 25 * 3600 + 600, 25 * 3600 + 600),
+            ("S4", 11, None, None),
+        ])
+
+        # Nothing left to do
+        added, updated = migrate_schedule_schema(self.provider)
+        self.assertEqual(added, [])
+        self.assertEqual(updated["departure_seconds"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Tests for utils_training_set module.
+"""
+
+from os import path, utime
+import unittest
+import logging
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from api_etl.utils_training_set import (
+    TrainingSetStore, TrainingArrayCache, save_raw_day, load_raw_day
+)
+
+logger = logging.getLogger(__name__)
+
+ID_COLS = ["Route_route_short_name", "Trip_trip_id", "Stop_stop_id", "TS_sequence_diff"]
+
+
+def build_training_set(rows_per_line=20, lines=("C", "D")):
+    """
+    Training set like DirectPredictionMatrix's ones: identifiers copied in
+    "_ix" index, and a duplicated column.
+    """
+    rows = []
+    for line in lines:
+        for i in range(rows_per_line):
+            rows.append({
+                "Route_route_short_name": line,
+                "Trip_trip_id": "DUASN%s%d" % (line, i % 4),
+                "Stop_stop_id": "StopPoint:DUA87%05d" % (i % 7),
+                "TS_sequence_diff": float(i % 10 + 1),
+                "TS_last_observed_delay": float(i * 30),
+                "label": float(i * 60),
+                "P_naive_pred": float(i * 30),
+                "D_business_day": bool(i % 2),
+            })
+    df = pd.DataFrame(rows)
+    for col in ID_COLS:
+        df[col + "_ix"] = df[col]
+    df = df.set_index([col + "_ix" for col in ID_COLS])
+    # Features and identifiers overlap in DirectPredictionMatrix
+    return pd.concat([df, df[["TS_sequence_diff"]]], axis=1)
+
+
+class TestTrainingSetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = TrainingSetStore(tempo=30, root=self.folder.name)
+        self.df = build_training_set()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_save_and_load(self):
+        written = self.store.save_day(self.df, "20170215")
+        self.assertEqual(len(written), 2)
+        self.assertTrue(path.isfile(
+            path.join(self.folder.name, "day=20170215", "line=C", "data.parquet")))
+        self.assertEqual(self.store.days(), ["20170215"])
+
+        df = self.store.load()
+        self.assertEqual(len(df), len(self.df))
+        self.assertEqual(list(df.index.names), [col + "_ix" for col in ID_COLS])
+        # Typed columns
+        self.assertEqual(df["label"].dtype, np.float32)
+        self.assertEqual(df["Stop_stop_id"].dtype.name, "category")
+        self.assertEqual(
+            df.index.get_level_values("Route_route_short_name_ix").dtype.name,
+            "category")
+        self.assertEqual(df["D_business_day"].dtype, bool)
+        self.assertAlmostEqual(df.label.sum(), self.df.label.sum())
+
+    def test_projection_and_pruning(self):
+        self.store.save_day(self.df, "20170215")
+        self.store.save_day(self.df, "20170216")
+
+        df = self.store.load(days=["20170216"], lines=["D"], columns=["label"])
+        self.assertEqual(list(df.columns), ["label"])
+        self.assertEqual(len(df), len(self.df) // 2)
+        self.assertEqual(
+            set(df.index.get_level_values("Route_route_short_name_ix")), {"D"})
+
+        df = self.store.load(
+            lines=["C"], columns=["label"],
+            filter=ds.field("TS_sequence_diff_ix") <= 2)
+        self.assertEqual(len(df), 2 * 4)
+        self.assertEqual(len(self.store.load(days=["20170301"])), 0)
+
+    def test_legacy_pickles(self):
+        self.store.save_day(self.df, "20170215")
+        self.df.to_pickle(path.join(self.folder.name, "20170214.pickle"))
+        # Days with a Parquet partition do not load their pickle
+        self.df.to_pickle(path.join(self.folder.name, "20170215.pickle"))
+
+        self.assertEqual(self.store.days(), ["20170214", "20170215"])
+        df = self.store.load(lines=["C"], columns=["label"])
+        self.assertEqual(len(df), len(self.df))
+        self.assertEqual(list(df.columns), ["label"])
+
+    def test_raw_day(self):
+        raw = pd.DataFrame({
+            "Stop_stop_id": ["StopPoint:DUA8727100", "StopPoint:DUA8739300"],
+            # Mixed types
+            "RealTime_data_freshness": [720, "unknown"],
+            "TS_trip_passed_observed_stop": [True, np.nan],
+        })
+        save_raw_day(raw, "20170215", folder=self.folder.name)
+        loaded = load_raw_day("20170215", folder=self.folder.name)
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(list(loaded.RealTime_data_freshness), ["720", "unknown"])
+
+
+class TestTrainingArrayCache(unittest.TestCase):
+
+    features = ["TS_last_observed_delay", "TS_sequence_diff", "D_business_day"]
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = TrainingSetStore(
+            tempo=30, root=path.join(self.folder.name, "training_set"))
+        self.cache = TrainingArrayCache(
+            self.features, store=self.store,
+            root=path.join(self.folder.name, "arrays"))
+        self.df = build_training_set()
+        self.store.save_day(self.df, "20170215")
+        self.store.save_day(self.df, "20170216")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_iter_arrays(self):
+        days = ["20170214", "20170215", "20170216"]
+        mapped = list(self.cache.iter_arrays(days, "C"))
+        self.assertEqual([day for day, _ in mapped], ["20170215", "20170216"])
+        self.assertEqual(self.cache.counters["built"], 2)
+
+        arrays = mapped[0][1]
+        self.assertIsInstance(arrays["X"], np.memmap)
+        self.assertEqual(arrays["X"].shape, (20, 3))
+        self.assertEqual(arrays["X"].dtype, np.float32)
+        expected = self.df[self.df.Route_route_short_name == "C"]
+        np.testing.assert_array_equal(arrays["label"], expected.label.values)
+        np.testing.assert_array_equal(
+            arrays["X"][:, 0], expected.TS_last_observed_delay.values)
+
+        # Up to date: not built again
+        list(self.cache.iter_arrays(days, "C"))
+        self.assertEqual(self.cache.counters["built"], 2)
+
+        # Rebuilt when source file changes
+        source = self.store._partition_path("20170215", "C")
+        utime(source, (0, 0))
+        list(self.cache.iter_arrays(days, "C"))
+        self.assertEqual(self.cache.counters["built"], 3)
+
+    def test_load_line(self):
+        arrays = self.cache.load_line(
+            ["20170215", "20170216"], "D",
+            mask_function=lambda a: a["sequence_diff"] <= 5)
+        # 2 days, 10 rows of 20 per day with sequence diff <= 5
+        self.assertEqual(len(arrays["label"]), 20)
+        self.assertEqual(arrays["X"].shape, (20, 3))
+        self.assertTrue((arrays["sequence_diff"] <= 5).all())
+        self.assertNotIsInstance(arrays["X"], np.memmap)
+        self.assertEqual(len(self.cache.load_line(["20170301"], "D")["label"]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Tests for utils_trip_extents module.
+"""
+
+import unittest
+import logging
+
+import numpy as np
+import pandas as pd
+
+from api_etl.utils_trip_extents import TripExtents, TripIntervalIndex
+
+logger = logging.getLogger(__name__)
+
+
+class TestTripExtents(unittest.TestCase):
+
+    def test_extents(self):
+        trips = pd.DataFrame(
+            [["T1", "R1", "0", "S1"], ["T2", "R2", "1", "S1"], ["T3", "R1", "0", "S1"]],
+            columns=["trip_id", "route_id", "direction_id", "service_id"])
+        routes = pd.DataFrame(
+            [["R1", "C"], ["R2", "D"]], columns=["route_id", "route_short_name"])
+        # Unordered, and sequences compared as integers
+        stop_times = pd.DataFrame(
+            [["T1", "09:00:00", "09:01:00", "10"], ["T1", "08:00:00", "08:00:00", "0"],
+             ["T1", "08:30:00", "08:31:00", "9"], ["T2", "24:50:00", "25:10:00", "0"],
+             ["T2", "25:40:00", "25:40:00", "1"]],
+            columns=["trip_id", "arrival_time", "departure_time", "stop_sequence"])
+        df = TripExtents(trips, routes, stop_times).df.set_index("trip_id")
+
+        # T3 has no stop times
+        self.assertEqual(list(df.index), ["T1", "T2"])
+        self.assertEqual(df.loc["T1", "first_departure"], 8 * 3600)
+        self.assertEqual(df.loc["T1", "last_arrival"], 9 * 3600)
+        self.assertEqual(df.loc["T1", "number_of_stops"], 3)
+        self.assertEqual(df.loc["T2", "last_arrival"], 25 * 3600 + 40 * 60)
+        self.assertEqual(df.loc["T2", "route_short_name"], "D")
+        self.assertEqual(df.loc["T2", "direction_id"], "1")
+
+
+class TestTripIntervalIndex(unittest.TestCase):
+
+    def test_against_brute_force(self):
+        random = np.random.RandomState(0)
+        starts = random.randint(4 * 3600, 25 * 3600, size=500)
+        ends = starts + random.randint(-600, 7200, size=500)
+        trips = np.arange(500)
+        index = TripIntervalIndex(trips, starts, ends)
+
+        for seconds in range(3 * 3600, 28 * 3600, 613):
+            expected = trips[(starts <= seconds) & (ends >= seconds)]
+            self.assertEqual(index.count_at(seconds), len(expected))
+            self.assertEqual(sorted(index.trips_at(seconds)), list(expected))
+
+    def test_empty(self):
+        index = TripIntervalIndex(np.array([]), np.array([]), np.array([]))
+        self.assertEqual(index.count_at(3600), 0)
+        self.assertEqual(len(index.trips_at(3600)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()